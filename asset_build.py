@@ -0,0 +1,137 @@
+import argparse
+import json
+import math
+import os
+import time
+
+import PIL.Image
+
+from assets import CAR_ATLAS_MANIFEST, CAR_ATLAS_VERSION, source_stamp
+from simulation import RACE_LEVELS
+
+# Сборка атласа машин до запуска игры: исходные PNG рисуются с масштабом
+# 0.08–0.2, а грузятся и уходят в атлас arcade целиком. Здесь каждая пара
+# (файл, масштаб) из составов заездов обрезается по прозрачности, уменьшается
+# ровно до размера на экране и укладывается в одну картинку с манифестом
+ATLAS_PADDING = 2
+# Запас разрешения над масштабом на экране (2 — для HiDPI)
+ATLAS_PIXEL_RATIO = 1
+
+
+def car_variants(levels=RACE_LEVELS):
+    variants = []
+    for race_class in levels.values():
+        for entry in race_class.roster:
+            for name, texture_file, scale, width, height in entry['cars']:
+                if (texture_file, scale) not in variants:
+                    variants.append((texture_file, scale))
+    return variants
+
+
+def shrink(image, scale):
+    # Прозрачные поля отрезаются до уменьшения, иначе они попали бы в атлас
+    box = image.getchannel('A').getbbox() if image.mode == 'RGBA' else None
+    if box:
+        image = image.crop(box)
+    width = max(1, round(image.width * scale))
+    height = max(1, round(image.height * scale))
+    return image.resize((width, height), PIL.Image.Resampling.LANCZOS)
+
+
+def pack(sizes, padding=ATLAS_PADDING):
+    # Полки: картинки по убыванию высоты слева направо, ширина атласа —
+    # степень двойки не меньше стороны квадрата той же площади
+    area = sum((width + padding) * (height + padding) for width, height in sizes)
+    widest = max(width for width, height in sizes) + padding
+    atlas_width = 2 ** math.ceil(math.log2(max(widest, math.sqrt(area), 1)))
+    positions = [None] * len(sizes)
+    x = y = shelf = 0
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        width, height = sizes[index]
+        if x + width + padding > atlas_width:
+            x, y, shelf = 0, y + shelf, 0
+        positions[index] = (x, y)
+        x += width + padding
+        shelf = max(shelf, height + padding)
+    return atlas_width, y + shelf, positions
+
+
+def build_car_atlas(manifest_path=CAR_ATLAS_MANIFEST, pixel_ratio=ATLAS_PIXEL_RATIO,
+                    levels=RACE_LEVELS, report=print):
+    variants = []
+    images = []
+    source_pixels = 0
+    source_decode = 0.0
+    decoded = set()
+    for texture_file, scale in car_variants(levels):
+        if not os.path.exists(texture_file):
+            report(f"Пропуск {texture_file}: файла нет")
+            continue
+        start = time.perf_counter()
+        image = PIL.Image.open(texture_file)
+        image.load()
+        if texture_file not in decoded:
+            # Исходник грузится один раз на файл, сколько бы масштабов ни было
+            decoded.add(texture_file)
+            source_decode += time.perf_counter() - start
+            source_pixels += image.width * image.height
+        variants.append((texture_file, scale))
+        images.append(shrink(image.convert('RGBA'), scale * pixel_ratio))
+    if not images:
+        return False, "Нет ни одной текстуры машин для атласа"
+
+    width, height, positions = pack([image.size for image in images])
+    atlas = PIL.Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    entries = []
+    for (texture_file, scale), image, (x, y) in zip(variants, images, positions):
+        atlas.paste(image, (x, y))
+        entries.append({
+            'source': texture_file,
+            'scale': scale,
+            'region': [x, y, image.width, image.height],
+            'stamp': source_stamp(texture_file),
+        })
+
+    directory = os.path.dirname(manifest_path) or "."
+    os.makedirs(directory, exist_ok=True)
+    image_name = os.path.splitext(os.path.basename(manifest_path))[0] + ".png"
+    atlas.save(os.path.join(directory, image_name), optimize=True)
+    temporary = manifest_path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump({'version': CAR_ATLAS_VERSION, 'image': image_name, 'pixel_ratio': pixel_ratio,
+                   'entries': entries}, f, ensure_ascii=False)
+    os.replace(temporary, manifest_path)
+
+    start = time.perf_counter()
+    PIL.Image.open(os.path.join(directory, image_name)).load()
+    atlas_decode = time.perf_counter() - start
+    stats = {
+        'variants': len(entries),
+        'size': (width, height),
+        'source_pixels': source_pixels,
+        'atlas_pixels': width * height,
+        'source_bytes': source_pixels * 4,
+        'atlas_bytes': width * height * 4,
+        'source_decode': source_decode,
+        'atlas_decode': atlas_decode,
+    }
+    report(f"Атлас {width}x{height}, машин {len(entries)}: {manifest_path}")
+    report(f"Память текстур: {stats['source_bytes'] / 2 ** 20:.2f} МБ -> "
+           f"{stats['atlas_bytes'] / 2 ** 10:.1f} КБ")
+    report(f"Декодирование: {source_decode * 1000:.1f} мс -> {atlas_decode * 1000:.2f} мс")
+    return True, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка атласа машин для игры")
+    parser.add_argument("--output", default=CAR_ATLAS_MANIFEST, help="путь к манифесту атласа")
+    parser.add_argument("--pixel-ratio", type=int, default=ATLAS_PIXEL_RATIO,
+                        help="во сколько раз текстура крупнее размера на экране")
+    args = parser.parse_args()
+    success, result = build_car_atlas(args.output, args.pixel_ratio)
+    if not success:
+        raise SystemExit(result)
+
+
+if __name__ == "__main__":
+    main()
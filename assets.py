@@ -0,0 +1,228 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+import arcade
+import PIL.Image
+
+import tilemap_cache
+
+ASSET_MEMORY_BUDGET = 256 * 1024 * 1024
+# Примерная цена спрайта тайла сверх текстуры: позиция, размер, цвет в буферах SpriteList
+TILE_SPRITE_BYTES = 200
+# Атлас машин, собранный asset_build.py; без него текстуры берутся из исходных PNG
+CAR_ATLAS_MANIFEST = os.path.join("build", "cars.json")
+CAR_ATLAS_VERSION = 1
+
+
+def texture_bytes(texture):
+    width, height = texture.image.size
+    return width * height * 4
+
+
+def sound_bytes(sound):
+    # Звук целиком декодирован в память: длительность на поток байт в секунду
+    source = sound.source
+    audio_format = getattr(source, 'audio_format', None)
+    if source.duration and audio_format:
+        return int(source.duration * audio_format.bytes_per_second)
+    return os.path.getsize(sound.file_name) if os.path.exists(str(sound.file_name)) else 0
+
+
+def tilemap_bytes(tile_map):
+    textures = {}
+    sprites = 0
+    for sprite_list in tile_map.sprite_lists.values():
+        sprites += len(sprite_list)
+        for sprite in sprite_list:
+            textures[id(sprite.texture)] = sprite.texture
+    return sum(texture_bytes(texture) for texture in textures.values()) + sprites * TILE_SPRITE_BYTES
+
+
+def source_stamp(path):
+    # Исходник считается тем же, пока не изменились размер и время правки
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class CarAtlas:
+    # Уменьшенные и обрезанные по прозрачности машины из одной картинки.
+    # Текстура собрана под масштаб из состава заезда, поэтому рисуется с
+    # масштабом 1 / pixel_ratio. Записи, чей исходник изменился после сборки,
+    # пропускаются, и такая машина грузится из исходного PNG
+    def __init__(self, manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get('version') != CAR_ATLAS_VERSION:
+            raise ValueError(f"Атлас {manifest_path} другой версии, пересоберите его")
+        self.pixel_ratio = data['pixel_ratio']
+        self.stale = []
+        self.textures = {}
+        image = PIL.Image.open(os.path.join(os.path.dirname(manifest_path), data['image']))
+        image.load()
+        for entry in data['entries']:
+            source = entry['source']
+            if not os.path.exists(source) or source_stamp(source) != entry['stamp']:
+                self.stale.append(source)
+                continue
+            x, y, width, height = entry['region']
+            self.textures[(source, entry['scale'])] = arcade.Texture(
+                image.crop((x, y, x + width, y + height)), hash=f"atlas:{source}:{entry['scale']}")
+
+    def get(self, path, scale):
+        texture = self.textures.get((path, scale))
+        if texture is None:
+            return None
+        return texture, 1 / self.pixel_ratio
+
+
+def atlas_bytes(atlas):
+    return sum(texture_bytes(texture) for texture in atlas.textures.values())
+
+
+LOADERS = {
+    'texture': (arcade.load_texture, texture_bytes),
+    'sound': (arcade.load_sound, sound_bytes),
+    'tilemap': (tilemap_cache.load_tilemap, tilemap_bytes),
+    'atlas': (CarAtlas, atlas_bytes),
+}
+
+
+class AssetRegistry:
+    # Общий на процесс реестр тайлмапов, текстур и звуков: каждый файл
+    # грузится один раз, виды получают один и тот же объект. Занятые ресурсы
+    # (счётчик ссылок больше нуля) не выгружаются никогда; отпущенные остаются
+    # в памяти, пока сумма не превысит budget, и тогда уходят в порядке LRU.
+    # Работает только из главного потока, как и всё, что трогает arcade
+
+    def __init__(self, budget=ASSET_MEMORY_BUDGET, loaders=None):
+        self.budget = budget
+        self.loaders = loaders or LOADERS
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._pending = []
+
+    def acquire(self, kind, path, **options):
+        key = (kind, path, tuple(sorted(options.items())))
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            load, measure = self.loaders[kind]
+            start = time.perf_counter()
+            asset = load(path, **options)
+            elapsed = time.perf_counter() - start
+            self.load_time += elapsed
+            entry = {'asset': asset, 'refs': 0, 'bytes': measure(asset), 'load_time': elapsed}
+            self._entries[key] = entry
+            self.total_bytes += entry['bytes']
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        entry['refs'] += 1
+        self._evict()
+        return entry['asset']
+
+    def release(self, kind, path, **options):
+        entry = self._entries.get((kind, path, tuple(sorted(options.items()))))
+        if entry is not None and entry['refs'] > 0:
+            entry['refs'] -= 1
+            self._evict()
+
+    def preload(self, manifest):
+        # manifest — список (kind, path, options); ресурсы грузятся заранее и
+        # остаются отпущенными, чтобы их можно было выгрузить при нехватке
+        for kind, path, options in manifest:
+            self.acquire(kind, path, **options)
+            self.release(kind, path, **options)
+
+    def queue_preload(self, manifest):
+        # Та же предзагрузка, но по одному ресурсу за вызов preload_next —
+        # вид вызывает его раз в кадр, и загрузка не останавливает отрисовку
+        self._pending.extend(manifest)
+
+    def preload_next(self):
+        # (True, сколько осталось) или (False, ошибка); ресурс, который не
+        # удалось загрузить, пропускается и позже грузится при первом запросе
+        if not self._pending:
+            return True, 0
+        kind, path, options = self._pending.pop(0)
+        try:
+            self.preload([(kind, path, options)])
+        except OSError as e:
+            return False, f"Не удалось заранее загрузить {path}: {e}"
+        return True, len(self._pending)
+
+    def lease(self):
+        return AssetLease(self)
+
+    def _evict(self):
+        if self.total_bytes <= self.budget:
+            return
+        for key in [key for key, entry in self._entries.items() if not entry['refs']]:
+            entry = self._entries.pop(key)
+            self.total_bytes -= entry['bytes']
+            self.evictions += 1
+            if self.total_bytes <= self.budget:
+                break
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'assets': len(self._entries),
+            'in_use': sum(1 for entry in self._entries.values() if entry['refs']),
+            'bytes': self.total_bytes,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'evictions': self.evictions,
+            'load_time': self.load_time,
+            'slowest': sorted(((entry['load_time'], key[1]) for key, entry in self._entries.items()),
+                              reverse=True)[:5],
+        }
+
+
+class AssetLease:
+    # Ресурсы одного вида: всё взятое через аренду отпускается одним release()
+    # при перезапуске уровня или уходе с экрана
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.held = []
+
+    def acquire(self, kind, path, **options):
+        asset = self.registry.acquire(kind, path, **options)
+        self.held.append((kind, path, options))
+        return asset
+
+    def texture(self, path):
+        return self.acquire('texture', path)
+
+    def sound(self, path):
+        return self.acquire('sound', path)
+
+    def tilemap(self, path, scaling=1.0):
+        return self.acquire('tilemap', path, scaling=scaling)
+
+    def car_texture(self, path, scale, atlas_path=CAR_ATLAS_MANIFEST):
+        # (текстура, масштаб спрайта): из собранного атласа, если машина в нём
+        # есть, иначе исходный PNG с масштабом из состава
+        if os.path.exists(atlas_path):
+            try:
+                found = self.acquire('atlas', atlas_path).get(path, scale)
+            except (OSError, ValueError, KeyError):
+                # Битый или устаревший манифест не должен мешать запуску
+                found = None
+            if found:
+                return found
+        return self.texture(path), scale
+
+    def release(self):
+        for kind, path, options in self.held:
+            self.registry.release(kind, path, **options)
+        self.held = []
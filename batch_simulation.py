@@ -0,0 +1,213 @@
+import numpy as np
+
+from simulation import (FIXED_DT, MAX_RACE_TIME, SCREEN_HEIGHT, SCREEN_WIDTH, SIMULATION_FPS,
+                        LevelOneRace, RACE_LEVELS, default_driver)
+
+# Пакетная модель заездов для подбора сложности: N гонок сразу, каждая
+# величина — массив формы (N, машины), столбец 0 — игрок. Повторяет
+# движение ИИ (на втором уровне — по полю направлений карты и со
+# столкновениями машин), случайные отклонения, удержание на дороге и финиш
+# из simulation.py, но без стен. Игрок едет
+# как PlayerBot с мгновенной реакцией. Генератор numpy не совпадает с
+# random.Random по seed, поэтому сравнивать с покадровой моделью нужно
+# распределения, а не отдельные заезды
+
+
+def start_state(race, races, rng, player_speed):
+    cars = race.cars
+    x = np.tile(np.array([car.center_x for car in cars], dtype=float), (races, 1))
+    y = np.tile(np.array([car.center_y for car in cars], dtype=float), (races, 1))
+    speed = np.empty((races, len(cars)))
+    speed[:, 0] = race.settings['player_speed'] if player_speed is None else player_speed
+    speed[:, 1:] = rng.uniform(race.settings['ai_speed_min'], race.settings['ai_speed_max'],
+                               (races, len(cars) - 1))
+    return x, y, speed
+
+
+def move_player(driver, x, y, speed, active):
+    # Основная ось к финишу и поперечный возврат на полосу PlayerBot
+    main, lateral = (x, y) if driver.direction_x else (y, x)
+    direction = driver.direction_x or driver.direction_y
+    main += np.where(active, direction * speed, 0)
+    offset = lateral - driver.lane_center
+    outside = active & (np.abs(offset) > driver.lane_half_width)
+    lateral -= np.where(outside, np.sign(offset) * speed, 0)
+
+
+def deviate(race, rng, lateral, active):
+    # Случайное поперечное отклонение: возвращает сдвиг и маску машин, которым
+    # оно выпало в этом шаге
+    shape = lateral.shape
+    rolled = active & (rng.random(shape) < race.ai_deviation_chance)
+    deviation = rng.uniform(-race.ai_deviation, race.ai_deviation, shape)
+    return np.where(rolled, deviation, 0.0), rolled
+
+
+def step_level_one(race, rng, x, y, speed, active):
+    left_limit, right_limit = race.road_limits
+    ai_x, ai_y, ai_speed, ai_active = x[:, 1:], y[:, 1:], speed[:, 1:], active[:, 1:]
+    ai_y -= np.where(ai_active, ai_speed, 0)
+    deviation, rolled = deviate(race, rng, ai_x, ai_active)
+    new_x = ai_x + deviation
+    inside = (new_x >= left_limit) & (new_x <= right_limit)
+    ai_x[...] = np.where(rolled & inside, new_x, np.where(rolled, ai_x - deviation * 0.3, ai_x))
+
+    # keep_car_on_road для всех машин; скорость ИИ гасится, игрок просто прижимается
+    too_left = active & (x < left_limit)
+    too_right = active & (x > right_limit)
+    x[too_left] = left_limit + 5
+    x[too_right] = right_limit - 5
+    slowed = (too_left | too_right)[:, 1:]
+    ai_speed[slowed] *= 0.95
+
+    lengths = np.array([car.car_length for car in race.cars], dtype=float)
+    return (active & (x >= race.finish_line_x_start) & (x <= race.finish_line_x_end) &
+            (y - lengths / 2 <= race.finish_line_y))
+
+
+def flow_headings(flow_field):
+    # Направление по номеру клетки из FlowField; последняя строка — прямо
+    # к финишу, её получают клетки без направления и всё за краем карты
+    if flow_field is None:
+        return None
+    vectors = np.array(flow_field.vectors + [(1.0, 0.0)])
+    directions = np.array(flow_field.directions)
+    return flow_field, np.vstack([vectors[directions], vectors[-1:]])
+
+
+def heading(flow, x, y):
+    if flow is None:
+        return 1.0, 0.0
+    field, headings = flow
+    column = (x // field.cell_size).astype(int)
+    row = (y // field.cell_size).astype(int)
+    inside = (column >= 0) & (column < field.columns) & (row >= 0) & (row < field.rows)
+    cells = headings[np.where(inside, row * field.columns + column, -1)]
+    return cells[..., 0], cells[..., 1]
+
+
+def collide_level_two(race, x, y, speed, active):
+    # handle_car_collision по всем парам машин: ИИ отталкивается и теряет
+    # скорость не ниже ai_speed_min. Толчок игрока не повторяется — бот
+    # задаёт change_x и change_y заново на каждом шаге
+    push = race.settings['push']
+    ai_speed_min = race.settings['ai_speed_min']
+    radius = [car.collision_radius for car in race.cars]
+    cars = x.shape[1]
+    for first in range(cars):
+        for second in range(first + 1, cars):
+            dx = x[:, second] - x[:, first]
+            dy = y[:, second] - y[:, first]
+            distance = np.hypot(dx, dy)
+            hit = active[:, first] & active[:, second] & (distance < radius[first] + radius[second])
+            if not hit.any():
+                continue
+            # Машины в одной точке в покадровой модели расталкиваются в
+            # случайную сторону, здесь — вдоль оси x
+            apart = distance > 0
+            safe = np.where(apart, distance, 1.0)
+            normal_x = np.where(apart, dx / safe, 1.0)
+            normal_y = np.where(apart, dy / safe, 0.0)
+            for car, sign in ((first, -1), (second, 1)):
+                if car == 0:
+                    continue
+                speed[:, car] = np.where(hit, np.maximum(speed[:, car] * 0.7, ai_speed_min), speed[:, car])
+                x[:, car] += np.where(hit, sign * normal_x * push * 0.3, 0)
+                y[:, car] += np.where(hit, sign * normal_y * push * 0.3, 0)
+
+
+def step_level_two(race, rng, x, y, speed, active, screen, flow=None):
+    collide_level_two(race, x, y, speed, active)
+    ai_x, ai_y, ai_speed, ai_active = x[:, 1:], y[:, 1:], speed[:, 1:], active[:, 1:]
+    # Как decide_ai_car: направление берётся по клетке до шага
+    heading_x, heading_y = heading(flow, ai_x, ai_y)
+    ai_x += np.where(ai_active, ai_speed * heading_x, 0)
+    ai_y += np.where(ai_active, ai_speed * heading_y, 0)
+    deviation, rolled = deviate(race, rng, ai_y, ai_active)
+    new_y = ai_y + deviation
+    y_min, y_max = race.ai_lane
+    inside = (new_y >= y_min) & (new_y <= y_max)
+    ai_y[...] = np.where(rolled & inside, new_y, np.where(rolled, ai_y - deviation * 0.5, ai_y))
+
+    # keep_car_in_bounds: у ИИ удар о край экрана срезает скорость
+    margin = race.bounds_margin
+    width, height = screen
+    hit_side = ai_active & ((ai_x < margin) | (ai_x > width - margin))
+    ai_speed[...] = np.where(hit_side, np.maximum(ai_speed * 0.8, race.settings['ai_speed_min']),
+                             ai_speed)
+    np.clip(x, margin, width - margin, out=x, where=active)
+    np.clip(y, margin, height - margin, out=y, where=active)
+
+    return (active & (y >= race.finish_line_y_start) & (y <= race.finish_line_y_end) &
+            (x >= race.finish_line_x))
+
+
+def simulate_races(level, races, seed=None, player_speed=None, settings=None, path=None,
+                   max_time=MAX_RACE_TIME, dt=FIXED_DT):
+    # player_speed — число или массив длины races, чтобы за один вызов
+    # прогнать сразу несколько профилей скорости игрока
+    race = RACE_LEVELS[level].from_map(path, seed=0, settings=settings, countdown=False)
+    driver = default_driver(level)
+    rng = np.random.default_rng(seed)
+    x, y, speed = start_state(race, races, rng, player_speed)
+    cars = len(race.cars)
+    finished = np.zeros((races, cars), dtype=bool)
+    finish_ticks = np.full((races, cars), -1)
+    rows = np.arange(races)
+    flow = flow_headings(race.flow_field)
+
+    max_ticks = int(round(max_time / dt))
+    for tick in range(1, max_ticks + 1):
+        active = ~finished
+        racing = active.any(axis=1)
+        if not racing.any():
+            break
+        if tick % SIMULATION_FPS == 0 and racing.mean() < 0.5:
+            # Завершённые заезды выкидываются из массивов, чтобы хвост из
+            # редких долгих гонок не считался по всей выборке
+            x, y, speed, finished, active, rows = (
+                x[racing], y[racing], speed[racing], finished[racing], active[racing], rows[racing]
+            )
+        move_player(driver, x[:, 0], y[:, 0], speed[:, 0], active[:, 0])
+        if isinstance(race, LevelOneRace):
+            crossed = step_level_one(race, rng, x, y, speed, active)
+        else:
+            crossed = step_level_two(race, rng, x, y, speed, active, (SCREEN_WIDTH, SCREEN_HEIGHT), flow)
+        crossed_rows, crossed_cars = np.nonzero(crossed)
+        finish_ticks[rows[crossed_rows], crossed_cars] = tick
+        finished |= crossed
+        # Финишировавшая машина стоит на месте
+        speed[crossed] = 0
+    return race_statistics(race, level, finish_ticks, dt)
+
+
+def race_statistics(race, level, finish_ticks, dt):
+    races, cars = finish_ticks.shape
+    # В одном шаге ИИ проверяются раньше игрока, поэтому при равенстве
+    # шагов игрок оказывается позади
+    ticks_key = np.where(finish_ticks < 0, np.iinfo(finish_ticks.dtype).max, finish_ticks)
+    tie_break = np.broadcast_to(np.r_[cars, np.arange(1, cars)], finish_ticks.shape)
+    order = np.lexsort((tie_break, ticks_key))
+    positions = np.empty_like(finish_ticks)
+    np.put_along_axis(positions, order, np.arange(1, cars + 1), axis=1)
+    positions[finish_ticks < 0] = 0
+    finish_times = np.where(finish_ticks < 0, np.nan, finish_ticks * dt)
+    finished_times = finish_times[~np.isnan(finish_times[:, 0]), 0]
+    return {
+        'level': level,
+        'races': races,
+        'car_names': [car.color_name for car in race.cars],
+        'finish_ticks': finish_ticks,
+        'finish_times': finish_times,
+        'finish_order': order,
+        'positions': positions,
+        'win_rates': (positions == 1).mean(axis=0),
+        'player_win_rate': float((positions[:, 0] == 1).mean()),
+        'player_positions': np.bincount(positions[:, 0], minlength=cars + 1),
+        'player_time_percentiles': (np.percentile(finished_times, (5, 50, 95))
+                                    if finished_times.size else None),
+        'mean_finish_times': np.array([
+            np.nanmean(column) if not np.isnan(column).all() else np.nan
+            for column in finish_times.T
+        ]),
+    }
@@ -0,0 +1,856 @@
+import argparse
+import itertools
+import math
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+import arcade
+import PIL.Image
+import pyglet
+from pyglet.media.exceptions import MediaException
+
+from assets import AssetRegistry
+from example import GameDatabase, LayerCache, MUSIC_FILE, MUSIC_VOLUME, RaceHud, SCHEMA_MIGRATIONS, level_manifest
+from music import MusicService
+from tilemap_cache import cache_path, compile_tilemap, load_tilemap
+from simulation import (FIXED_DT, MAX_RACE_TIME, RACE_LEVELS, SCREEN_HEIGHT, SCREEN_WIDTH, AIScheduler,
+                        Car, LevelOneRace, StressRamp, default_driver, simulate_race)
+from track import DEFAULT_TILE_SIZE, TILE_SCALING, OccupancyGrid, build_flow_field, load_flow_field, load_map_geometry
+
+# Цель для безголовых заездов по одному — тысячи в секунду на ядро
+SIMULATION_TARGET_RATE = 1000
+
+
+def measure(func, repeat=200):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def print_plan(database, query, params):
+    database.cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+    for row in database.cursor.fetchall():
+        print(f"    {row[-1]}")
+
+
+def fill_race_results(database, rows, players, levels=3, chunk=100000):
+    rng = random.Random(12345)
+    cursor = database.conn.cursor()
+    cursor.executemany(
+        "INSERT INTO players (username, password) VALUES (?, ?)",
+        ((f"bench_{i}", "-") for i in range(players))
+    )
+    for start in range(0, rows, chunk):
+        cursor.executemany(
+            "INSERT INTO race_results (player_id, level, position, race_time) VALUES (?, ?, ?, ?)",
+            (
+                (rng.randint(1, players), rng.randint(1, levels),
+                 rng.randint(1, 3), round(rng.uniform(20.0, 90.0), 3))
+                for _ in range(min(chunk, rows - start))
+            )
+        )
+    cursor.execute('''
+        INSERT INTO race_best (player_id, level, best_time, position)
+        SELECT player_id, level, MIN(race_time), position
+        FROM race_results GROUP BY player_id, level
+    ''')
+    database.conn.commit()
+
+
+def bench_leaderboard(rows, players):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = GameDatabase(os.path.join(tmp, "bench.db"))
+        start = time.perf_counter()
+        fill_race_results(database, rows, players)
+        print(f"Заполнение: {rows} заездов, {players} игроков за {time.perf_counter() - start:.1f} сек")
+
+        player_id = players // 2
+        ok, (first_page, cursor) = database.get_leaderboard(1, limit=10)
+        deep_cursor = None
+        for _ in range(50):
+            ok, (page, deep_cursor) = database.get_leaderboard(1, limit=100, after=deep_cursor)
+
+        checks = [
+            ("Топ-10 уровня", lambda: database.get_leaderboard(1, limit=10)),
+            ("Страница 51 (по ключу)", lambda: database.get_leaderboard(1, limit=100, after=deep_cursor)),
+            ("Страница 51 (OFFSET, для сравнения)", lambda: database.cursor.execute('''
+                SELECT b.player_id, p.username, b.best_time, b.position
+                FROM race_best AS b JOIN players AS p ON p.id = b.player_id
+                WHERE b.level = ? ORDER BY b.best_time, b.player_id LIMIT 100 OFFSET 5000
+            ''', (1,)).fetchall()),
+            ("Личный рекорд", lambda: database.get_personal_best(player_id, 1)),
+            ("Место игрока", lambda: database.get_player_rank(player_id, 1)),
+            ("Запись результата", lambda: database.record_race_result(
+                player_id, 1, 1, random.uniform(20.0, 90.0))),
+        ]
+        for name, func in checks:
+            median, worst = measure(func)
+            print(f"{name:40s} медиана {median:7.3f} мс, максимум {worst:7.3f} мс")
+
+        print("Планы запросов:")
+        plans = [
+            ("Топ-N", '''
+                SELECT b.player_id, p.username, b.best_time, b.position
+                FROM race_best AS b JOIN players AS p ON p.id = b.player_id
+                WHERE b.level = ? AND (b.best_time, b.player_id) > (?, ?)
+                ORDER BY b.best_time, b.player_id LIMIT ?
+            ''', (1, 0.0, 0, 10)),
+            ("Личный рекорд", "SELECT best_time FROM race_best WHERE player_id = ? AND level = ?",
+             (player_id, 1)),
+            ("Место игрока", '''
+                SELECT COUNT(*) FROM race_best
+                WHERE level = ? AND (best_time, player_id) < (?, ?)
+            ''', (1, 50.0, player_id)),
+            ("История игрока", '''
+                SELECT MIN(race_time) FROM race_results WHERE player_id = ? AND level = ?
+            ''', (player_id, 1)),
+        ]
+        for name, query, params in plans:
+            print(f"  {name}:")
+            print_plan(database, query, params)
+        database.close()
+
+
+def create_legacy_database(path, players, duplicates):
+    # Схема до миграций: player_progress без индекса по player_id
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.executescript(SCHEMA_MIGRATIONS[0][0] + ";" + SCHEMA_MIGRATIONS[0][1])
+    cursor.executemany(
+        "INSERT INTO players (username, password) VALUES (?, ?)",
+        ((f"bench_{i}", "-") for i in range(players))
+    )
+    cursor.execute("INSERT INTO player_progress (player_id, current_level) SELECT id, 1 FROM players")
+    rng = random.Random(12345)
+    cursor.executemany(
+        "INSERT INTO player_progress (player_id, current_level) VALUES (?, ?)",
+        ((rng.randint(1, players), rng.randint(1, 3)) for _ in range(duplicates))
+    )
+    conn.commit()
+    return conn
+
+
+def legacy_update_player_level(conn, player_id, new_level):
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE player_progress SET current_level = ? WHERE player_id = ?",
+        (new_level, player_id)
+    )
+    if cursor.rowcount == 0:
+        cursor.execute(
+            "INSERT INTO player_progress (player_id, current_level) VALUES (?, ?)",
+            (player_id, new_level)
+        )
+    conn.commit()
+
+
+def bench_progress(players, duplicates, updates):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        conn = create_legacy_database(path, players, duplicates)
+        rng = random.Random(1)
+        ids = [rng.randint(1, players) for _ in range(updates)]
+
+        start = time.perf_counter()
+        for player_id in ids:
+            legacy_update_player_level(conn, player_id, 2)
+        before = (time.perf_counter() - start) * 1000 / updates
+        conn.close()
+
+        start = time.perf_counter()
+        database = GameDatabase(path)
+        print(f"Миграции до версии {len(SCHEMA_MIGRATIONS)}: {time.perf_counter() - start:.2f} сек")
+        database.cursor.execute("SELECT COUNT(*), COUNT(DISTINCT player_id) FROM player_progress")
+        rows, distinct = database.cursor.fetchone()
+        print(f"Строк прогресса после удаления дубликатов: {rows} (игроков {distinct})")
+
+        start = time.perf_counter()
+        for player_id in ids:
+            database.update_player_level(player_id, 3)
+        after = (time.perf_counter() - start) * 1000 / updates
+        print(f"Обновление уровня: до {before:.3f} мс, после {after:.3f} мс ({before / after:.0f}x)")
+
+        # Повторное чтение профиля идёт из ProfileCache, а не из БД
+        profiles = sorted(set(ids))
+        for label in ("из БД", "из кэша"):
+            start = time.perf_counter()
+            for player_id in profiles:
+                database.get_player_profile(player_id)
+            print(f"Чтение профиля {label}: {(time.perf_counter() - start) * 1000 / len(profiles):.3f} мс")
+        stats = database.profile_cache.stats()
+        print(f"Кэш профилей: попаданий {stats['hits']}, промахов {stats['misses']}, "
+              f"доля попаданий {stats['hit_rate']:.0%}, записей {stats['size']}")
+        print("План поиска строки прогресса:")
+        print_plan(database, "SELECT current_level FROM player_progress WHERE player_id = ?", (1,))
+        database.close()
+
+
+STARTUP_PROBE = '''
+import os
+import sys
+import time
+
+project = os.path.abspath(sys.argv[1])
+watched = (project, os.getcwd())
+events = []
+
+
+def audit(event, args):
+    if event == "sqlite3.connect":
+        events.append(f"{event} {args[0]}")
+    elif event == "open" and isinstance(args[0], str):
+        path = os.path.abspath(args[0])
+        if path.startswith(watched) and not path.endswith((".py", ".pyc")):
+            events.append(f"{event} {path}")
+
+
+sys.addaudithook(audit)
+sys.path.insert(0, project)
+start = time.perf_counter()
+import example
+print(f"{(time.perf_counter() - start) * 1000:.1f}")
+print("\\n".join(events))
+'''
+
+
+def bench_startup():
+    # Импорт модуля игры не должен открывать БД и файлы проекта: проверяется
+    # через audit hook в отдельном процессе из пустого каталога
+    project = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE, project],
+            cwd=tmp, capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        import_ms, events = float(output[0]), [line for line in output[1:] if line]
+        print(f"Импорт example: {import_ms:.1f} мс")
+        print(f"Обращений к БД и файлам проекта при импорте: {len(events)}")
+        for event in events:
+            print(f"    {event}")
+
+        database = GameDatabase(os.path.join(tmp, "bench.db"), write_behind=True, lazy=True)
+        start = time.perf_counter()
+        database.warm_up()
+        database._warm_up_thread.join()
+        print(f"Открытие БД и миграции (в фоне после показа меню): "
+              f"{(time.perf_counter() - start) * 1000:.1f} мс")
+        database.close()
+    return 1 if events else 0
+
+
+def bench_simulation(races, seed):
+    # Безголовые заезды с ботом: пропускная способность и детерминизм по seed
+    for level in sorted(RACE_LEVELS):
+        start = time.perf_counter()
+        results = [simulate_race(level, seed + i) for i in range(races)]
+        elapsed = time.perf_counter() - start
+        repeat = simulate_race(level, seed)
+        wins = sum(result['player_won'] for result in results)
+        finished = sum(result['finished'] for result in results)
+        rate = races / elapsed
+        print(f"Уровень {level}: {rate:8.1f} заездов/сек, "
+              f"завершено {finished}/{races}, побед бота {wins}, "
+              f"повтор seed {'совпал' if repeat == results[0] else 'НЕ совпал'}")
+        # Факт против цели, а не только число: по одному заезду цель пока
+        # не достигнута, тысячи в секунду даёт пакетная модель (montecarlo)
+        print(f"  цель {SIMULATION_TARGET_RATE} заездов/сек: "
+              f"{'достигнута' if rate >= SIMULATION_TARGET_RATE else 'НЕ достигнута'} "
+              f"({rate / SIMULATION_TARGET_RATE:.0%})")
+    for level in sorted(RACE_LEVELS):
+        bench_frame_rates(level, seed)
+
+
+def race_at_frame_rate(level, seed, frame_times):
+    # Заезд так, как его ведёт окно: кадры произвольной длины через advance()
+    race = RACE_LEVELS[level].from_map(seed=seed, driver=default_driver(level))
+    for frame_time in frame_times:
+        if race.race_finished or race.game_time > MAX_RACE_TIME:
+            break
+        race.advance(frame_time)
+    return race.results()
+
+
+def bench_frame_rates(level, seed):
+    jitter = random.Random(seed)
+    modes = [(f"{fps} Гц", itertools.repeat(1 / fps)) for fps in (30, 60, 144, 240)]
+    modes.append(("рваные кадры 5-70 мс", iter(lambda: jitter.uniform(0.005, 0.07), None)))
+    reference = None
+    for name, frame_times in modes:
+        result = race_at_frame_rate(level, seed, frame_times)
+        reference = reference or result
+        print(f"Уровень {level}, {name:22s}: шагов {result['ticks']}, "
+              f"время игрока {result['player_time']:.3f} сек, "
+              f"{'совпадает' if result == reference else 'ОТЛИЧАЕТСЯ'}")
+
+
+def bench_montecarlo(races, seed, speeds):
+    # numpy импортируется только здесь: для игры и остальных замеров он не нужен
+    import numpy as np
+    from batch_simulation import simulate_races
+
+    for level in (1, 2):
+        race_class = RACE_LEVELS[level]
+        start = time.perf_counter()
+        batch = simulate_races(level, races, seed=seed)
+        batch_rate = races / (time.perf_counter() - start)
+
+        # Та же модель по одному заезду на той же карте, бот реагирует каждый шаг
+        scalar_races = max(races // 50, 1)
+        start = time.perf_counter()
+        scalar_times = []
+        for i in range(scalar_races):
+            driver = default_driver(level)
+            driver.reaction_time = 0
+            race = race_class.from_map(seed=seed + i, driver=driver, countdown=False)
+            race.run()
+            scalar_times.append([race.finish_times.get(car, float("nan")) for car in race.cars])
+        scalar_rate = scalar_races / (time.perf_counter() - start)
+        names = ", ".join(batch['car_names'])
+        print(f"Уровень {level}: пакетно {batch_rate:9.0f} заездов/сек, "
+              f"по одному {scalar_rate:7.0f} заездов/сек")
+        scalar_mean = np.nanmean(scalar_times, axis=0)
+        print(f"  среднее время финиша ({names}): пакетно "
+              f"{np.round(batch['mean_finish_times'], 2)}, по одному {np.round(scalar_mean, 2)}")
+        # Пакетная модель без стен: у ИИ расхождение в пределах разброса
+        # выборки (до 1% при 1000 заездах по одному), игрок на втором уровне не
+        # объезжает камни и финиширует на ~6% раньше
+        difference = (batch['mean_finish_times'] - scalar_mean) / scalar_mean
+        print(f"  расхождение: {', '.join(f'{value:+.1%}' for value in difference)}")
+
+        profile = np.repeat(speeds, races // len(speeds))
+        sweep = simulate_races(level, len(profile), seed=seed, player_speed=profile)
+        wins = sweep['positions'][:, 0] == 1
+        table = ", ".join(f"{speed:g}: {wins[profile == speed].mean():.1%}" for speed in speeds)
+        print(f"  вероятность победы по скорости игрока: {table}")
+
+
+def bench_farm(level, races):
+    # Масштабирование фермы заездов по числу процессов
+    from race_farm import run_farm
+
+    base = None
+    for workers in sorted({1, 2, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        run_farm(level, [{}], races, workers=workers, chunk_size=max(races // (workers * 8), 1),
+                 output=os.devnull, report=lambda message: None)
+        rate = races / (time.perf_counter() - start)
+        base = base or rate
+        print(f"Процессов {workers:3d}: {rate:8.0f} заездов/сек (x{rate / base:.2f})")
+
+
+def crowded_race(level, cars, seed):
+    # Заезд с толпой машин ИИ, равномерно разбросанных по экрану
+    race = RACE_LEVELS[level](seed=seed, countdown=False)
+    rng = random.Random(seed)
+    template = race.ai_cars[0]
+    while len(race.cars) < cars:
+        race.add_car(Car(f"ИИ {len(race.cars)}", rng.uniform(0, SCREEN_WIDTH), rng.uniform(0, SCREEN_HEIGHT),
+                         template.width, template.height, ai_speed=race.random_ai_speed(),
+                         car_length=template.car_length, car_width=template.car_width))
+    return race
+
+
+def naive_collisions(race):
+    # Прежний вариант: уровень 1 проверял каждую пару дважды, уровень 2 —
+    # двойной цикл с math.sqrt
+    hits = 0
+    cars = race.cars
+    if isinstance(race, LevelOneRace):
+        for car in cars:
+            for other in cars:
+                if other is not car and race.check_car_collision_front_rear(car, other):
+                    hits += 1
+    else:
+        for i in range(len(cars)):
+            for j in range(i + 1, len(cars)):
+                car1, car2 = cars[i], cars[j]
+                distance = math.sqrt((car1.center_x - car2.center_x) ** 2 +
+                                     (car1.center_y - car2.center_y) ** 2)
+                if distance < car1.collision_radius + car2.collision_radius:
+                    hits += 1
+    return hits
+
+
+def grid_collisions(race, pairs=None):
+    check = (race.check_car_collision_front_rear if isinstance(race, LevelOneRace)
+             else race.check_car_collision)
+    pairs = race.collision_pairs() if pairs is None else pairs
+    return sum(1 for car1, car2 in pairs if check(car1, car2))
+
+
+def bench_collisions(counts, seed):
+    # 3 машины — обычный заезд: там collision_pairs обходится без сетки
+    # (SPATIAL_HASH_MIN_CARS), поэтому сетка меряется и отдельно
+    for level in (1, 2):
+        for cars in counts:
+            race = crowded_race(level, cars, seed)
+            naive, _ = measure(lambda: naive_collisions(race), repeat=20)
+            grid, _ = measure(lambda: grid_collisions(race, race.collision_grid.pairs(race.cars)), repeat=20)
+            chosen, _ = measure(lambda: grid_collisions(race), repeat=20)
+            candidates = len(race.collision_pairs())
+            print(f"Уровень {level}, машин {cars:4d}: перебор {naive:8.3f} мс, сетка {grid:7.3f} мс, "
+                  f"collision_pairs {chosen:7.3f} мс (x{naive / chosen:5.1f}), "
+                  f"пар-кандидатов {candidates}, касаний {grid_collisions(race)}")
+
+
+def bench_walls(sizes, density, seed):
+    # Проверка хитбокса машины о стены: перебор прямоугольников тайлов против
+    # сетки занятости на картах разного размера с долей стен density
+    tile = DEFAULT_TILE_SIZE
+    for columns, rows in sizes:
+        rng = random.Random(seed)
+        centers = [((column + 0.5) * tile, (row + 0.5) * tile)
+                   for column in range(columns) for row in range(rows) if rng.random() < density]
+        rects = [(x - tile / 2, y - tile / 2, x + tile / 2, y + tile / 2) for x, y in centers]
+        grid = OccupancyGrid.from_tiles(centers, tile)
+        probes = [(rng.uniform(0, columns * tile), rng.uniform(0, rows * tile)) for _ in range(1000)]
+
+        def scan():
+            for x, y in probes:
+                left, bottom, right, top = x - 51, y - 24, x + 51, y + 24
+                for wall in rects:
+                    if left < wall[2] and right > wall[0] and bottom < wall[3] and top > wall[1]:
+                        break
+
+        def lookup():
+            for x, y in probes:
+                grid.overlaps(x - 51, y - 24, x + 51, y + 24)
+
+        scan_ms, _ = measure(scan, repeat=5)
+        grid_ms, _ = measure(lookup, repeat=5)
+        print(f"Карта {columns}x{rows} ({len(rects)} стен): перебор {scan_ms:8.1f} мкс, "
+              f"сетка {grid_ms:5.2f} мкс на проверку (x{scan_ms / grid_ms:.0f})")
+
+
+def bench_standings(counts, seed):
+    # Живая таблица мест: сортировка вставками по уже почти упорядоченному
+    # списку против полной сортировки каждый шаг
+    for cars in counts:
+        race = crowded_race(2, cars, seed)
+        race.driver = default_driver(2)
+        race.live_standings = True
+        for _ in range(30):
+            race.step()
+        progress, _ = measure(race.update_progress, repeat=50)
+        incremental, _ = measure(race.update_standings, repeat=50)
+        full, _ = measure(lambda: sorted(race.cars, key=race.standing_key), repeat=50)
+        print(f"Машин {cars:4d}: прогресс {progress:6.3f} мс, таблица вставками {incremental:6.3f} мс, "
+              f"полная сортировка {full:6.3f} мс")
+
+
+def bench_flowfield(races, seed):
+    # Поле направлений второго уровня: построение, чтение из .cache, цена
+    # одного запроса и длина заездов ИИ с полем и без него
+    race_class = RACE_LEVELS[2]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), race_class.map_path)
+    walls, _ = load_map_geometry(path, race_class.wall_layers)
+    field = race_class.load_flow_field(path)
+    build, _ = measure(lambda: build_flow_field(walls, field.columns, field.rows, race_class.flow_target,
+                                                *race_class.ai_clearance), repeat=10)
+    cached, _ = measure(lambda: load_flow_field.__wrapped__(path, race_class.wall_layers,
+                                                            race_class.flow_target,
+                                                            *race_class.ai_clearance), repeat=10)
+    rng = random.Random(seed)
+    probes = [(rng.uniform(0, SCREEN_WIDTH), rng.uniform(0, SCREEN_HEIGHT)) for _ in range(10000)]
+    lookup, _ = measure(lambda: [field.direction(x, y) for x, y in probes], repeat=20)
+    print(f"Поле {field.columns}x{field.rows}: построение {build:.1f} мс, из кэша {cached:.1f} мс, "
+          f"запрос {lookup * 1000 / len(probes):.3f} мкс")
+
+    for label, flow_field in (("без поля", None), ("с полем", field)):
+        ticks = []
+        ai_times = []
+        unfinished = 0
+        for race_seed in range(seed, seed + races):
+            race = race_class.from_map(path, seed=race_seed, driver=default_driver(2), countdown=False)
+            race.flow_field = flow_field
+            ticks.append(race.run()['ticks'])
+            for car in race.ai_cars:
+                if car in race.finish_times:
+                    ai_times.append(race.finish_times[car])
+                else:
+                    unfinished += 1
+        print(f"ИИ {label}: медиана заезда {statistics.median(ticks)} шагов, "
+              f"медиана финиша ИИ {statistics.median(ai_times):.2f} сек, "
+              f"худший {max(ai_times):.2f} сек, не доехали {unfinished}")
+
+
+def bench_ai(counts, intervals, budget, seed, steps=120):
+    # Стоимость решений ИИ на кадр при разной частоте решений и с бюджетом
+    for cars in counts:
+        for interval, budget_ms in [(interval, None) for interval in intervals] + [(1, budget)]:
+            race = crowded_race(2, cars, seed)
+            race.ai_scheduler = AIScheduler(interval, budget_ms, measure=True)
+            race.driver = default_driver(2)
+            for _ in range(steps):
+                race.step()
+            stats = race.ai_scheduler.stats()
+            label = f"раз в {interval}" if budget_ms is None else f"бюджет {budget_ms} мс"
+            print(f"Машин {cars:4d}, решения {label:>13}: {stats['mean_ms']:6.3f} мс/кадр в среднем, "
+                  f"пик {stats['peak_ms']:6.3f} мс, решений {stats['decisions'] / stats['frames']:6.1f}/кадр, "
+                  f"кадров сверх бюджета {stats['over_budget']}")
+
+
+def bench_stress(level, limit, steps=120):
+    # Безголовая часть стресс-теста example.py --stress: наибольшая толпа ИИ,
+    # при которой шаг модели укладывается в кадр 60 FPS (без отрисовки)
+    race_class = RACE_LEVELS[level]
+    ramp = StressRamp(limit=limit)
+    while not ramp.done:
+        race = race_class.from_map(seed=1, roster=race_class.crowd_roster(ramp.count),
+                                   driver=default_driver(level), countdown=False)
+        start = time.perf_counter()
+        for _ in range(steps):
+            race.step()
+        step_ms = (time.perf_counter() - start) / steps * 1000
+        print(f"Машин ИИ {ramp.count:5d}: шаг {step_ms:7.2f} мс")
+        ramp.record(step_ms <= FIXED_DT * 1000)
+    print(f"Уровень {level}: шаг укладывается в {FIXED_DT * 1000:.1f} мс до {ramp.best or 0} машин ИИ")
+
+
+def tile_layers(columns, rows, layers, seed):
+    # Слои тайлов размером с карту: нижний сплошной, остальные заняты на
+    # треть, несколько текстур на слой, как у тайлсета
+    rng = random.Random(seed)
+    textures = [arcade.Texture(PIL.Image.new("RGBA", (64, 64), (rng.randrange(256), rng.randrange(256),
+                                                               rng.randrange(256), 255)))
+                for _ in range(8)]
+    sprite_lists = []
+    for layer in range(layers):
+        sprite_list = arcade.SpriteList()
+        for column in range(columns):
+            for row in range(rows):
+                if layer == 0 or rng.random() < 0.3:
+                    sprite_list.append(arcade.Sprite(rng.choice(textures), 0.5, (column + 0.5) * DEFAULT_TILE_SIZE,
+                                                     (row + 0.5) * DEFAULT_TILE_SIZE))
+        sprite_lists.append(sprite_list)
+    return sprite_lists
+
+
+def bench_background(frames, layers, seed):
+    # Время кадра фона: все статичные слои каждый кадр против одной текстуры
+    # LayerCache. ctx.finish() ждёт видеокарту, иначе замер покажет только
+    # постановку команд в очередь. Нужен дисплей: окно создаётся скрытым
+    window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, "benchmarks", visible=False)
+    sprite_lists = tile_layers(int(SCREEN_WIDTH // DEFAULT_TILE_SIZE), int(SCREEN_HEIGHT // DEFAULT_TILE_SIZE),
+                               layers, seed)
+    start = time.perf_counter()
+    cache = LayerCache(*sprite_lists)
+    window.ctx.finish()
+    bake = (time.perf_counter() - start) * 1000
+
+    def layers_frame():
+        window.clear()
+        for sprite_list in sprite_lists:
+            sprite_list.draw()
+        window.ctx.finish()
+
+    def cached_frame():
+        window.clear()
+        cache.draw()
+        window.ctx.finish()
+
+    direct, direct_max = measure(layers_frame, repeat=frames)
+    cached, cached_max = measure(cached_frame, repeat=frames)
+    tiles = sum(len(sprite_list) for sprite_list in sprite_lists)
+    print(f"Слоёв {layers}, тайлов {tiles}: запекание {bake:.1f} мс один раз")
+    print(f"Кадр по слоям: {direct:6.3f} мс (худший {direct_max:6.3f}), "
+          f"из кэша: {cached:6.3f} мс (худший {cached_max:6.3f}), x{direct / cached:.1f}")
+    window.close()
+
+
+def draw_text_hud(race, player_data):
+    # Прежний HUD первого уровня: arcade.draw_text на каждую надпись в каждом кадре
+    arcade.draw_text(f"Игрок: {player_data['username']}", 10, SCREEN_HEIGHT - 30, arcade.color.WHITE, 16)
+    arcade.draw_text(f"Уровень: {player_data['current_level']}", 10, SCREEN_HEIGHT - 60, arcade.color.WHITE, 16)
+    arcade.draw_text(f"Время: {race.game_time - race.race_start_time:.1f} сек",
+                     SCREEN_WIDTH - 150, SCREEN_HEIGHT - 30, arcade.color.YELLOW, 16)
+    arcade.draw_text(f"Место: {race.player.place}/{len(race.cars)}",
+                     SCREEN_WIDTH - 150, SCREEN_HEIGHT - 60, arcade.color.YELLOW, 16)
+    arcade.draw_text("Цель: первым пересечь линию финиша!", SCREEN_WIDTH // 2, SCREEN_HEIGHT - 30,
+                     arcade.color.YELLOW, 22, anchor_x="center")
+    arcade.draw_text(f"Финишировало: {len(race.finish_order)}/{len(race.cars)}", SCREEN_WIDTH // 2,
+                     SCREEN_HEIGHT - 60, arcade.color.CYAN, 18, anchor_x="center")
+    arcade.draw_text(f"Лидирует: {race.standings[0].color_name}", SCREEN_WIDTH // 2, SCREEN_HEIGHT - 90,
+                     arcade.color.RED, 18, anchor_x="center")
+
+
+def bench_hud(frames):
+    # Время CPU на HUD за кадр во время заезда: надписи draw_text против
+    # постоянных arcade.Text в пачке RaceHud. Нужен дисплей: окно скрытое
+    window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, "benchmarks", visible=False)
+    race = LevelOneRace(seed=1, countdown=False, driver=default_driver(1), live_standings=True)
+    player_data = {'username': "benchmark", 'current_level': 1}
+    hud = RaceHud("Цель: первым пересечь линию финиша!")
+
+    def frame(draw):
+        # Шаг модели между кадрами, чтобы время на табло менялось как в игре
+        race.step()
+        window.clear()
+        start = time.perf_counter()
+        draw()
+        elapsed = time.perf_counter() - start
+        window.ctx.finish()
+        return elapsed
+
+    def hud_frame():
+        hud.update(race, player_data, True)
+        hud.draw()
+
+    results = {}
+    for label, draw in (("draw_text", lambda: draw_text_hud(race, player_data)), ("RaceHud", hud_frame)):
+        timings = [frame(draw) * 1000 for _ in range(frames)]
+        results[label] = statistics.median(timings)
+        print(f"HUD {label:>9}: {results[label]:6.3f} мс CPU на кадр (худший {max(timings):6.3f})")
+    print(f"Быстрее в {results['draw_text'] / results['RaceHud']:.1f} раза")
+    window.close()
+
+
+def bench_assets(level, restarts):
+    # Перезапуски уровня (R, повтор с экрана итогов): загрузка ресурсов с
+    # диска каждый раз против общего реестра. Файлы манифеста, которые не
+    # грузятся (нет файла или тайлсета карты), пропускаются
+    registry = AssetRegistry()
+    loaders = registry.loaders
+    manifest = []
+    for kind, path, options in level_manifest(level):
+        try:
+            loaders[kind][0](path, **options)
+        except OSError as e:
+            print(f"Пропуск {path}: {e}")
+            continue
+        manifest.append((kind, path, options))
+    if not manifest:
+        print(f"Ни один ресурс уровня {level} не загружается")
+        return
+
+    def from_disk():
+        for kind, path, options in manifest:
+            loaders[kind][0](path, **options)
+
+    def from_registry():
+        lease = registry.lease()
+        for kind, path, options in manifest:
+            lease.acquire(kind, path, **options)
+        lease.release()
+
+    disk, _ = measure(from_disk, repeat=restarts)
+    start = time.perf_counter()
+    from_registry()
+    first = (time.perf_counter() - start) * 1000
+    shared, _ = measure(from_registry, repeat=restarts)
+    stats = registry.stats()
+    print(f"Уровень {level}, ресурсов {len(manifest)}: с диска {disk:.1f} мс на запуск, "
+          f"из реестра: первый {first:.1f} мс, затем {shared:.3f} мс")
+    print(f"Реестр: {stats['bytes'] / 2 ** 20:.1f} МБ из {stats['budget'] / 2 ** 20:.0f}, "
+          f"попаданий {stats['hit_rate']:.1%}, загрузка {stats['load_time'] * 1000:.1f} мс, "
+          f"выгружено {stats['evictions']}")
+
+
+def music_track(directory, seconds):
+    # Трек игры, если он есть и pyglet умеет его декодировать, иначе тишина
+    # в WAV той же длительности, что и у MP3 (стерео, 44.1 кГц, 16 бит)
+    try:
+        pyglet.media.load(MUSIC_FILE, streaming=True).delete()
+        return MUSIC_FILE
+    except (OSError, MediaException) as e:
+        print(f"{MUSIC_FILE} не открывается ({e}), вместо него тишина {seconds} сек в WAV")
+    path = os.path.join(directory, "track.wav")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(bytes(44100 * 4 * seconds))
+    return path
+
+
+def bench_music(restarts, pause, seconds):
+    # Сессия из restarts перезапусков уровня с паузой между ними: раньше
+    # каждый GameView грузил трек целиком и запускал ещё один плеер, теперь
+    # играет один потоковый плеер сервиса. Память — по tracemalloc, CPU —
+    # время процесса, включая поток звукового драйвера
+    window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, "music", visible=False)
+
+    def session(restart):
+        tracemalloc.start()
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        for _ in range(restarts):
+            restart()
+            until = time.perf_counter() + pause
+            while time.perf_counter() < until:
+                pyglet.clock.tick()
+                time.sleep(0.005)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return time.process_time() - start_cpu, time.perf_counter() - start, current, peak
+
+    with tempfile.TemporaryDirectory() as tmp:
+        track = music_track(tmp, seconds)
+        players = []
+        service = MusicService(MUSIC_VOLUME, fade=pause / 2)
+        for label, restart in (
+            ("load_sound на вид", lambda: players.append(arcade.load_sound(track).play(volume=MUSIC_VOLUME))),
+            ("MusicService", lambda: service.play(track)),
+        ):
+            cpu, elapsed, current, peak = session(restart)
+            alive = len(players) if players else service.stats()['players']
+            print(f"{label:>18}: CPU {cpu * 1000:7.1f} мс за {elapsed:.1f} сек, "
+                  f"память {current / 2 ** 20:6.1f} МБ (пик {peak / 2 ** 20:6.1f}), плееров {alive}")
+            for player in players:
+                player.delete()
+            players.clear()
+        print(f"Загрузок трека сервисом: {service.stats()['loads']}")
+        service.stop()
+        service.finish_fade()
+    window.close()
+
+
+def bench_tilemap(maps, repeat):
+    # Вход в уровень и перезапуск: arcade.load_tilemap (XML, CSV, тайлсеты)
+    # против кэша из tilemap_cache. Карты без тайлсетов пропускаются
+    window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, "tilemap", visible=False)
+    for path in maps:
+        try:
+            start = time.perf_counter()
+            compile_tilemap(path)
+            compile_ms = (time.perf_counter() - start) * 1000
+        except (OSError, ValueError) as e:
+            print(f"Пропуск {path}: {e}")
+            continue
+        parsed, _ = measure(lambda: arcade.load_tilemap(path, scaling=TILE_SCALING), repeat=repeat)
+        cached, _ = measure(lambda: load_tilemap(path), repeat=repeat)
+        tile_map = load_tilemap(path)
+        sprites = sum(len(sprite_list) for sprite_list in tile_map.sprite_lists.values())
+        print(f"{path}: слоёв {len(tile_map.sprite_lists)}, тайлов {sprites}, "
+              f"кэш {os.path.getsize(cache_path(path, TILE_SCALING)) / 1024:.0f} КБ "
+              f"(компиляция {compile_ms:.1f} мс)")
+        print(f"    arcade.load_tilemap {parsed:6.1f} мс, из кэша {cached:6.1f} мс, "
+              f"быстрее в {parsed / cached:.1f} раза")
+    window.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности игры")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    leaderboard = subparsers.add_parser("leaderboard", help="таблица лидеров на синтетических данных")
+    leaderboard.add_argument("--rows", type=int, default=1000000)
+    leaderboard.add_argument("--players", type=int, default=50000)
+
+    progress = subparsers.add_parser("progress", help="обновление уровня до и после миграций")
+    progress.add_argument("--players", type=int, default=200000)
+    progress.add_argument("--duplicates", type=int, default=20000)
+    progress.add_argument("--updates", type=int, default=200)
+
+    subparsers.add_parser("startup", help="проверка отсутствия обращений к диску при импорте")
+
+    simulation = subparsers.add_parser("simulation", help="безголовые заезды без окна")
+    simulation.add_argument("--races", type=int, default=20)
+    simulation.add_argument("--seed", type=int, default=1)
+
+    montecarlo = subparsers.add_parser("montecarlo", help="пакетная модель заездов на numpy")
+    montecarlo.add_argument("--races", type=int, default=20000)
+    montecarlo.add_argument("--seed", type=int, default=1)
+    montecarlo.add_argument("--speeds", type=float, nargs="+", default=[2.0, 2.5, 3.0, 3.5, 4.0])
+
+    farm = subparsers.add_parser("farm", help="масштабирование фермы заездов по ядрам")
+    farm.add_argument("--level", type=int, default=1)
+    farm.add_argument("--races", type=int, default=4000)
+
+    collisions = subparsers.add_parser("collisions", help="столкновения машин: перебор и сетка")
+    collisions.add_argument("--cars", type=int, nargs="+", default=[3, 8, 16, 50, 100, 200, 500])
+    collisions.add_argument("--seed", type=int, default=1)
+
+    walls = subparsers.add_parser("walls", help="проверка стен: перебор тайлов и сетка занятости")
+    walls.add_argument("--density", type=float, default=0.1)
+    walls.add_argument("--seed", type=int, default=1)
+
+    standings = subparsers.add_parser("standings", help="прогресс по воротам и живая таблица мест")
+    standings.add_argument("--cars", type=int, nargs="+", default=[3, 50, 500])
+    standings.add_argument("--seed", type=int, default=1)
+
+    flowfield = subparsers.add_parser("flowfield", help="поле направлений ИИ второго уровня")
+    flowfield.add_argument("--races", type=int, default=40)
+    flowfield.add_argument("--seed", type=int, default=0)
+
+    ai = subparsers.add_parser("ai", help="планировщик решений ИИ: частота и бюджет на кадр")
+    ai.add_argument("--cars", type=int, nargs="+", default=[3, 100, 1000])
+    ai.add_argument("--intervals", type=int, nargs="+", default=[1, 2, 4, 8])
+    ai.add_argument("--budget", type=float, default=0.5)
+    ai.add_argument("--seed", type=int, default=1)
+
+    stress = subparsers.add_parser("stress", help="наибольшая толпа ИИ, при которой шаг модели держит 60 FPS")
+    stress.add_argument("--level", type=int, default=2)
+    stress.add_argument("--limit", type=int, default=1000)
+
+    background = subparsers.add_parser("background", help="фон уровня: слои тайлов и запечённая текстура")
+    background.add_argument("--frames", type=int, default=300)
+    background.add_argument("--layers", type=int, default=5)
+    background.add_argument("--seed", type=int, default=1)
+
+    hud = subparsers.add_parser("hud", help="надписи HUD: draw_text и постоянные arcade.Text")
+    hud.add_argument("--frames", type=int, default=600)
+
+    assets = subparsers.add_parser("assets", help="перезапуски уровня: ресурсы с диска и из реестра")
+    assets.add_argument("--level", type=int, default=2)
+    assets.add_argument("--restarts", type=int, default=20)
+
+    music = subparsers.add_parser("music", help="музыка за сессию перезапусков: память и CPU")
+    music.add_argument("--restarts", type=int, default=30)
+    music.add_argument("--pause", type=float, default=0.5)
+    music.add_argument("--seconds", type=int, default=180)
+
+    tilemap = subparsers.add_parser("tilemap", help="загрузка карт: разбор TMX и скомпилированный кэш")
+    tilemap.add_argument("--maps", nargs="+", default=["carr2.tmx", "does.tmx"])
+    tilemap.add_argument("--repeat", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.benchmark == "leaderboard":
+        bench_leaderboard(args.rows, args.players)
+    elif args.benchmark == "progress":
+        bench_progress(args.players, args.duplicates, args.updates)
+    elif args.benchmark == "startup":
+        raise SystemExit(bench_startup())
+    elif args.benchmark == "simulation":
+        bench_simulation(args.races, args.seed)
+    elif args.benchmark == "montecarlo":
+        bench_montecarlo(args.races, args.seed, args.speeds)
+    elif args.benchmark == "farm":
+        bench_farm(args.level, args.races)
+    elif args.benchmark == "collisions":
+        bench_collisions(args.cars, args.seed)
+    elif args.benchmark == "walls":
+        bench_walls([(30, 25), (120, 100), (480, 400)], args.density, args.seed)
+    elif args.benchmark == "standings":
+        bench_standings(args.cars, args.seed)
+    elif args.benchmark == "flowfield":
+        bench_flowfield(args.races, args.seed)
+    elif args.benchmark == "ai":
+        bench_ai(args.cars, args.intervals, args.budget, args.seed)
+    elif args.benchmark == "stress":
+        bench_stress(args.level, args.limit)
+    elif args.benchmark == "background":
+        bench_background(args.frames, args.layers, args.seed)
+    elif args.benchmark == "hud":
+        bench_hud(args.frames)
+    elif args.benchmark == "assets":
+        bench_assets(args.level, args.restarts)
+    elif args.benchmark == "music":
+        bench_music(args.restarts, args.pause, args.seconds)
+    elif args.benchmark == "tilemap":
+        bench_tilemap(args.maps, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
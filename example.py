@@ -1,146 +1,910 @@
 import arcade
-import random
-import math
+import PIL.Image
+import pyglet
 from arcade.gui import UIManager, UIFlatButton, UILabel, UIInputText
 from arcade.gui.widgets.layout import UIAnchorLayout, UIBoxLayout
 import sqlite3
+import threading
+import queue
+import atexit
+import hashlib
+import hmac
+import os
+import csv
+import json
+import time
+import itertools
+import argparse
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from assets import CAR_ATLAS_MANIFEST, AssetRegistry
+from music import MusicService
+from track import TILE_SCALING, OccupancyGrid, load_checkpoints
+from race_farm import FARM_CHUNK_SIZE, FARM_SETTINGS, parse_grid, run_farm
+from simulation import (SCREEN_WIDTH, SCREEN_HEIGHT, CAR_SPEED_LEVEL_1, CAR_SPEED_LEVEL_2,
+                        AI_DECISION_BUDGET_MS, RACE_LEVELS, AIScheduler, LevelOneRace, LevelTwoRace,
+                        StressRamp, default_driver)
 
-SCREEN_WIDTH = 960
-SCREEN_HEIGHT = 800
 SCREEN_TITLE = "Гонки - Многоуровневая игра"
 BUTTON_SIZE = {"width": 200, "height": 50}
-TILE_SCALING = 0.5
-CAR_SPEED_LEVEL_1 = 5
-CAR_SPEED_LEVEL_2 = 7
-AI_CAR_SPEED_MIN = 2.0
-AI_CAR_SPEED_MAX = 4.0
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_DELAY = 0.05
+PASSWORD_SCRYPT_N = 2 ** 14
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_SALT_SIZE = 16
+AUTH_WORKERS = 2
+PROFILE_CACHE_SIZE = 256
+PROFILE_CACHE_TTL = 300
+BULK_CHUNK_SIZE = 5000
+BULK_FIELDS = ("username", "password", "created_at", "current_level")
+MUSIC_FILE = 'Aphex_Twin_-_Ptolemy_80592407.mp3'
+MUSIC_VOLUME = 0.07
+# Трек каждого уровня; при смене трека музыка сменяется плавно
+LEVEL_MUSIC = {1: MUSIC_FILE, 2: MUSIC_FILE}
+# Задержка перед загрузкой следующего уровня с экрана итогов, сек
+PRELOAD_DELAY = 0.3
+STRESS_TARGET_FPS = 60
+# Допуск на дрожание таймера: 57 кадров/с ещё считаются за 60
+STRESS_FPS_TOLERANCE = 0.95
+STRESS_WARMUP_TIME = 0.5
+STRESS_MEASURE_TIME = 2.0
+
+
+def hash_password(password, n=PASSWORD_SCRYPT_N, r=PASSWORD_SCRYPT_R, p=PASSWORD_SCRYPT_P):
+    salt = os.urandom(PASSWORD_SALT_SIZE)
+    digest = hashlib.scrypt(
+        password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+        maxmem=256 * n * r + 1024 * 1024
+    )
+    return f"scrypt${n}${r}${p}${salt.hex()}${digest.hex()}"
+
+
+def is_password_hash(stored):
+    parts = stored.split("$")
+    return len(parts) == 6 and parts[0] == "scrypt"
+
+
+def verify_password(password, stored, n=PASSWORD_SCRYPT_N, r=PASSWORD_SCRYPT_R, p=PASSWORD_SCRYPT_P):
+    # Возвращает (пароль верный, нужно ли перехешировать запись)
+    if not is_password_hash(stored):
+        # Запись из старой версии игры с паролем в открытом виде
+        valid = hmac.compare_digest(password.encode("utf-8"), stored.encode("utf-8"))
+        return valid, valid
+    parts = stored.split("$")
+    stored_n, stored_r, stored_p = int(parts[1]), int(parts[2]), int(parts[3])
+    digest = hashlib.scrypt(
+        password.encode("utf-8"), salt=bytes.fromhex(parts[4]),
+        n=stored_n, r=stored_r, p=stored_p,
+        maxmem=256 * stored_n * stored_r + 1024 * 1024
+    )
+    valid = hmac.compare_digest(digest, bytes.fromhex(parts[5]))
+    return valid, valid and (stored_n, stored_r, stored_p) != (n, r, p)
+
+
+class ProfileCache:
+    # LRU-кэш профилей игроков с временем жизни записи. Общий для главного
+    # потока и потоков AuthService
+
+    def __init__(self, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._profiles = OrderedDict()
+        self._ids_by_username = {}
+        self._lock = threading.Lock()
+
+    def get(self, player_id):
+        with self._lock:
+            entry = self._profiles.get(player_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, profile = entry
+            if expires_at < time.monotonic():
+                self._remove(player_id)
+                self.misses += 1
+                return None
+            self._profiles.move_to_end(player_id)
+            self.hits += 1
+            return dict(profile)
+
+    def get_by_username(self, username):
+        with self._lock:
+            player_id = self._ids_by_username.get(username)
+        if player_id is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return self.get(player_id)
+
+    def put(self, profile):
+        with self._lock:
+            self._remove(profile['id'])
+            self._profiles[profile['id']] = (time.monotonic() + self.ttl, dict(profile))
+            self._ids_by_username[profile['username']] = profile['id']
+            while len(self._profiles) > self.maxsize:
+                player_id = next(iter(self._profiles))
+                self._remove(player_id)
+                self.evictions += 1
+
+    def update(self, player_id, **fields):
+        # Поддерживает кэш согласованным с записями в БД
+        with self._lock:
+            entry = self._profiles.get(player_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+    def invalidate(self, player_id=None):
+        with self._lock:
+            if player_id is None:
+                self._profiles.clear()
+                self._ids_by_username.clear()
+            else:
+                self._remove(player_id)
+
+    def _remove(self, player_id):
+        entry = self._profiles.pop(player_id, None)
+        if entry is not None:
+            self._ids_by_username.pop(entry[1]['username'], None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._profiles),
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+SCHEMA_MIGRATIONS = [
+    # 1: исходная схема
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS players (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS player_progress (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            current_level INTEGER DEFAULT 1,
+            FOREIGN KEY (player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+        ''',
+    ],
+    # 2: результаты заездов и лучшие результаты для таблицы лидеров.
+    # race_best поддерживается при каждой записи в race_results, чтобы таблица
+    # лидеров и место игрока не сканировали всю историю заездов
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS race_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            player_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            race_time REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (player_id) REFERENCES players(id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_race_results_player
+        ON race_results (player_id, level, race_time)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS race_best (
+            player_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            best_time REAL NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (player_id, level)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_race_best_leaderboard
+        ON race_best (level, best_time, player_id)
+        ''',
+    ],
+    # 3: одна строка прогресса на игрока. Из дубликатов остаётся строка
+    # с наибольшим уровнем
+    [
+        '''
+        DELETE FROM player_progress WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY player_id ORDER BY current_level DESC, id DESC
+                ) AS row_number
+                FROM player_progress
+            ) WHERE row_number > 1
+        )
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_player_progress_player
+        ON player_progress (player_id)
+        ''',
+    ],
+    # 4: отметки для продолжения прерванного импорта
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS import_state (
+            source TEXT PRIMARY KEY,
+            file_size INTEGER NOT NULL,
+            rows_done INTEGER NOT NULL
+        )
+        ''',
+    ],
+]
+
+
+def validate_credentials(username, password):
+    if not username or not password:
+        return "Логин и пароль не могут быть пустыми"
+
+    if len(username) < 3:
+        return "Логин должен быть не менее 3 символов"
+
+    if len(password) < 4:
+        return "Пароль должен быть не менее 4 символов"
+    return None
+
+
+def read_player_records(path):
+    # Построчное чтение CSV/JSONL без загрузки всего файла в память
+    with open(path, encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            for record in csv.DictReader(file):
+                yield record
+        else:
+            for line in file:
+                if line.strip():
+                    # Битая строка отдаётся как None: она считается
+                    # некорректной, а номер строки для продолжения не сбивается
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield None
 
 
 class GameDatabase:
 
-    def __init__(self, db_name="game_database12345.db"):
+    def __init__(self, db_name="game_database12345.db", write_behind=False, lazy=False):
         self.db_name = db_name
         self.conn = None
         self.cursor = None
-        self.connect_database()
+        self.write_behind = write_behind
+        self._write_queue = None
+        self._writer_thread = None
+        # Уровни, которые уже подтверждены игре, но ещё не записаны на диск
+        self._pending_levels = {}
+        self._pending_lock = threading.Lock()
+        # Соединение используется и из потоков AuthService
+        self._lock = threading.RLock()
+        self.profile_cache = ProfileCache()
+        self._warm_up_thread = None
+        self._close_registered = False
+        # В ленивом режиме файл БД открывается при первом обращении (или в
+        # warm_up), а поток записи — при первой отложенной записи
+        if not lazy:
+            self.connect_database()
 
     def connect_database(self):
+        with self._lock:
+            if self.conn:
+                return True
+            return self._connect_database()
+
+    def warm_up(self):
+        # Открывает БД и применяет миграции в фоне, пока показывается меню
+        if self.conn or self._warm_up_thread:
+            return
+        self._warm_up_thread = threading.Thread(
+            target=self.connect_database, name="GameDatabaseWarmUp", daemon=True
+        )
+        self._warm_up_thread.start()
+
+    def _connect_database(self):
         try:
-            self.conn = sqlite3.connect(self.db_name)
+            self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
             self.cursor = self.conn.cursor()
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS players (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS player_progress (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    player_id INTEGER NOT NULL,
-                    current_level INTEGER DEFAULT 1,
-                    FOREIGN KEY (player_id) REFERENCES players(id) ON DELETE CASCADE
-                )
-            ''')
-            self.conn.commit()
+            self.cursor.execute("PRAGMA journal_mode=WAL")
+            self.migrate()
             return True
         except Exception as e:
             print(f"Ошибка подключения к БД: {e}")
             return False
 
-    def register_player(self, username, password):
+    def migrate(self):
+        # Номер применённой миграции хранится в PRAGMA user_version; каждая
+        # миграция выполняется в своей транзакции вместе со сменой версии
+        self.cursor.execute("PRAGMA user_version")
+        version = self.cursor.fetchone()[0]
+        for target_version, statements in enumerate(SCHEMA_MIGRATIONS[version:], version + 1):
+            try:
+                self.cursor.execute("BEGIN")
+                for statement in statements:
+                    self.cursor.execute(statement)
+                self.cursor.execute(f"PRAGMA user_version = {target_version}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return max(len(SCHEMA_MIGRATIONS) - version, 0)
+
+    def register_player(self, username, password, hash_params=None):
         try:
             if not self.conn:
                 if not self.connect_database():
                     return False, "Ошибка подключения к базе данных"
-            if not username or not password:
-                return False, "Логин и пароль не могут быть пустыми"
-
-            if len(username) < 3:
-                return False, "Логин должен быть не менее 3 символов"
-
-            if len(password) < 4:
-                return False, "Пароль должен быть не менее 4 символов"
-            self.cursor.execute("SELECT id FROM players WHERE username = ?", (username,))
-            existing_player = self.cursor.fetchone()
+            error = validate_credentials(username, password)
+            if error:
+                return False, error
+            with self._lock:
+                self.cursor.execute("SELECT id FROM players WHERE username = ?", (username,))
+                existing_player = self.cursor.fetchone()
 
             if existing_player:
                 return False, "Игрок с таким логином уже существует"
-            self.cursor.execute(
-                "INSERT INTO players (username, password) VALUES (?, ?)",
-                (username, password)
-            )
-            player_id = self.cursor.lastrowid
-            self.cursor.execute(
-                "INSERT INTO player_progress (player_id, current_level) VALUES (?, ?)",
-                (player_id, 1)
-            )
-            self.conn.commit()
+            # Хеширование намеренно дорогое, поэтому выполняется без блокировки БД
+            password_hash = hash_password(password, **(hash_params or {}))
+            with self._lock:
+                self.cursor.execute(
+                    "INSERT INTO players (username, password) VALUES (?, ?)",
+                    (username, password_hash)
+                )
+                player_id = self.cursor.lastrowid
+                self.cursor.execute(
+                    "INSERT INTO player_progress (player_id, current_level) VALUES (?, ?)",
+                    (player_id, 1)
+                )
+                self.conn.commit()
             return True, "Регистрация успешна! Ваш текущий уровень: 1"
         except sqlite3.IntegrityError:
             return False, "Игрок с таким логином уже существует"
         except Exception as e:
             return False, f"Ошибка регистрации: {str(e)}"
 
-    def login_player(self, username, password):
+    def _load_profile(self, where, value):
+        with self._lock:
+            self.cursor.execute(f'''
+                SELECT p.id, p.username, p.password, pp.current_level
+                FROM players AS p LEFT JOIN player_progress AS pp ON pp.player_id = p.id
+                WHERE p.{where} = ?
+            ''', (value,))
+            row = self.cursor.fetchone()
+        if not row:
+            return None
+        profile = {
+            'id': row[0],
+            'username': row[1],
+            'password': row[2],
+            'current_level': row[3] if row[3] is not None else 1
+        }
+        pending_level = self._pending_level(row[0])
+        if pending_level is not None:
+            profile['current_level'] = pending_level
+        self.profile_cache.put(profile)
+        return profile
+
+    def login_player(self, username, password, hash_params=None):
         try:
             if not self.conn:
                 if not self.connect_database():
                     return False, "Ошибка подключения к базе данных"
 
-            self.cursor.execute(
-                "SELECT id, username FROM players WHERE username = ? AND password = ?",
-                (username, password)
-            )
-            player = self.cursor.fetchone()
-            if player:
-                self.cursor.execute(
-                    "SELECT current_level FROM player_progress WHERE player_id = ?",
-                    (player[0],)
-                )
-                progress = self.cursor.fetchone()
-                current_level = progress[0] if progress else 1
-                return True, {
-                    'id': player[0],
-                    'username': player[1],
-                    'current_level': current_level
-                }
-            else:
+            profile = self.profile_cache.get_by_username(username)
+            if profile is None:
+                profile = self._load_profile("username", username)
+            if not profile:
+                return False, "Неверный логин или пароль"
+            hash_params = hash_params or {}
+            valid, needs_rehash = verify_password(password, profile['password'], **hash_params)
+            if not valid:
                 return False, "Неверный логин или пароль"
+            if needs_rehash:
+                # Старые записи с открытым паролем (или устаревшими параметрами)
+                # прозрачно перехешируются при первом успешном входе
+                password_hash = hash_password(password, **hash_params)
+                with self._lock:
+                    self.cursor.execute(
+                        "UPDATE players SET password = ? WHERE id = ? AND password = ?",
+                        (password_hash, profile['id'], profile['password'])
+                    )
+                    self.conn.commit()
+                self.profile_cache.update(profile['id'], password=password_hash)
+            return True, {
+                'id': profile['id'],
+                'username': profile['username'],
+                'current_level': profile['current_level']
+            }
         except Exception as e:
             return False, f"Ошибка входа: {str(e)}"
 
+    def get_player_profile(self, player_id):
+        try:
+            if not self.conn:
+                if not self.connect_database():
+                    return False, "Ошибка подключения к базе данных"
+            profile = self.profile_cache.get(player_id)
+            if profile is None:
+                profile = self._load_profile("id", player_id)
+            if not profile:
+                return False, "Игрок не найден"
+            return True, {
+                'id': profile['id'],
+                'username': profile['username'],
+                'current_level': profile['current_level']
+            }
+        except Exception as e:
+            return False, f"Ошибка загрузки профиля: {str(e)}"
+
     def update_player_level(self, player_id, new_level):
+        if self.write_behind:
+            self.update_player_level_async(player_id, new_level)
+            return True, f"Уровень обновлен до {new_level}"
         try:
             if not self.conn:
                 if not self.connect_database():
                     return False, "Ошибка подключения к базе данных"
-            self.cursor.execute(
-                "UPDATE player_progress SET current_level = ? WHERE player_id = ?",
-                (new_level, player_id)
+            with self._lock:
+                self._write_player_level(self.cursor, player_id, new_level)
+                self.conn.commit()
+            self.profile_cache.update(player_id, current_level=new_level)
+            return True, f"Уровень обновлен до {new_level}"
+        except Exception as e:
+            return False, f"Ошибка обновления уровня: {str(e)}"
+
+    def update_player_level_async(self, player_id, new_level, callback=None):
+        # Возвращает Future, который завершается, когда запись попала на диск.
+        # callback вызывается из потока записи с результатом (success, message)
+        if not self.write_behind:
+            future = Future()
+            future.set_result(self.update_player_level(player_id, new_level))
+        else:
+            # До записи профиль читается из БД с наложенным ожидающим уровнем
+            # (_load_profile), а кэш получает уровень только после коммита
+            with self._pending_lock:
+                self._pending_levels[player_id] = new_level
+            self.profile_cache.invalidate(player_id)
+            future = self._enqueue_write(
+                self._write_player_level, (player_id, new_level),
+                f"Уровень обновлен до {new_level}"
             )
-            if self.cursor.rowcount == 0:
+            future.add_done_callback(
+                lambda f: self._level_written(player_id, new_level, *f.result())
+            )
+        if callback:
+            future.add_done_callback(lambda f: callback(*f.result()))
+        return future
+
+    def _write_player_level(self, cursor, player_id, new_level):
+        cursor.execute('''
+            INSERT INTO player_progress (player_id, current_level) VALUES (?, ?)
+            ON CONFLICT (player_id) DO UPDATE SET current_level = excluded.current_level
+        ''', (player_id, new_level))
+
+    def record_race_result(self, player_id, level, position, race_time, callback=None):
+        message = f"Результат заезда сохранен: уровень {level}, место {position}"
+        if self.write_behind:
+            future = self._enqueue_write(
+                self._write_race_result, (player_id, level, position, race_time), message
+            )
+            if callback:
+                future.add_done_callback(lambda f: callback(*f.result()))
+            return True, message
+        try:
+            if not self.conn:
+                if not self.connect_database():
+                    return False, "Ошибка подключения к базе данных"
+            with self._lock:
+                self._write_race_result(self.cursor, player_id, level, position, race_time)
+                self.conn.commit()
+            result = True, message
+        except Exception as e:
+            result = False, f"Ошибка сохранения результата: {str(e)}"
+        if callback:
+            callback(*result)
+        return result
+
+    def _write_race_result(self, cursor, player_id, level, position, race_time):
+        cursor.execute(
+            "INSERT INTO race_results (player_id, level, position, race_time) VALUES (?, ?, ?, ?)",
+            (player_id, level, position, race_time)
+        )
+        cursor.execute('''
+            INSERT INTO race_best (player_id, level, best_time, position) VALUES (?, ?, ?, ?)
+            ON CONFLICT (player_id, level) DO UPDATE
+            SET best_time = excluded.best_time, position = excluded.position
+            WHERE excluded.best_time < race_best.best_time
+        ''', (player_id, level, race_time, position))
+
+    def get_leaderboard(self, level, limit=10, after=None):
+        # Постраничная выдача по ключу: after — курсор (best_time, player_id)
+        # последней строки предыдущей страницы, а не OFFSET
+        try:
+            if not self.conn:
+                if not self.connect_database():
+                    return False, "Ошибка подключения к базе данных"
+            if after is None:
+                query = '''
+                    SELECT b.player_id, p.username, b.best_time, b.position
+                    FROM race_best AS b JOIN players AS p ON p.id = b.player_id
+                    WHERE b.level = ?
+                    ORDER BY b.best_time, b.player_id
+                    LIMIT ?
+                '''
+                params = (level, limit)
+            else:
+                query = '''
+                    SELECT b.player_id, p.username, b.best_time, b.position
+                    FROM race_best AS b JOIN players AS p ON p.id = b.player_id
+                    WHERE b.level = ? AND (b.best_time, b.player_id) > (?, ?)
+                    ORDER BY b.best_time, b.player_id
+                    LIMIT ?
+                '''
+                params = (level, after[0], after[1], limit)
+            with self._lock:
+                self.cursor.execute(query, params)
+                rows = self.cursor.fetchall()
+            leaders = [
+                {'player_id': row[0], 'username': row[1], 'best_time': row[2], 'position': row[3]}
+                for row in rows
+            ]
+            next_cursor = (rows[-1][2], rows[-1][0]) if len(rows) == limit else None
+            return True, (leaders, next_cursor)
+        except Exception as e:
+            return False, f"Ошибка загрузки таблицы лидеров: {str(e)}"
+
+    def get_personal_best(self, player_id, level):
+        try:
+            if not self.conn:
+                if not self.connect_database():
+                    return False, "Ошибка подключения к базе данных"
+            with self._lock:
                 self.cursor.execute(
-                    "INSERT INTO player_progress (player_id, current_level) VALUES (?, ?)",
-                    (player_id, new_level)
+                    "SELECT best_time FROM race_best WHERE player_id = ? AND level = ?",
+                    (player_id, level)
                 )
+                row = self.cursor.fetchone()
+            return True, row[0] if row else None
+        except Exception as e:
+            return False, f"Ошибка загрузки лучшего времени: {str(e)}"
 
-            self.conn.commit()
-            return True, f"Уровень обновлен до {new_level}"
+    def get_player_rank(self, player_id, level):
+        try:
+            if not self.conn:
+                if not self.connect_database():
+                    return False, "Ошибка подключения к базе данных"
+            with self._lock:
+                self.cursor.execute(
+                    "SELECT best_time FROM race_best WHERE player_id = ? AND level = ?",
+                    (player_id, level)
+                )
+                row = self.cursor.fetchone()
+                if not row:
+                    return True, None
+                self.cursor.execute('''
+                    SELECT COUNT(*) FROM race_best
+                    WHERE level = ? AND (best_time, player_id) < (?, ?)
+                ''', (level, row[0], player_id))
+                better = self.cursor.fetchone()[0]
+            return True, better + 1
         except Exception as e:
-            return False, f"Ошибка обновления уровня: {str(e)}"
+            return False, f"Ошибка загрузки места игрока: {str(e)}"
+
+    def export_players(self, path, chunk_size=BULK_CHUNK_SIZE, report=print):
+        try:
+            if not self.conn:
+                if not self.connect_database():
+                    return False, "Ошибка подключения к базе данных"
+            is_csv = path.lower().endswith(".csv")
+            exported = 0
+            start = time.perf_counter()
+            with self._lock, open(path, "w", encoding="utf-8", newline="") as file:
+                cursor = self.conn.cursor()
+                cursor.execute('''
+                    SELECT p.username, p.password, p.created_at,
+                           COALESCE(pp.current_level, 1)
+                    FROM players AS p LEFT JOIN player_progress AS pp ON pp.player_id = p.id
+                    ORDER BY p.id
+                ''')
+                if is_csv:
+                    writer = csv.writer(file)
+                    writer.writerow(BULK_FIELDS)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    if is_csv:
+                        writer.writerows(rows)
+                    else:
+                        file.writelines(
+                            json.dumps(dict(zip(BULK_FIELDS, row)), ensure_ascii=False) + "\n"
+                            for row in rows
+                        )
+                    exported += len(rows)
+                    if report:
+                        elapsed = time.perf_counter() - start
+                        report(f"Экспортировано {exported} игроков ({exported / elapsed:.0f} строк/сек)")
+            elapsed = time.perf_counter() - start
+            return True, {'exported': exported, 'rows_per_second': exported / elapsed if elapsed else 0}
+        except Exception as e:
+            return False, f"Ошибка экспорта: {str(e)}"
+
+    def import_players(self, path, chunk_size=BULK_CHUNK_SIZE, report=print, hash_params=None,
+                       workers=None):
+        # Каждая порция пишется одной транзакцией вместе с отметкой о
+        # количестве обработанных строк, поэтому после сбоя импорт того же
+        # файла продолжается с первой незаписанной порции. Хэши из выгрузки
+        # export_players пишутся как есть, открытые пароли хэшируются scrypt
+        # в пуле потоков (scrypt отпускает GIL) и только для новых игроков
+        hash_params = hash_params or {}
+        executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                      thread_name_prefix="ImportHash")
+        try:
+            if not self.conn:
+                if not self.connect_database():
+                    return False, "Ошибка подключения к базе данных"
+            source = os.path.abspath(path)
+            file_size = os.path.getsize(path)
+            with self._lock:
+                self.cursor.execute(
+                    "SELECT rows_done FROM import_state WHERE source = ? AND file_size = ?",
+                    (source, file_size)
+                )
+                state = self.cursor.fetchone()
+            rows_done = state[0] if state else 0
+            if rows_done and report:
+                report(f"Продолжаем импорт со строки {rows_done + 1}")
+
+            summary = {'imported': 0, 'skipped': 0, 'invalid': 0, 'resumed_from': rows_done}
+            start = time.perf_counter()
+            records = itertools.islice(read_player_records(path), rows_done, None)
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+                valid = []
+                seen = set()
+                for record in chunk:
+                    if not isinstance(record, dict):
+                        summary['invalid'] += 1
+                        continue
+                    username = str(record.get('username') or "").strip()
+                    password = str(record.get('password') or "")
+                    try:
+                        level = int(record.get('current_level') or 1)
+                    except (TypeError, ValueError):
+                        level = 0
+                    if validate_credentials(username, password) or level < 1:
+                        summary['invalid'] += 1
+                        continue
+                    if username in seen:
+                        # Повтор имени в той же порции: остаётся первая запись
+                        summary['skipped'] += 1
+                        continue
+                    seen.add(username)
+                    valid.append((username, password, record.get('created_at') or None, level))
+                rows_done += len(chunk)
+                candidates = len(valid)
+                valid = self._hash_new_players(valid, executor, hash_params)
+                with self._lock:
+                    cursor = self.conn.cursor()
+                    try:
+                        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM players")
+                        last_id = cursor.fetchone()[0]
+                        before = self.conn.total_changes
+                        cursor.executemany('''
+                            INSERT OR IGNORE INTO players (username, password, created_at)
+                            VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                        ''', ((row[0], row[1], row[2]) for row in valid))
+                        inserted = self.conn.total_changes - before
+                        # Прогресс добавляется только игрокам, созданным этой порцией
+                        cursor.executemany('''
+                            INSERT INTO player_progress (player_id, current_level)
+                            SELECT id, ? FROM players WHERE username = ? AND id > ?
+                            ON CONFLICT (player_id) DO NOTHING
+                        ''', ((row[3], row[0], last_id) for row in valid))
+                        cursor.execute('''
+                            INSERT OR REPLACE INTO import_state (source, file_size, rows_done)
+                            VALUES (?, ?, ?)
+                        ''', (source, file_size, rows_done))
+                        self.conn.commit()
+                    except Exception:
+                        self.conn.rollback()
+                        raise
+                summary['imported'] += inserted
+                summary['skipped'] += candidates - inserted
+                if report:
+                    elapsed = time.perf_counter() - start
+                    processed = rows_done - summary['resumed_from']
+                    report(f"Обработано {rows_done} строк ({processed / elapsed:.0f} строк/сек)")
+            with self._lock:
+                self.cursor.execute("DELETE FROM import_state WHERE source = ?", (source,))
+                self.conn.commit()
+            elapsed = time.perf_counter() - start
+            processed = rows_done - summary['resumed_from']
+            summary['rows_per_second'] = processed / elapsed if elapsed else 0
+            return True, summary
+        except Exception as e:
+            return False, f"Ошибка импорта: {str(e)}"
+        finally:
+            executor.shutdown(wait=True)
+
+    def _hash_new_players(self, rows, executor, hash_params, batch=900):
+        # Уже существующие игроки всё равно пропускаются INSERT OR IGNORE,
+        # поэтому scrypt тратится только на новые имена
+        existing = set()
+        with self._lock:
+            for offset in range(0, len(rows), batch):
+                names = [row[0] for row in rows[offset:offset + batch]]
+                self.cursor.execute(
+                    f"SELECT username FROM players WHERE username IN ({','.join('?' * len(names))})",
+                    names
+                )
+                existing.update(name for name, in self.cursor.fetchall())
+        rows = [row for row in rows if row[0] not in existing]
+        plain = [index for index, row in enumerate(rows) if not is_password_hash(row[1])]
+        hashed = executor.map(lambda index: hash_password(rows[index][1], **hash_params), plain)
+        for index, password in zip(plain, hashed):
+            rows[index] = (rows[index][0], password) + rows[index][2:]
+        return rows
+
+    def _level_written(self, player_id, new_level, success, message):
+        # Вызывается из потока записи: при ошибке в кэше не должно остаться
+        # уровня, которого нет в БД
+        if success:
+            self.profile_cache.update(player_id, current_level=new_level)
+        else:
+            self.profile_cache.invalidate(player_id)
+        with self._pending_lock:
+            if self._pending_levels.get(player_id) == new_level:
+                del self._pending_levels[player_id]
+
+    def _pending_level(self, player_id):
+        with self._pending_lock:
+            return self._pending_levels.get(player_id)
+
+    def start_writer(self):
+        with self._lock:
+            if self._writer_thread:
+                return
+            self._write_queue = queue.Queue()
+            self._writer_thread = threading.Thread(
+                target=self._writer_loop, name="GameDatabaseWriter", daemon=True
+            )
+            self._writer_thread.start()
+            if not self._close_registered:
+                atexit.register(self.close)
+                self._close_registered = True
+
+    def _enqueue_write(self, operation, args, message):
+        self.start_writer()
+        future = Future()
+        self._write_queue.put((operation, args, message, future))
+        return future
+
+    def _writer_loop(self):
+        # Схема должна быть создана и мигрирована до первой записи
+        self.connect_database()
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("PRAGMA journal_mode=WAL")
+        stopping = False
+        while not stopping:
+            batch = [self._write_queue.get()]
+            # Собираем всё, что успело накопиться, в одну транзакцию
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._write_queue.get(timeout=WRITE_BATCH_DELAY))
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [item for item in batch if item is not None]
+            self._write_batch(conn, batch)
+        conn.close()
+
+    def _write_batch(self, conn, batch):
+        if not batch:
+            return
+        try:
+            cursor = conn.cursor()
+            for operation, args, message, future in batch:
+                if operation:
+                    operation(cursor, *args)
+            conn.commit()
+            for operation, args, message, future in batch:
+                future.set_result((True, message))
+        except Exception:
+            conn.rollback()
+            # Одна ошибочная запись не должна терять остальные — пишем по одной
+            for operation, args, message, future in batch:
+                try:
+                    if operation:
+                        operation(conn.cursor(), *args)
+                    conn.commit()
+                    future.set_result((True, message))
+                except Exception as e:
+                    conn.rollback()
+                    future.set_result((False, f"Ошибка записи в БД: {str(e)}"))
+
+    def flush(self, timeout=None):
+        if not self._writer_thread:
+            return True
+        try:
+            self._enqueue_write(None, (), "").result(timeout)
+            return True
+        except Exception:
+            return False
 
     def close(self):
-        if self.conn:
-            try:
-                self.conn.close()
-            except:
-                pass
+        if self._writer_thread:
+            self._write_queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+        with self._lock:
+            if self.conn:
+                try:
+                    self.conn.close()
+                except:
+                    pass
+                self.conn = None
+
+
+
+class AuthService:
+    # Хеширование и проверка паролей в пуле потоков, чтобы не блокировать
+    # цикл событий arcade. Методы возвращают Future с результатом (success, data)
+
+    def __init__(self, database, max_workers=AUTH_WORKERS,
+                 n=PASSWORD_SCRYPT_N, r=PASSWORD_SCRYPT_R, p=PASSWORD_SCRYPT_P):
+        self.database = database
+        self.max_workers = max_workers
+        self.hash_params = {'n': n, 'r': r, 'p': p}
+        self._executor = None
+
+    def _submit(self, func, *args):
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="AuthService"
+            )
+        return self._executor.submit(func, *args)
+
+    def login(self, username, password):
+        return self._submit(self.database.login_player, username, password, self.hash_params)
+
+    def register(self, username, password):
+        return self._submit(self._register_and_login, username, password)
+
+    def _register_and_login(self, username, password):
+        success, message = self.database.register_player(username, password, self.hash_params)
+        if not success:
+            return False, message
+        login_success, player_data = self.database.login_player(username, password, self.hash_params)
+        if not login_success:
+            return False, player_data
+        return True, (message, player_data)
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
 
-db = GameDatabase("game_database12345.db")
+
+db = GameDatabase("game_database12345.db", write_behind=True, lazy=True)
+auth_service = AuthService(db)
+asset_registry = AssetRegistry()
+music_service = MusicService(MUSIC_VOLUME)
 
 class MainMenuView(arcade.View):
     def __init__(self):
@@ -207,6 +971,8 @@ class MainMenuView(arcade.View):
 
     def on_show_view(self):
         self.ui_manager.enable()
+        # Музыка уровней играет и на экране итогов, а в меню затихает
+        music_service.stop()
 
     def on_hide_view(self):
         self.ui_manager.disable()
@@ -228,6 +994,7 @@ class LoginView(arcade.View):
         self.username_input = None
         self.password_input = None
         self.message_label = None
+        self.pending_login = None
         self.setup_ui()
 
     def setup_ui(self):
@@ -313,6 +1080,8 @@ class LoginView(arcade.View):
         self.ui_manager.add(anchor_layout)
 
     def on_login_clicked(self, event):
+        if self.pending_login:
+            return
         username = self.username_input.text.strip()
         password = self.password_input.text.strip()
 
@@ -321,8 +1090,17 @@ class LoginView(arcade.View):
             self.message_label.text_color = arcade.color.RED
             return
 
-        success, result = db.login_player(username, password)
+        self.pending_login = auth_service.login(username, password)
+        self.message_label.text = "Проверка данных..."
+        self.message_label.text_color = arcade.color.YELLOW
+
+    def on_update(self, delta_time):
+        if self.pending_login and self.pending_login.done():
+            success, result = self.pending_login.result()
+            self.pending_login = None
+            self.on_login_finished(success, result)
 
+    def on_login_finished(self, success, result):
         if success:
             self.message_label.text = " Вход выполнен успешно!"
             self.message_label.text_color = arcade.color.GREEN
@@ -372,6 +1150,7 @@ class RegistrationView(arcade.View):
         self.password_input = None
         self.confirm_password_input = None
         self.message_label = None
+        self.pending_registration = None
         self.setup_ui()
 
     def setup_ui(self):
@@ -471,6 +1250,8 @@ class RegistrationView(arcade.View):
         self.ui_manager.add(anchor_layout)
 
     def on_register_clicked(self, event):
+        if self.pending_registration:
+            return
         username = self.username_input.text.strip()
         password = self.password_input.text.strip()
         confirm_password = self.confirm_password_input.text.strip()
@@ -490,20 +1271,28 @@ class RegistrationView(arcade.View):
             self.message_label.text = "Пароли не совпадают"
             self.message_label.text_color = arcade.color.RED
             return
-        success, message = db.register_player(username, password)
+        self.pending_registration = auth_service.register(username, password)
+        self.message_label.text = "Создание аккаунта..."
+        self.message_label.text_color = arcade.color.YELLOW
+
+    def on_update(self, delta_time):
+        if self.pending_registration and self.pending_registration.done():
+            success, result = self.pending_registration.result()
+            self.pending_registration = None
+            self.on_registration_finished(success, result)
 
+    def on_registration_finished(self, success, result):
         if success:
+            message, player_data = result
             self.message_label.text = f" {message}"
             self.message_label.text_color = arcade.color.GREEN
             self.username_input.text = ""
             self.password_input.text = ""
             self.confirm_password_input.text = ""
-            login_success, player_data = db.login_player(username, password)
-            if login_success:
-                game_view = GameView(player_data)
-                self.window.show_view(game_view)
+            game_view = GameView(player_data)
+            self.window.show_view(game_view)
         else:
-            self.message_label.text = f" {message}"
+            self.message_label.text = f" {result}"
             self.message_label.text_color = arcade.color.RED
 
     def on_back_clicked(self, event):
@@ -664,307 +1453,296 @@ class GameOverView(arcade.View):
         self.ui_manager.on_mouse_release(x, y, button, modifiers)
 
 
+def tile_grid(tile_map, *names):
+    # Статичные слои карты один раз переводятся в сетку занятости тайлов;
+    # у карты из кэша (tilemap_cache) сетки посчитаны при компиляции
+    if getattr(tile_map, 'occupancy', None) is not None:
+        return tile_map.walls(*names)
+    return OccupancyGrid.from_tiles(
+        [tile.position for name in names for tile in tile_map.sprite_lists[name]],
+        tile_map.tile_width * tile_map.scaling
+    )
+
+
+def level_manifest(level):
+    # Всё, что нужно уровню: карта, музыка и текстуры машин из состава заезда
+    race_class = RACE_LEVELS[level]
+    # Музыка сюда не входит: она читается потоком в music_service
+    manifest = [('tilemap', race_class.map_path, {'scaling': TILE_SCALING})]
+    if os.path.exists(CAR_ATLAS_MANIFEST):
+        manifest.append(('atlas', CAR_ATLAS_MANIFEST, {}))
+        return manifest
+    for entry in race_class.roster:
+        for name, texture_file, scale, width, height in entry['cars']:
+            manifest.append(('texture', texture_file, {}))
+    return manifest
+
+
+def preload_level(level):
+    # Ресурсы следующего уровня грузятся по одному за кадр, начиная после
+    # того, как экран итогов показан; что не загрузилось, уровень загрузит сам
+    asset_registry.queue_preload(level_manifest(level))
+    arcade.schedule_once(lambda delta_time: pyglet.clock.schedule(preload_step), PRELOAD_DELAY)
+
+
+def preload_step(delta_time):
+    success, result = asset_registry.preload_next()
+    if not success:
+        print(f" {result}")
+    elif not result:
+        arcade.unschedule(preload_step)
+
+
+def play_music(level):
+    # Тот же трек продолжает играть с того же места; без файла игра идёт без музыки
+    success, result = music_service.play(LEVEL_MUSIC[level])
+    if not success:
+        print(result)
+
+
+class LayerCache:
+    # Статичные слои карты за заезд не меняются, поэтому при загрузке карты
+    # они один раз рисуются во внеэкранный буфер, а в кадре выводится одна
+    # текстура на весь экран вместо тысяч тайлов. Кэш живёт, пока реестр
+    # отдаёт тот же объект карты (holds), см. bake_layers
+    def __init__(self, *sprite_lists):
+        self.sprite_lists = [sprite_list for sprite_list in sprite_lists if sprite_list]
+        self.sprite_list = arcade.SpriteList()
+        self.bake()
+
+    def holds(self, *sprite_lists):
+        layers = [sprite_list for sprite_list in sprite_lists if sprite_list]
+        return len(layers) == len(self.sprite_lists) and all(
+            layer is cached for layer, cached in zip(layers, self.sprite_lists))
+
+    def bake(self):
+        window = arcade.get_window()
+        ctx = window.ctx
+        # Буфер в размере кадра в пикселях, чтобы на HiDPI не терять резкость
+        width, height = window.get_framebuffer_size()
+        framebuffer = ctx.framebuffer(color_attachments=[ctx.texture((width, height), components=4)])
+        camera = arcade.camera.Camera2D(
+            viewport=arcade.LBWH(0, 0, width, height),
+            position=(SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2),
+            projection=arcade.LRBT(-SCREEN_WIDTH / 2, SCREEN_WIDTH / 2, -SCREEN_HEIGHT / 2, SCREEN_HEIGHT / 2),
+            render_target=framebuffer
+        )
+        with camera.activate():
+            framebuffer.clear()
+            for sprite_list in self.sprite_lists:
+                sprite_list.draw()
+        # Пиксели забираются в обычную текстуру: она живёт в атласе arcade
+        # и переживает его перестройку, в отличие от самого буфера
+        image = PIL.Image.frombytes("RGBA", (width, height), framebuffer.read(components=4))
+        # Хитбокс фона не нужен: рамка вместо обхода контура по пикселям кадра
+        texture = arcade.Texture(image.transpose(PIL.Image.Transpose.FLIP_TOP_BOTTOM),
+                                 hit_box_algorithm=arcade.hitbox.algo_bounding_box)
+        self.sprite_list.clear()
+        self.sprite_list.append(arcade.Sprite(texture, SCREEN_WIDTH / width,
+                                              SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2))
+
+    def draw(self):
+        self.sprite_list.draw(pixelated=True)
+
+
+# Запечённые слои по (карта, слои): общие для всех видов и перезапусков
+layer_caches = {}
+
+
+def bake_layers(path, tile_map, *names):
+    # Новый вид уровня и перезапуск (R) получают из реестра тот же объект
+    # карты, и готовая текстура берётся отсюда без перерисовки
+    sprite_lists = [tile_map.sprite_lists[name] for name in names]
+    key = (path, names)
+    cache = layer_caches.get(key)
+    if cache is None or not cache.holds(*sprite_lists):
+        cache = layer_caches[key] = LayerCache(*sprite_lists)
+    return cache
+
+
+def car_sprites(race, assets):
+    # Спрайты по составу заезда: текстура каждого варианта берётся из реестра
+    # (из атласа, если он собран) один раз, сколько бы машин с ней ни было
+    textures = {}
+    car_list = arcade.SpriteList()
+    sprites = []
+    for car in race.cars:
+        if car.sprite not in textures:
+            textures[car.sprite] = assets.car_texture(*car.sprite)
+        texture, scale = textures[car.sprite]
+        sprite = arcade.Sprite(texture, scale)
+        # Стены проверяются по хитбоксу текстуры, как в PhysicsEngineSimple
+        car.width = sprite.right - sprite.left
+        car.height = sprite.top - sprite.bottom
+        car_list.append(sprite)
+        sprites.append((car, sprite))
+    return car_list, sprites
+
+
+class RaceHud:
+    # Надписи заезда — постоянные arcade.Text в одной пачке pyglet. Строка
+    # пересобирается только когда меняется показываемое значение (время —
+    # раз в 0.1 сек), и весь HUD рисуется одним batch.draw() вместо
+    # раскладки глифов в каждом arcade.draw_text. hints — строки под целью
+    def __init__(self, goal, hints=(), ready_size=30):
+        self.batch = pyglet.graphics.Batch()
+        center_x = SCREEN_WIDTH // 2
+        self.player = self.text(10, SCREEN_HEIGHT - 30, arcade.color.WHITE, 16)
+        self.level = self.text(10, SCREEN_HEIGHT - 60, arcade.color.WHITE, 16)
+        self.time = self.text(SCREEN_WIDTH - 150, SCREEN_HEIGHT - 30, arcade.color.YELLOW, 16)
+        self.place = self.text(SCREEN_WIDTH - 150, SCREEN_HEIGHT - 60, arcade.color.YELLOW, 16)
+        self.goal = self.text(center_x, SCREEN_HEIGHT - 30, arcade.color.YELLOW, 22, goal, anchor_x="center")
+        self.hints = [self.text(center_x, SCREEN_HEIGHT - 60 - 30 * index, arcade.color.ORANGE, 19, hint,
+                                anchor_x="center")
+                      for index, hint in enumerate(hints)]
+        row = SCREEN_HEIGHT - 60 - 30 * len(hints)
+        self.finished = self.text(center_x, row, arcade.color.CYAN, 18, anchor_x="center")
+        self.player_leads = self.text(center_x, row - 30, arcade.color.GREEN, 20, "ВЫ ЛИДИРУЕТЕ!",
+                                      anchor_x="center", bold=True)
+        self.leader = self.text(center_x, row - 30, arcade.color.RED, 18, anchor_x="center")
+        self.countdown = self.text(center_x, SCREEN_HEIGHT // 2, arcade.color.RED, 100,
+                                   anchor_x="center", anchor_y="center", bold=True)
+        self.ready = self.text(center_x, SCREEN_HEIGHT // 2 - 100, arcade.color.WHITE, ready_size,
+                               "ПРИГОТОВЬТЕСЬ К СТАРТУ!", anchor_x="center", anchor_y="center")
+        self.go = self.text(center_x, SCREEN_HEIGHT // 2, arcade.color.GREEN, 60, "ГОНКА!",
+                            anchor_x="center", anchor_y="center", bold=True)
+
+    def text(self, x, y, color, size, value="", **kwargs):
+        return arcade.Text(value, x, y, color, size, batch=self.batch, **kwargs)
+
+    @staticmethod
+    def show(text, visible, value=None):
+        # arcade.Text сам пропускает присваивание той же строки
+        if visible and value is not None:
+            text.text = value
+        if text.visible != visible:
+            text.visible = visible
+
+    def update(self, race, player_data, racing):
+        show = self.show
+        show(self.player, True, f"Игрок: {player_data['username']}")
+        show(self.level, True, f"Уровень: {player_data['current_level']}")
+        show(self.time, racing, f"Время: {race.game_time - race.race_start_time:.1f} сек" if racing else None)
+        show(self.place, racing, f"Место: {race.player.place}/{len(race.cars)}" if racing else None)
+        show(self.goal, racing)
+        for hint in self.hints:
+            show(hint, racing)
+        show(self.finished, racing and bool(race.finish_order),
+             f"Финишировало: {len(race.finish_order)}/{len(race.cars)}")
+        # Лидер по живой таблице: известен ещё до первого финиша
+        leader = race.standings[0]
+        show(self.player_leads, racing and leader.is_player)
+        show(self.leader, racing and not leader.is_player, f"Лидирует: {leader.color_name}")
+        show(self.countdown, not race.game_started, race.countdown_text)
+        show(self.ready, not race.game_started)
+        show(self.go, race.game_started and race.show_go_text)
+
+    def draw(self):
+        self.batch.draw()
+
+
 class GameView(arcade.View):
     def __init__(self, player_data):
         super().__init__()
         self.player_data = player_data
-        sound1 = arcade.load_sound('Aphex_Twin_-_Ptolemy_80592407.mp3')
-        sound1.play(volume=0.07)
-        self.timer = 3.0
-        self.game_started = False
-        self.countdown_text = ""
-        self.show_go_text = False
-        self.go_text_timer = 0
-        self.finish_line_y = 150
-        self.finish_line_x_start = 200
-        self.finish_line_x_end = 760
-        self.ai_cars = []
+        self.race = None
         self.race_finished = False
-        self.road_limits = (200, 760)
-        self.finish_order = []  # Список машин в порядке финиша
-        self.finish_times = {}  # Время финиша каждой машины
-        self.game_time = 0
-        self.race_start_time = 0
         self.result_shown = False
+        self.assets = asset_registry.lease()
 
         self.setup()
 
     def setup(self):
-        tile_map = arcade.load_tilemap("carr2.tmx", scaling=TILE_SCALING)
+        # Новая аренда берётся до отпускания старой, поэтому при перезапуске
+        # (R) карта и текстуры приходят из реестра, а не с диска
+        held = self.assets
+        self.assets = asset_registry.lease()
+        tile_map = self.assets.tilemap("carr2.tmx", TILE_SCALING)
         self.ground_list = tile_map.sprite_lists["ground"]
         self.trassa_list = tile_map.sprite_lists["trassa"]
         self.decoration_list = tile_map.sprite_lists["sdecoration"]
         self.lines_list = tile_map.sprite_lists["finish_start_lines"]
         self.collision_list = tile_map.sprite_lists["collisions"]
-
-        self.car_list = arcade.SpriteList()
-        self.ai_cars = []
-        self.finish_order = []
-        self.finish_times = {}
+        self.background = bake_layers("carr2.tmx", tile_map, "ground", "trassa", "sdecoration",
+                                      "finish_start_lines")
+        self.hud = RaceHud("Цель: первым пересечь линию финиша!")
+
+        # Вся логика заезда живёт в LevelOneRace, вид только рисует её состояние
+        self.race = LevelOneRace(
+            walls=tile_grid(tile_map, "collisions"),
+            road_tiles=[tile.position for tile in self.trassa_list],
+            checkpoints=load_checkpoints("carr2.tmx"),
+            ai_scheduler=AIScheduler(budget_ms=AI_DECISION_BUDGET_MS),
+            live_standings=True
+        )
         self.race_finished = False
         self.result_shown = False
-        self.game_time = 0
-        self.race_start_time = 0
-        self.calculate_road_limits()
-        self.car_yellow = arcade.Sprite("car_yellow (12).png", 0.2)
-        self.car_yellow.center_x = 450
-        self.car_yellow.center_y = 700
-        self.car_yellow.change_x = 0
-        self.car_yellow.change_y = 0
-        self.car_yellow.has_finished = False
-        self.car_yellow.collision_radius = 25
-        self.car_yellow.is_player = True
-        self.car_yellow.color_name = "Желтая (Вы)"
-        self.car_yellow.finish_position = 0
-        self.car_yellow.car_length = 60
-        self.car_yellow.car_width = 30
-        self.car_yellow.front_bumper_y = 0
-        self.car_yellow.rear_bumper_y = 0
-        self.car_list.append(self.car_yellow)
-        self.car_red = arcade.Sprite("car_red12.png", 0.08)
-        self.car_red.center_x = 300
-        self.car_red.center_y = 700
-        self.car_red.ai_speed = random.uniform(AI_CAR_SPEED_MIN, AI_CAR_SPEED_MAX)
-        self.car_red.has_finished = False
-        self.car_red.collision_radius = 25
-        self.car_red.is_player = False
-        self.car_red.color_name = "Красная"
-        self.car_red.finish_position = 0
-        self.car_red.car_length = 24
-        self.car_red.car_width = 12
-        self.car_red.front_bumper_y = 0
-        self.car_red.rear_bumper_y = 0
-        self.car_list.append(self.car_red)
-        self.ai_cars.append(self.car_red)
-        self.car_blue = arcade.Sprite("car_blue123.png", 0.08)
-        self.car_blue.center_x = 600
-        self.car_blue.center_y = 700
-        self.car_blue.ai_speed = random.uniform(AI_CAR_SPEED_MIN, AI_CAR_SPEED_MAX)
-        self.car_blue.has_finished = False
-        self.car_blue.collision_radius = 25
-        self.car_blue.is_player = False
-        self.car_blue.color_name = "Синяя"
-        self.car_blue.finish_position = 0
-        # Параметры для определения передней/задней части
-        self.car_blue.car_length = 24
-        self.car_blue.car_width = 12
-        self.car_blue.front_bumper_y = 0
-        self.car_blue.rear_bumper_y = 0
-        self.car_list.append(self.car_blue)
-        self.ai_cars.append(self.car_blue)
-
-        self.create_physics_engines()
-
-        self.timer = 3.0
-        self.game_started = False
-        self.countdown_text = "3"
-        self.show_go_text = False
-        self.go_text_timer = 0
-
-    def calculate_road_limits(self):
-        if self.trassa_list and len(self.trassa_list) > 0:
-            min_x = SCREEN_WIDTH
-            max_x = 0
-
-            for tile in self.trassa_list:
-                if tile.center_x < min_x:
-                    min_x = tile.center_x
-                if tile.center_x > max_x:
-                    max_x = tile.center_x
-
-            road_width = max_x - min_x
-            padding = road_width * 0.05
-
-            self.road_limits = (min_x + padding, max_x - padding)
-        else:
-            self.road_limits = (200, 760)
-
-    def create_physics_engines(self):
-        self.physics_engines = []
-
-        self.player_physics = arcade.PhysicsEngineSimple(self.car_yellow, self.collision_list)
-        self.physics_engines.append(self.player_physics)
-
-        for ai_car in self.ai_cars:
-            ai_physics = arcade.PhysicsEngineSimple(ai_car, self.collision_list)
-            self.physics_engines.append(ai_physics)
-
-    def update_car_bumpers(self, car):
-        if car.scale == 0.2:
-            half_length = car.car_length / 2
-            car.front_bumper_y = car.center_y - half_length
-            car.rear_bumper_y = car.center_y + half_length
-        else:
-            half_length = car.car_length / 2
-            car.front_bumper_y = car.center_y - half_length
-            car.rear_bumper_y = car.center_y + half_length
-
-    def check_car_collision_front_rear(self, car1, car2):
-        if car1.has_finished or car2.has_finished:
-            return False
-        self.update_car_bumpers(car1)
-        self.update_car_bumpers(car2)
-        half_width1 = car1.car_width / 2
-        half_width2 = car2.car_width / 2
+        self.car_list, self.car_sprites = car_sprites(self.race, self.assets)
+        self.car_yellow = self.car_sprites[0][1]
+        held.release()
+        self.sync_sprites()
 
-        x_overlap = abs(car1.center_x - car2.center_x) < (half_width1 + half_width2)
-
-        if not x_overlap:
-            return False
-        front_to_rear = (car1.front_bumper_y <= car2.rear_bumper_y and
-                         car1.front_bumper_y >= car2.front_bumper_y)
-
-        rear_to_front = (car1.rear_bumper_y >= car2.front_bumper_y and
-                         car1.rear_bumper_y <= car2.rear_bumper_y)
-
-        side_by_side = (car1.rear_bumper_y > car2.front_bumper_y and
-                        car1.front_bumper_y < car2.rear_bumper_y)
-
-        return front_to_rear or rear_to_front or side_by_side
-
-    def check_car_collisions(self, car):
-        if car.has_finished:
-            return
-
-        for other_car in self.car_list:
-            if other_car != car and not other_car.has_finished:
-                if self.check_car_collision_front_rear(car, other_car):
-                    self.handle_collision(car, other_car)
-
-    def handle_collision(self, car1, car2):
-        self.update_car_bumpers(car1)
-        self.update_car_bumpers(car2)
-
-        # тип столкновения
-        front_to_rear = car1.front_bumper_y <= car2.rear_bumper_y and car1.front_bumper_y >= car2.front_bumper_y
-        rear_to_front = car1.rear_bumper_y >= car2.front_bumper_y and car1.rear_bumper_y <= car2.rear_bumper_y
-        if front_to_rear:
-            push_strength = 20
-            if car1.is_player:
-                car1.change_y *= 0.3
-            else:
-                car1.ai_speed *= 0.4
-            if car2.is_player:
-                car2.change_y = min(car2.change_y - 3, -CAR_SPEED_LEVEL_1)
-            else:
-                car2.ai_speed = min(car2.ai_speed * 1.5, AI_CAR_SPEED_MAX * 2)
-
-        elif rear_to_front:
-            # car1 врезается спереди в car2
-            push_strength = 15
-            if car1.is_player:
-                car1.change_y *= 0.5
-            else:
-                car1.ai_speed *= 0.6
-            if car2.is_player:
-                car2.change_y = max(car2.change_y + 2, CAR_SPEED_LEVEL_1)
-            else:
-                car2.ai_speed = max(car2.ai_speed * 0.8, AI_CAR_SPEED_MIN)
-        else:
-            # Боковое столкновение
-            push_strength = 10
-            if car1.is_player:
-                car1.change_y *= 0.7
-            else:
-                car1.ai_speed *= 0.8
-            if car2.is_player:
-                car2.change_y *= 0.7
-            else:
-                car2.ai_speed *= 0.8
-
-        # Горизонтальное отталкивание
-        dx = car2.center_x - car1.center_x
-        if dx != 0:
-            push_x = push_strength * 0.3 * (1 if dx > 0 else -1)
-            car1.center_x -= push_x
-            car2.center_x += push_x
-
-        # Вертикальное отталкивание
-        dy = car2.center_y - car1.center_y
-        if dy != 0:
-            push_y = push_strength * (1 if dy > 0 else -1)
-            car1.center_y -= push_y
-            car2.center_y += push_y
-        self.keep_car_on_road(car1, is_ai=(not car1.is_player))
-        self.keep_car_on_road(car2, is_ai=(not car2.is_player))
-
-    def keep_car_on_road(self, car, is_ai=False):
-        left_limit, right_limit = self.road_limits
-        if car.center_x < left_limit:
-            car.center_x = left_limit + 5
-            if is_ai and not car.has_finished:
-                car.ai_speed *= 0.95
-            elif not is_ai and not car.has_finished:
-                car.change_x = 0
-
-        elif car.center_x > right_limit:
-            car.center_x = right_limit - 5
-            if is_ai and not car.has_finished:
-                car.ai_speed *= 0.95
-            elif not is_ai and not car.has_finished:
-                car.change_x = 0
-
-    def check_finish_line(self, car):
-        if car.has_finished:
-            return False
-        if not (self.finish_line_x_start <= car.center_x <= self.finish_line_x_end):
-            return False
-        self.update_car_bumpers(car)
-        if car.front_bumper_y <= self.finish_line_y:
-            return True
-        return False
-
-    def handle_finish(self, car):
-        if not car.has_finished:
-            car.has_finished = True
-            if car.is_player:
-                car.change_x = 0
-                car.change_y = 0
-            else:
-                car.ai_speed = 0
-            car.center_y = self.finish_line_y - 5
-            race_time = self.game_time - self.race_start_time
-            self.finish_times[car] = race_time
-            self.finish_order.append(car)
-            car.finish_position = len(self.finish_order)
-            self.check_race_completion()
+    def sync_sprites(self):
+        for car, sprite in self.car_sprites:
+            sprite.center_x, sprite.center_y = self.race.interpolated_position(car)
 
     def check_race_completion(self):
-        all_finished = all(car.has_finished for car in self.car_list)
-        if all_finished and not self.race_finished:
+        if self.race.race_finished and not self.race_finished:
             print(" ВСЕ МАШИНЫ ФИНИШИРОВАЛИ НА УРОВНЕ 1!")
             print("Порядок финиша:")
-            for i, car in enumerate(self.finish_order, 1):
-                print(f"{i}. {car.color_name} - {self.finish_times[car]:.2f} сек")
+            for i, car in enumerate(self.race.finish_order, 1):
+                print(f"{i}. {car.color_name} - {self.race.finish_times[car]:.2f} сек")
             self.race_finished = True
+            self.save_race_result(1)
             arcade.schedule(self.show_final_results, 1.0)
 
+    def save_race_result(self, level):
+        player_car = self.race.player
+        if player_car not in self.race.finish_times:
+            return
+        success, db_message = db.record_race_result(
+            self.player_data['id'], level,
+            player_car.finish_position,
+            self.race.finish_times[player_car]
+        )
+        if not success:
+            print(f" Ошибка сохранения результата в БД: {db_message}")
+
     def show_final_results(self, delta_time=None):
         arcade.unschedule(self.show_final_results)
         if self.result_shown:
             return
         self.result_shown = True
-        if self.finish_order:
-            winner = self.finish_order[0]
+        finish_order = self.race.finish_order
+        finish_times = self.race.finish_times
+        if finish_order:
+            winner = finish_order[0]
             winner_name = winner.color_name
             is_victory = winner.is_player
             message = ""
             if is_victory:
-                message = f" ПОБЕДА! Уровень 1 пройден!\nВы финишировали ПЕРВЫМ!\nВремя: {self.finish_times[winner]:.2f} сек"
+                message = f" ПОБЕДА! Уровень 1 пройден!\nВы финишировали ПЕРВЫМ!\nВремя: {finish_times[winner]:.2f} сек"
 
-                success, db_message = db.update_player_level(self.player_data['id'], 2)
-                if success:
-                    print(f" Уровень игрока {self.player_data['username']} обновлен до 2 в БД")
-                    self.player_data['current_level'] = 2
-                else:
-                    print(f" Ошибка обновления уровня в БД: {db_message}")
+                username = self.player_data['username']
+
+                def on_level_saved(success, db_message):
+                    if success:
+                        print(f" Уровень игрока {username} обновлен до 2 в БД")
+                    else:
+                        print(f" Ошибка обновления уровня в БД: {db_message}")
+
+                db.update_player_level_async(self.player_data['id'], 2, callback=on_level_saved)
+                self.player_data['current_level'] = 2
+                # Второй уровень грузится, пока виден экран итогов:
+                # переход на него уже не ждёт диска
+                preload_level(2)
             else:
-                player_car = self.car_yellow
-                player_time = self.finish_times.get(player_car, 0)
+                player_car = self.race.player
+                player_time = finish_times.get(player_car, 0)
 
                 #  позиция игрока
-                if player_car in self.finish_order:
-                    player_position = self.finish_order.index(player_car) + 1
+                if player_car in finish_order:
+                    player_position = finish_order.index(player_car) + 1
                 else:
                     player_position = "не финишировал"
 
@@ -980,160 +1758,37 @@ class GameView(arcade.View):
         game_over_view = GameOverView(message, self.player_data, is_victory, winner_name)
         self.window.show_view(game_over_view)
 
-    def update_ai_cars(self, delta_time):
-        if not self.game_started or self.race_finished:
-            return
-        for ai_car in self.ai_cars:
-            if ai_car.has_finished:
-                continue
-            ai_car.center_y -= ai_car.ai_speed
-
-            # Проверяем столкновения
-            self.check_car_collisions(ai_car)
-
-            # Небольшие случайные отклонения
-            if random.random() < 0.03:
-                deviation = random.uniform(-10, 10)
-                new_x = ai_car.center_x + deviation
-
-                left_limit, right_limit = self.road_limits
-                if left_limit <= new_x <= right_limit:
-                    ai_car.center_x = new_x
-                else:
-                    ai_car.center_x += -deviation * 0.3
+    def on_update(self, delta_time):
+        self.race.advance(delta_time)
+        self.check_race_completion()
 
-            self.keep_car_on_road(ai_car, is_ai=True)
-            if self.check_finish_line(ai_car) and not ai_car.has_finished:
-                self.handle_finish(ai_car)
+    def on_show_view(self):
+        play_music(1)
 
-    def on_update(self, delta_time):
-        self.game_time += delta_time
-        if not self.game_started:
-            self.timer -= delta_time
-            if self.timer > 2.0:
-                self.countdown_text = "3"
-            elif self.timer > 1.0:
-                self.countdown_text = "2"
-            elif self.timer > 0:
-                self.countdown_text = "1"
-            else:
-                self.countdown_text = ""
-                self.game_started = True
-                self.show_go_text = True
-                self.go_text_timer = 1.0
-                self.race_start_time = self.game_time
-
-        # Скрывать текст "ГОНКА!" через 1 секунду
-        if self.game_started and self.show_go_text:
-            self.go_text_timer -= delta_time
-            if self.go_text_timer <= 0:
-                self.show_go_text = False
-        if self.game_started and not self.race_finished:
-            for physics_engine in self.physics_engines:
-                physics_engine.update()
-            if self.car_yellow and not self.car_yellow.has_finished:
-                self.check_car_collisions(self.car_yellow)
-            self.update_ai_cars(delta_time)
-            if self.car_yellow and not self.car_yellow.has_finished:
-                self.keep_car_on_road(self.car_yellow, is_ai=False)
-
-                # Проверяем финиш игрока
-                if self.check_finish_line(self.car_yellow) and not self.car_yellow.has_finished:
-                    self.handle_finish(self.car_yellow)
+    def on_hide_view(self):
+        self.assets.release()
 
     def on_draw(self):
         self.clear()
-        if self.ground_list:
-            self.ground_list.draw()
-        if self.trassa_list:
-            self.trassa_list.draw()
-        if self.decoration_list:
-            self.decoration_list.draw()
-        if self.lines_list:
-            self.lines_list.draw()
+        race = self.race
+        self.sync_sprites()
+        self.background.draw()
         if self.car_list:
             self.car_list.draw()
-        arcade.draw_text(
-            f"Игрок: {self.player_data['username']}",
-            10, SCREEN_HEIGHT - 30,
-            arcade.color.WHITE, 16
-        )
-        arcade.draw_text(
-            f"Уровень: {self.player_data['current_level']}",
-            10, SCREEN_HEIGHT - 60,
-            arcade.color.WHITE, 16
-        )
-        if self.game_started and not self.race_finished:
-            race_time = self.game_time - self.race_start_time
-            arcade.draw_text(
-                f"Время: {race_time:.1f} сек",
-                SCREEN_WIDTH - 150, SCREEN_HEIGHT - 30,
-                arcade.color.YELLOW, 16
-            )
-        if self.game_started and not self.race_finished:
-            arcade.draw_text(
-                "Цель: первым пересечь линию финиша!",
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT - 30,
-                arcade.color.YELLOW, 22,
-                anchor_x="center"
-            )
-            if self.finish_order:
-                arcade.draw_text(
-                    f"Финишировало: {len(self.finish_order)}/3",
-                    SCREEN_WIDTH // 2, SCREEN_HEIGHT - 60,
-                    arcade.color.CYAN, 18,
-                    anchor_x="center"
-                )
-                if len(self.finish_order) > 0:
-                    leader = self.finish_order[0]
-                    if leader.is_player:
-                        arcade.draw_text(
-                            "ВЫ ЛИДИРУЕТЕ!",
-                            SCREEN_WIDTH // 2, SCREEN_HEIGHT - 90,
-                            arcade.color.GREEN, 20,
-                            anchor_x="center", bold=True
-                        )
-                    else:
-                        arcade.draw_text(
-                            f"Лидирует: {leader.color_name}",
-                            SCREEN_WIDTH // 2, SCREEN_HEIGHT - 90,
-                            arcade.color.RED, 18,
-                            anchor_x="center"
-                        )
-
-        if not self.game_started:
-            arcade.draw_text(
-                self.countdown_text,
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2,
-                arcade.color.RED, 100,
-                anchor_x="center", anchor_y="center",
-                bold=True
-            )
-            arcade.draw_text(
-                "ПРИГОТОВЬТЕСЬ К СТАРТУ!",
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100,
-                arcade.color.WHITE, 30,
-                anchor_x="center", anchor_y="center"
-            )
-        elif self.show_go_text:
-            arcade.draw_text(
-                "ГОНКА!",
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2,
-                arcade.color.GREEN, 60,
-                anchor_x="center", anchor_y="center",
-                bold=True
-            )
+        self.hud.update(race, self.player_data, race.game_started and not self.race_finished)
+        self.hud.draw()
 
     def on_key_press(self, key, modifiers):
-        if self.game_started and self.car_yellow and not self.car_yellow.has_finished:
+        player = self.race.player
+        if self.race.game_started and not player.has_finished:
             if key == arcade.key.UP:
-                self.car_yellow.change_y = CAR_SPEED_LEVEL_1
+                player.change_y = CAR_SPEED_LEVEL_1
             elif key == arcade.key.DOWN:
-                self.car_yellow.change_y = -CAR_SPEED_LEVEL_1
+                player.change_y = -CAR_SPEED_LEVEL_1
             elif key == arcade.key.LEFT:
-                self.car_yellow.change_x = -CAR_SPEED_LEVEL_1
+                player.change_x = -CAR_SPEED_LEVEL_1
             elif key == arcade.key.RIGHT:
-                self.car_yellow.change_x = CAR_SPEED_LEVEL_1
+                player.change_x = CAR_SPEED_LEVEL_1
 
         if key == arcade.key.R:
             self.setup()
@@ -1144,226 +1799,94 @@ class GameView(arcade.View):
             self.window.show_view(menu_view)
 
     def on_key_release(self, key, modifiers):
-        if self.game_started and self.car_yellow and not self.car_yellow.has_finished:
+        player = self.race.player
+        if self.race.game_started and not player.has_finished:
             if key == arcade.key.UP or key == arcade.key.DOWN:
-                self.car_yellow.change_y = 0
+                player.change_y = 0
             elif key == arcade.key.LEFT or key == arcade.key.RIGHT:
-                self.car_yellow.change_x = 0
+                player.change_x = 0
 
 
 class SecondLevel(arcade.View):
     def __init__(self, player_data):
         super().__init__()
         self.player_data = player_data
-        self.timer = 3.0
-        self.game_started = False
-        self.countdown_text = "3"
-        self.show_go_text = False
-        self.go_text_timer = 0
-        self.ai_cars = []
+        self.race = None
         self.race_finished = False
-        self.finish_order = []
-        self.finish_times = {}
-        self.game_time = 0
-        self.race_start_time = 0
-        self.finish_line_x = 900
-        self.finish_line_y_start = 200
-        self.finish_line_y_end = 600
         self.result_shown = False
-        self.music_playing = False
+        self.assets = asset_registry.lease()
         self.setup()
 
     def setup(self):
-        if not self.music_playing:
-            sound = arcade.load_sound('Aphex_Twin_-_Ptolemy_80592407.mp3')
-            sound.play(volume=0.07)
-            self.music_playing = True
-        tile_map = arcade.load_tilemap("does.tmx", scaling=TILE_SCALING)
+        held = self.assets
+        self.assets = asset_registry.lease()
+        tile_map = self.assets.tilemap("does.tmx", TILE_SCALING)
         self.ground_list = tile_map.sprite_lists["earth"]
         self.finish_list = tile_map.sprite_lists["finish"]
         self.start_list = tile_map.sprite_lists["start"]
         self.collisions_list = tile_map.sprite_lists["collisions"]
         self.roks_list = tile_map.sprite_lists["rocs"]
-        self.car_list = arcade.SpriteList()
-        self.ai_cars = []
-        self.car_yellow = arcade.Sprite("car_yellow (1).png", 0.2)
-        self.car_yellow.center_x = 50
-        self.car_yellow.center_y = 650
-        self.car_yellow.angle = 0
-        self.car_yellow.change_x = 0
-        self.car_yellow.change_y = 0
-        self.car_yellow.has_finished = False
-        self.car_yellow.collision_radius = 25
-        self.car_yellow.is_player = True
-        self.car_yellow.color_name = "Желтая (Вы)"
-        self.car_list.append(self.car_yellow)
-        self.car_red = arcade.Sprite("car_red1.png", 0.08)
-        self.car_red.center_x = 50
-        self.car_red.center_y = 430
-        self.car_red.angle = 0
-        self.car_red.ai_speed = random.uniform(AI_CAR_SPEED_MIN, AI_CAR_SPEED_MAX)
-        self.car_red.has_finished = False
-        self.car_red.collision_radius = 25
-        self.car_red.is_player = False
-        self.car_red.color_name = "Красная"
-        self.car_list.append(self.car_red)
-        self.ai_cars.append(self.car_red)
-        self.car_blue = arcade.Sprite("car_blue1.png", 0.08)
-        self.car_blue.center_x = 50
-        self.car_blue.center_y = 250
-        self.car_blue.angle = 0
-        self.car_blue.ai_speed = random.uniform(AI_CAR_SPEED_MIN, AI_CAR_SPEED_MAX)
-        self.car_blue.has_finished = False
-        self.car_blue.collision_radius = 25
-        self.car_blue.is_player = False
-        self.car_blue.color_name = "Синяя"
-        self.car_list.append(self.car_blue)
-        self.ai_cars.append(self.car_blue)
-        self.physics_engines = []
-        all_collision_objects = arcade.SpriteList()
-        all_collision_objects.extend(self.collisions_list)
-        all_collision_objects.extend(self.roks_list)
-        self.player_physics = arcade.PhysicsEngineSimple(self.car_yellow, all_collision_objects)
-        self.physics_engines.append(self.player_physics)
-        for ai_car in self.ai_cars:
-            ai_physics = arcade.PhysicsEngineSimple(ai_car, all_collision_objects)
-            self.physics_engines.append(ai_physics)
-        self.timer = 3.0
-        self.game_started = False
-        self.countdown_text = "3"
-        self.show_go_text = False
-        self.go_text_timer = 0
+        self.background = bake_layers("does.tmx", tile_map, "earth", "rocs", "finish", "start", "collisions")
+        self.hud = RaceHud("Цель: первым пересечь финишную линию справа!", ("Избегайте камней!",),
+                           ready_size=33)
+        self.race = LevelTwoRace(
+            walls=tile_grid(tile_map, "collisions", "rocs"),
+            checkpoints=load_checkpoints("does.tmx"),
+            flow_field=LevelTwoRace.load_flow_field("does.tmx"),
+            ai_scheduler=AIScheduler(budget_ms=AI_DECISION_BUDGET_MS),
+            live_standings=True
+        )
         self.race_finished = False
-        self.game_time = 0
-        self.race_start_time = 0
-        self.finish_order = []
-        self.finish_times = {}
         self.result_shown = False
+        self.car_list, self.car_sprites = car_sprites(self.race, self.assets)
+        self.car_yellow = self.car_sprites[0][1]
+        held.release()
+        self.sync_sprites()
 
-    def check_car_collision(self, car1, car2):
-        if car1.has_finished or car2.has_finished:
-            return False
-        distance = math.sqrt(
-            (car1.center_x - car2.center_x) ** 2 +
-            (car1.center_y - car2.center_y) ** 2
-        )
-        collision_distance = car1.collision_radius + car2.collision_radius
-        return distance < collision_distance
-
-    def handle_car_collision(self, car1, car2):
-        dx = car2.center_x - car1.center_x
-        dy = car2.center_y - car1.center_y
-        distance = math.sqrt(dx * dx + dy * dy)
-        if distance == 0:
-            dx = random.uniform(-1, 1)
-            dy = random.uniform(-1, 1)
-            distance = math.sqrt(dx * dx + dy * dy)
-        dx /= distance
-        dy /= distance
-        push_strength = 15
-
-        if car1.is_player:
-            car1.change_x -= dx * push_strength * 0.5
-            car1.change_y -= dy * push_strength * 0.5
-            car1.change_x *= 0.7
-            car1.change_y *= 0.7
-        else:
-            car1.ai_speed *= 0.7
-            car1.center_x -= dx * push_strength * 0.3
-            car1.center_y -= dy * push_strength * 0.3
-
-        if car2.is_player:
-            car2.change_x += dx * push_strength * 0.5
-            car2.change_y += dy * push_strength * 0.5
-            car2.change_x *= 0.7
-            car2.change_y *= 0.7
-        else:
-            car2.ai_speed *= 0.7
-            car2.center_x += dx * push_strength * 0.3
-            car2.center_y += dy * push_strength * 0.3
-
-    def check_all_car_collisions(self):
-        for i in range(len(self.car_list)):
-            car1 = self.car_list[i]
-            if car1.has_finished:
-                continue
-            for j in range(i + 1, len(self.car_list)):
-                car2 = self.car_list[j]
-                if car2.has_finished:
-                    continue
-                if self.check_car_collision(car1, car2):
-                    self.handle_car_collision(car1, car2)
-
-    def keep_car_in_bounds(self, car, is_ai=False):
-        margin = 20
-        if car.center_x < margin:
-            car.center_x = margin
-            if car.is_player:
-                car.change_x = max(car.change_x, 0)
-            else:
-                car.ai_speed = max(car.ai_speed * 0.8, AI_CAR_SPEED_MIN)
-        if car.center_x > SCREEN_WIDTH - margin:
-            car.center_x = SCREEN_WIDTH - margin
-            if car.is_player:
-                car.change_x = min(car.change_x, 0)
-            else:
-                car.ai_speed = max(car.ai_speed * 0.8, AI_CAR_SPEED_MIN)
-        if car.center_y < margin:
-            car.center_y = margin
-            if car.is_player:
-                car.change_y = max(car.change_y, 0)
-        if car.center_y > SCREEN_HEIGHT - margin:
-            car.center_y = SCREEN_HEIGHT - margin
-            if car.is_player:
-                car.change_y = min(car.change_y, 0)
-
-    def check_finish_line(self, car):
-        if car.has_finished:
-            return False
-        if not (self.finish_line_y_start <= car.center_y <= self.finish_line_y_end):
-            return False
-        if car.center_x >= self.finish_line_x:
-            return True
-        return False
-
-    def handle_finish(self, car):
-        if not car.has_finished:
-            car.has_finished = True
-            if car.is_player:
-                car.change_x = 0
-                car.change_y = 0
-            else:
-                car.ai_speed = 0
-            car.center_x = self.finish_line_x - 10
-            race_time = self.game_time - self.race_start_time
-            self.finish_times[car] = race_time
-            self.finish_order.append(car)
-            self.check_race_completion()
+    def sync_sprites(self):
+        for car, sprite in self.car_sprites:
+            sprite.center_x, sprite.center_y = self.race.interpolated_position(car)
 
     def check_race_completion(self):
-        all_finished = all(car.has_finished for car in self.car_list)
-        if all_finished and not self.race_finished:
+        if self.race.race_finished and not self.race_finished:
             self.race_finished = True
+            self.save_race_result(self.player_data['current_level'])
             self.show_final_results()
 
+    def save_race_result(self, level):
+        player_car = self.race.player
+        if player_car not in self.race.finish_times:
+            return
+        success, db_message = db.record_race_result(
+            self.player_data['id'], level,
+            player_car.finish_position,
+            self.race.finish_times[player_car]
+        )
+        if not success:
+            print(f" Ошибка сохранения результата в БД: {db_message}")
+
     def show_final_results(self):
         if self.result_shown:
             return
         self.result_shown = True
-        winner = self.finish_order[0] if self.finish_order else None
+        finish_order = self.race.finish_order
+        finish_times = self.race.finish_times
+        winner = finish_order[0] if finish_order else None
         winner_name = winner.color_name if winner else ""
         is_victory = winner.is_player if winner else False
         if is_victory:
-            message = f" ПОБЕДА! Уровень 2 пройден!\nВы финишировали ПЕРВЫМ!\nВремя: {self.finish_times[winner]:.2f} сек"
+            message = f" ПОБЕДА! Уровень 2 пройден!\nВы финишировали ПЕРВЫМ!\nВремя: {finish_times[winner]:.2f} сек"
             success, db_message = db.update_player_level(self.player_data['id'], 3)
             if success:
                 self.player_data['current_level'] = 3
+            else:
+                print(f" Ошибка обновления уровня в БД: {db_message}")
         else:
-            player_car = self.car_yellow
-            player_time = self.finish_times.get(player_car, 0)
+            player_car = self.race.player
+            player_time = finish_times.get(player_car, 0)
 
-            if player_car in self.finish_order:
-                player_position = self.finish_order.index(player_car) + 1
+            if player_car in finish_order:
+                player_position = finish_order.index(player_car) + 1
             else:
                 player_position = "не финишировал"
             message = f'Вы проиграли уровень 2!\n'
@@ -1474,180 +1997,38 @@ class SecondLevel(arcade.View):
         game_over_view = SecondLevelGameOverView(message, self.player_data, is_victory, winner_name)
         self.window.show_view(game_over_view)
 
-    def update_ai_cars(self, delta_time):
-        if not self.game_started or self.race_finished:
-            return
-
-        for ai_car in self.ai_cars:
-            if ai_car.has_finished:
-                continue
-
-            ai_car.center_x += ai_car.ai_speed
-
-            if random.random() < 0.04:
-                deviation = random.uniform(-15, 15)
-                new_y = ai_car.center_y + deviation
-                y_min, y_max = 100, 700
-                if y_min <= new_y <= y_max:
-                    ai_car.center_y = new_y
-                else:
-                    ai_car.center_y -= deviation * 0.5
-
-            self.keep_car_in_bounds(ai_car, is_ai=True)
-
-            if self.check_finish_line(ai_car):
-                self.handle_finish(ai_car)
-
     def on_update(self, delta_time):
-        self.game_time += delta_time
-
-        if not self.game_started:
-            self.timer -= delta_time
-            if self.timer > 2.0:
-                self.countdown_text = "3"
-            elif self.timer > 1.0:
-                self.countdown_text = "2"
-            elif self.timer > 0:
-                self.countdown_text = "1"
-            else:
-                self.countdown_text = ""
-                self.game_started = True
-                self.show_go_text = True
-                self.go_text_timer = 1.0
-                self.race_start_time = self.game_time
-
-        if self.game_started and self.show_go_text:
-            self.go_text_timer -= delta_time
-            if self.go_text_timer <= 0:
-                self.show_go_text = False
-
-        if self.game_started and not self.race_finished:
-            for physics_engine in self.physics_engines:
-                physics_engine.update()
-
-            self.check_all_car_collisions()
-            self.update_ai_cars(delta_time)
-
-            if not self.car_yellow.has_finished:
-                self.keep_car_in_bounds(self.car_yellow, is_ai=False)
-
-                if self.check_finish_line(self.car_yellow):
-                    self.handle_finish(self.car_yellow)
-
-            if not self.race_finished:
-                all_finished = all(car.has_finished for car in self.car_list)
-                if all_finished:
-                    self.check_race_completion()
+        self.race.advance(delta_time)
+        self.check_race_completion()
 
     def on_draw(self):
         self.clear()
-        self.ground_list.draw()
-        self.roks_list.draw()
-        self.finish_list.draw()
-        self.start_list.draw()
-        self.collisions_list.draw()
+        race = self.race
+        self.sync_sprites()
+        self.background.draw()
         self.car_list.draw()
-
-        arcade.draw_text(
-            f"Игрок: {self.player_data['username']}",
-            10, SCREEN_HEIGHT - 30,
-            arcade.color.WHITE, 16
-        )
-
-        arcade.draw_text(
-            f"Уровень: {self.player_data['current_level']}",
-            10, SCREEN_HEIGHT - 60,
-            arcade.color.WHITE, 16
-        )
-
-        if self.game_started and not self.race_finished:
-            race_time = self.game_time - self.race_start_time
-            arcade.draw_text(
-                f"Время: {race_time:.1f} сек",
-                SCREEN_WIDTH - 150, SCREEN_HEIGHT - 30,
-                arcade.color.YELLOW, 16
-            )
-
-        if self.game_started and not self.race_finished:
-            arcade.draw_text(
-                "Цель: первым пересечь финишную линию справа!",
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT - 30,
-                arcade.color.YELLOW, 22,
-                anchor_x="center"
-            )
-
-            arcade.draw_text(
-                "Избегайте камней!",
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT - 60,
-                arcade.color.ORANGE, 19,
-                anchor_x="center"
-            )
-
-            if self.finish_order:
-                arcade.draw_text(
-                    f"Финишировало: {len(self.finish_order)}/3",
-                    SCREEN_WIDTH // 2, SCREEN_HEIGHT - 90,
-                    arcade.color.CYAN, 18,
-                    anchor_x="center"
-                )
-
-                if len(self.finish_order) > 0:
-                    leader = self.finish_order[0]
-                    if leader.is_player:
-                        arcade.draw_text(
-                            "ВЫ ЛИДИРУЕТЕ!",
-                            SCREEN_WIDTH // 2, SCREEN_HEIGHT - 120,
-                            arcade.color.GREEN, 20,
-                            anchor_x="center", bold=True
-                        )
-                    else:
-                        arcade.draw_text(
-                            f"Лидирует: {leader.color_name}",
-                            SCREEN_WIDTH // 2, SCREEN_HEIGHT - 120,
-                            arcade.color.RED, 18,
-                            anchor_x="center"
-                        )
-
-        if not self.game_started:
-            arcade.draw_text(
-                self.countdown_text,
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2,
-                arcade.color.RED, 100,
-                anchor_x="center", anchor_y="center",
-                bold=True
-            )
-
-            arcade.draw_text(
-                "ПРИГОТОВЬТЕСЬ К СТАРТУ!",
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100,
-                arcade.color.WHITE, 33,
-                anchor_x="center", anchor_y="center"
-            )
-        elif self.show_go_text:
-            arcade.draw_text(
-                "ГОНКА!",
-                SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2,
-                arcade.color.GREEN, 60,
-                anchor_x="center", anchor_y="center",
-                bold=True
-            )
+        self.hud.update(race, self.player_data, race.game_started and not self.race_finished)
+        self.hud.draw()
 
     def on_show_view(self):
-        if not self.music_playing:
-            sound = arcade.load_sound('Aphex_Twin_-_Ptolemy_80592407.mp3')
-            sound.play(volume=0.07)
-            self.music_playing = True
+        play_music(2)
+
+    def on_hide_view(self):
+        # Карта и текстуры остаются в реестре для следующего заезда, но
+        # больше не заняты и могут быть выгружены при нехватке бюджета
+        self.assets.release()
 
     def on_key_press(self, key, modifiers):
-        if self.game_started and not self.car_yellow.has_finished:
+        player = self.race.player
+        if self.race.game_started and not player.has_finished:
             if key == arcade.key.RIGHT:
-                self.car_yellow.change_x = CAR_SPEED_LEVEL_2
+                player.change_x = CAR_SPEED_LEVEL_2
             elif key == arcade.key.LEFT:
-                self.car_yellow.change_x = -CAR_SPEED_LEVEL_2
+                player.change_x = -CAR_SPEED_LEVEL_2
             elif key == arcade.key.UP:
-                self.car_yellow.change_y = CAR_SPEED_LEVEL_2
+                player.change_y = CAR_SPEED_LEVEL_2
             elif key == arcade.key.DOWN:
-                self.car_yellow.change_y = -CAR_SPEED_LEVEL_2
+                player.change_y = -CAR_SPEED_LEVEL_2
 
         if key == arcade.key.R:
             self.setup()
@@ -1657,17 +2038,175 @@ class SecondLevel(arcade.View):
             self.window.show_view(menu_view)
 
     def on_key_release(self, key, modifiers):
-        if self.game_started and not self.car_yellow.has_finished:
+        player = self.race.player
+        if self.race.game_started and not player.has_finished:
             if key == arcade.key.RIGHT or key == arcade.key.LEFT:
-                self.car_yellow.change_x = 0
+                player.change_x = 0
             elif key == arcade.key.UP or key == arcade.key.DOWN:
-                self.car_yellow.change_y = 0
+                player.change_y = 0
+
+
+class StressTestView(arcade.View):
+    # Стресс-тест уровня: заезд с растущим числом машин ИИ под управлением
+    # ботов. На каждом числе после разгона STRESS_MEASURE_TIME секунд
+    # считается частота кадров, StressRamp выбирает следующее число. Итог —
+    # наибольшее число машин ИИ, при котором держится STRESS_TARGET_FPS
+    def __init__(self, level, limit):
+        super().__init__()
+        self.level = level
+        self.race_class = RACE_LEVELS[level]
+        path = self.race_class.map_path
+        self.assets = asset_registry.lease()
+        tile_map = self.assets.tilemap(path, TILE_SCALING)
+        self.background = bake_layers(path, tile_map, *tile_map.sprite_lists)
+        self.walls = tile_grid(tile_map, *self.race_class.wall_layers)
+        road_layer = self.race_class.road_layer
+        self.road_tiles = [tile.position for tile in tile_map.sprite_lists[road_layer]] if road_layer else ()
+        self.checkpoints = load_checkpoints(path)
+        self.flow_field = self.race_class.load_flow_field(path)
+        self.ramp = StressRamp(limit=limit)
+        self.batch = pyglet.graphics.Batch()
+        self.status = arcade.Text("", 10, SCREEN_HEIGHT - 30, arcade.color.YELLOW, 16, batch=self.batch)
+        self.last_round = arcade.Text("", 10, SCREEN_HEIGHT - 60, arcade.color.WHITE, 14, batch=self.batch)
+        self.results = []
+        self.start_round()
+
+    def start_round(self):
+        count = self.ramp.count
+        self.race = self.race_class(
+            walls=self.walls,
+            road_tiles=self.road_tiles,
+            checkpoints=self.checkpoints,
+            flow_field=self.flow_field,
+            ai_scheduler=AIScheduler(budget_ms=AI_DECISION_BUDGET_MS),
+            roster=self.race_class.crowd_roster(count),
+            driver=default_driver(self.level),
+            countdown=False,
+            # Стресс-тест меряет шаг той же ценой, что и в игре с HUD
+            live_standings=True
+        )
+        self.car_list, self.car_sprites = car_sprites(self.race, self.assets)
+        self.round_time = 0.0
+        self.measured_time = 0.0
+        self.frames = 0
+
+    def on_update(self, delta_time):
+        if self.ramp.done:
+            return
+        self.race.advance(delta_time)
+        self.round_time += delta_time
+        if self.round_time < STRESS_WARMUP_TIME:
+            return
+        self.frames += 1
+        self.measured_time += delta_time
+        if self.measured_time < STRESS_MEASURE_TIME:
+            return
+        fps = self.frames / self.measured_time
+        passed = fps >= STRESS_TARGET_FPS * STRESS_FPS_TOLERANCE
+        self.results.append((self.ramp.count, fps))
+        print(f"Машин ИИ: {self.ramp.count}, {fps:.1f} кадров/с, "
+              f"решения ИИ {self.race.ai_scheduler.stats()['mean_ms']:.2f} мс/кадр")
+        if self.ramp.record(passed):
+            self.start_round()
+        elif self.ramp.best is None:
+            print(f"{STRESS_TARGET_FPS} кадров/с не держится даже с {self.results[0][0]} машинами ИИ")
+        else:
+            print(f"Уровень {self.level}: {STRESS_TARGET_FPS} кадров/с держится до {self.ramp.best} машин ИИ")
+
+    def on_draw(self):
+        self.clear()
+        self.background.draw()
+        for car, sprite in self.car_sprites:
+            sprite.center_x, sprite.center_y = self.race.interpolated_position(car)
+        self.car_list.draw()
+        if self.ramp.done:
+            best = self.ramp.best or 0
+            self.status.text = f"Итог: {STRESS_TARGET_FPS} кадров/с до {best} машин ИИ (Esc — выход)"
+        else:
+            self.status.text = f"Стресс-тест, уровень {self.level}: машин ИИ {self.ramp.count}"
+        if self.results:
+            count, fps = self.results[-1]
+            self.last_round.text = f"Прошлый замер: {count} машин, {fps:.1f} кадров/с"
+        self.batch.draw()
+
+    def on_key_press(self, key, modifiers):
+        if key == arcade.key.ESCAPE:
+            arcade.exit()
+
+
+def run_stress_test(args):
+    window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE)
+    window.show_view(StressTestView(args.stress, args.stress_limit))
+    arcade.run()
+    return 0
+
+
+def run_bulk_transfer(args):
+    try:
+        if args.export_file:
+            success, result = db.export_players(args.export_file)
+        else:
+            success, result = db.import_players(args.import_file)
+        print(result)
+        return 0 if success else 1
+    finally:
+        db.close()
+
+
+def run_race_farm(args):
+    try:
+        grid = parse_grid(args.grid, args.simulate)
+    except ValueError as e:
+        print(e)
+        return 2
+    success, result = run_farm(
+        args.simulate, grid, args.races, seed=args.seed, workers=args.workers,
+        chunk_size=args.chunk_size, output=args.output
+    )
+    if not success:
+        print(result)
+    return 0 if success else 1
+
+
 def main():
+    parser = argparse.ArgumentParser(description=SCREEN_TITLE)
+    parser.add_argument("--export", dest="export_file", metavar="FILE",
+                        help="выгрузить игроков и прогресс в CSV/JSONL")
+    parser.add_argument("--import", dest="import_file", metavar="FILE",
+                        help="загрузить игроков и прогресс из CSV/JSONL")
+    parser.add_argument("--simulate", type=int, metavar="LEVEL",
+                        help="прогнать заезды уровня без окна на всех ядрах")
+    parser.add_argument("--races", type=int, default=10000,
+                        help="число заездов на каждую точку сетки")
+    parser.add_argument("--seed", type=int, default=0, help="первый seed заездов")
+    parser.add_argument("--grid", action="append", metavar="NAME=V1,V2",
+                        help=f"перебираемая настройка: {', '.join(FARM_SETTINGS)}")
+    parser.add_argument("--workers", type=int, help="число процессов (по умолчанию все ядра)")
+    parser.add_argument("--chunk-size", type=int, default=FARM_CHUNK_SIZE,
+                        help="заездов в одном задании процесса")
+    parser.add_argument("--output", metavar="FILE", help="файл JSONL для статистики")
+    parser.add_argument("--stress", type=int, choices=sorted(RACE_LEVELS), metavar="LEVEL",
+                        help=f"найти наибольшее число машин ИИ, при котором держится {STRESS_TARGET_FPS} кадров/с")
+    parser.add_argument("--stress-limit", type=int, default=1000,
+                        help="предел числа машин ИИ для стресс-теста")
+    args = parser.parse_args()
+    if args.export_file or args.import_file:
+        raise SystemExit(run_bulk_transfer(args))
+    if args.simulate is not None:
+        raise SystemExit(run_race_farm(args))
+    if args.stress is not None:
+        raise SystemExit(run_stress_test(args))
+
     window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE)
     menu_view = MainMenuView()
     window.show_view(menu_view)
-    arcade.run()
-    db.close()
+    db.warm_up()
+    try:
+        arcade.run()
+    finally:
+        # Дожидаемся записи всех отложенных изменений прогресса
+        auth_service.shutdown()
+        db.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+import pyglet
+from pyglet.media.exceptions import MediaException
+
+MUSIC_FADE = 1.5
+MUSIC_FADE_STEP = 1 / 30
+
+
+class MusicService:
+    # Фоновая музыка на всё приложение. Трек читается потоком (streaming):
+    # декодируется кусками по мере проигрывания, а не целиком в память.
+    # Плеер живёт в сервисе, а не в виде, поэтому перезапуск и смена уровня
+    # с тем же треком его не трогают; другой трек сменяет текущий плавно,
+    # громкости сводятся по часам pyglet, которые тикают в цикле arcade
+    def __init__(self, volume=1.0, fade=MUSIC_FADE):
+        self.volume = volume
+        self.fade = fade
+        self.track = None
+        self.player = None
+        self.outgoing = []
+        self.fade_time = 0.0
+        self.fading = False
+        self.loads = 0
+
+    def play(self, path):
+        if path == self.track and self.player is not None:
+            return True, self.player
+        try:
+            source = pyglet.media.load(path, streaming=True)
+        except (OSError, MediaException) as e:
+            return False, f"Не удалось открыть музыку {path}: {e}"
+        self.loads += 1
+        self.fade_out_current()
+        player = pyglet.media.Player()
+        player.loop = True
+        player.queue(source)
+        player.volume = 0.0 if self.fade else self.volume
+        player.play()
+        self.track = path
+        self.player = player
+        self.start_fade()
+        return True, player
+
+    def stop(self):
+        if self.player is None:
+            return
+        self.fade_out_current()
+        self.track = None
+        self.start_fade()
+
+    def fade_out_current(self):
+        if self.player is not None:
+            # Уходящий плеер затихает от той громкости, на которой его застали
+            self.outgoing.append((self.player, self.player.volume))
+            self.player = None
+
+    def start_fade(self):
+        self.fade_time = 0.0
+        if not self.fade:
+            self.finish_fade()
+        elif not self.fading:
+            self.fading = True
+            pyglet.clock.schedule_interval(self.step, MUSIC_FADE_STEP)
+
+    def step(self, delta_time):
+        self.fade_time += delta_time
+        progress = min(self.fade_time / self.fade, 1.0)
+        if self.player is not None:
+            self.player.volume = self.volume * progress
+        for player, volume in self.outgoing:
+            player.volume = volume * (1.0 - progress)
+        if progress >= 1.0:
+            self.finish_fade()
+
+    def finish_fade(self):
+        if self.fading:
+            pyglet.clock.unschedule(self.step)
+            self.fading = False
+        if self.player is not None:
+            self.player.volume = self.volume
+        for player, volume in self.outgoing:
+            player.delete()
+        self.outgoing = []
+
+    def stats(self):
+        return {
+            'track': self.track,
+            'players': len(self.outgoing) + (self.player is not None),
+            'loads': self.loads,
+        }
@@ -0,0 +1,186 @@
+import itertools
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from simulation import RACE_LEVELS, simulate_race
+
+FARM_CHUNK_SIZE = 250
+# Настройки, которые можно перебирать сеткой: имя -> тип значения
+FARM_SETTINGS = {
+    'ai_speed_min': float,
+    'ai_speed_max': float,
+    'player_speed': float,
+    'push_front': float,
+    'push_rear': float,
+    'push_side': float,
+    'push': float,
+    'ai_decision_interval': int,
+}
+
+
+def level_settings(level):
+    # Настройки, которые действительно читает уровень: push_front есть только
+    # у первого, push — только у второго
+    race_class = RACE_LEVELS.get(level)
+    if race_class is None:
+        return set(FARM_SETTINGS)
+    return set(FARM_SETTINGS) & set(race_class.default_settings)
+
+
+def parse_grid(values, level=None):
+    # ["ai_speed_max=3,4,5", "push=10,15"] -> список словарей настроек
+    # (декартово произведение всех значений)
+    allowed = level_settings(level)
+    axes = []
+    for value in values or ():
+        name, sep, options = value.partition("=")
+        name = name.strip()
+        if not sep or name not in FARM_SETTINGS:
+            raise ValueError(f"Неизвестный параметр сетки: {value}")
+        if name not in allowed:
+            raise ValueError(f"Параметр {name} не влияет на уровень {level}")
+        axes.append([(name, FARM_SETTINGS[name](option)) for option in options.split(",") if option])
+    return [dict(point) for point in itertools.product(*axes)]
+
+
+def roster_size(level):
+    # Сколько машин строит setup_cars по составу уровня, вместе с игроком
+    return sum(entry['count'] for entry in RACE_LEVELS[level].roster)
+
+
+def new_stats(cars):
+    return {
+        'races': 0,
+        'finished': 0,
+        'player_wins': 0,
+        'player_positions': [0] * (cars + 1),
+        'player_time_sum': 0.0,
+        'player_time_sq': 0.0,
+        'player_time_min': None,
+        'player_time_max': None,
+        'winners': {},
+    }
+
+
+def add_result(stats, result):
+    stats['races'] += 1
+    stats['finished'] += result['finished']
+    stats['player_wins'] += result['player_won']
+    stats['player_positions'][result['player_position'] or 0] += 1
+    if result['finish_order']:
+        winner = result['finish_order'][0]
+        stats['winners'][winner] = stats['winners'].get(winner, 0) + 1
+    player_time = result['player_time']
+    if player_time is not None:
+        stats['player_time_sum'] += player_time
+        stats['player_time_sq'] += player_time * player_time
+        if stats['player_time_min'] is None or player_time < stats['player_time_min']:
+            stats['player_time_min'] = player_time
+        if stats['player_time_max'] is None or player_time > stats['player_time_max']:
+            stats['player_time_max'] = player_time
+
+
+def merge_stats(total, part):
+    for key in ('races', 'finished', 'player_wins', 'player_time_sum', 'player_time_sq'):
+        total[key] += part[key]
+    total['player_positions'] = [a + b for a, b in zip(total['player_positions'], part['player_positions'])]
+    for winner, count in part['winners'].items():
+        total['winners'][winner] = total['winners'].get(winner, 0) + count
+    for key, pick in (('player_time_min', min), ('player_time_max', max)):
+        if part[key] is not None:
+            total[key] = part[key] if total[key] is None else pick(total[key], part[key])
+
+
+def summarize(stats):
+    races = stats['races']
+    timed = stats['player_positions'][1:]
+    timed_races = sum(timed)
+    mean = stats['player_time_sum'] / timed_races if timed_races else None
+    deviation = None
+    if timed_races:
+        deviation = math.sqrt(max(stats['player_time_sq'] / timed_races - mean * mean, 0.0))
+    return {
+        'races': races,
+        'finished_rate': stats['finished'] / races if races else 0.0,
+        'player_win_rate': stats['player_wins'] / races if races else 0.0,
+        'player_positions': stats['player_positions'],
+        'winners': stats['winners'],
+        'player_time_mean': mean,
+        'player_time_std': deviation,
+        'player_time_min': stats['player_time_min'],
+        'player_time_max': stats['player_time_max'],
+    }
+
+
+def run_chunk(level, settings, first_seed, count, cars):
+    # Выполняется в процессе пула: возвращает только агрегат, а не все
+    # результаты, чтобы между процессами ходило как можно меньше данных
+    stats = new_stats(cars)
+    for seed in range(first_seed, first_seed + count):
+        add_result(stats, simulate_race(level, seed, settings))
+    return stats
+
+
+def farm_chunks(grid, races, seed, chunk_size):
+    for point_index, settings in enumerate(grid):
+        for offset in range(0, races, chunk_size):
+            yield point_index, settings, seed + offset, min(chunk_size, races - offset)
+
+
+def run_farm(level, grid, races, seed=0, workers=None, chunk_size=FARM_CHUNK_SIZE,
+             output=None, report=print):
+    # Каждая точка сетки получает одни и те же seed, так что точки сравниваются
+    # на одинаковых заездах. После каждого готового куска в output дописывается
+    # строка JSON с текущим агрегатом этой точки
+    if level not in RACE_LEVELS:
+        return False, f"Нет уровня {level}"
+    allowed = level_settings(level)
+    for settings in grid or ():
+        unknown = sorted(set(settings) - allowed)
+        if unknown:
+            return False, f"Параметры {', '.join(unknown)} не влияют на уровень {level}"
+    workers = workers or os.cpu_count() or 1
+    grid = grid or [{}]
+    cars = roster_size(level)
+    totals = [new_stats(cars) for _ in grid]
+    chunks = farm_chunks(grid, races, seed, chunk_size)
+    stream = open(output, "w", encoding="utf-8") if output else sys.stdout
+    start = time.perf_counter()
+    done_races = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # В работе держим не больше двух кусков на процесс, остальные
+            # выдаются по мере освобождения
+            pending = {}
+            for point_index, settings, first_seed, count in itertools.islice(chunks, workers * 2):
+                pending[executor.submit(run_chunk, level, settings, first_seed, count, cars)] = point_index
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    point_index = pending.pop(future)
+                    part = future.result()
+                    merge_stats(totals[point_index], part)
+                    done_races += part['races']
+                    record = {
+                        'level': level,
+                        'settings': grid[point_index],
+                        'done': totals[point_index]['races'] >= races,
+                    }
+                    record.update(summarize(totals[point_index]))
+                    stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    stream.flush()
+                for point_index, settings, first_seed, count in itertools.islice(chunks, len(finished)):
+                    pending[executor.submit(run_chunk, level, settings, first_seed, count, cars)] = point_index
+    finally:
+        if output:
+            stream.close()
+    elapsed = time.perf_counter() - start
+    rate = done_races / elapsed if elapsed else 0.0
+    if output:
+        report(f"Заездов: {done_races} за {elapsed:.1f} сек ({rate:.0f} заездов/сек, "
+               f"процессов {workers}), результаты в {output}")
+    return True, [summarize(stats) for stats in totals]
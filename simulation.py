@@ -0,0 +1,1151 @@
+import bisect
+import copy
+import math
+import operator
+import os
+import random
+import time
+
+from track import (DEFAULT_TILE_SIZE, OccupancyGrid, ProgressIndex, load_checkpoints, load_flow_field,
+                   load_map_geometry, segment_crossing)
+
+SCREEN_WIDTH = 960
+SCREEN_HEIGHT = 800
+CAR_SPEED_LEVEL_1 = 5
+CAR_SPEED_LEVEL_2 = 7
+AI_CAR_SPEED_MIN = 2.0
+AI_CAR_SPEED_MAX = 4.0
+SIMULATION_FPS = 60
+FIXED_DT = 1 / SIMULATION_FPS
+COUNTDOWN_TIME = 3.0
+MAX_RACE_TIME = 120.0
+MAX_FRAME_TIME = 0.25
+# Бюджет решений ИИ на кадр в игре с окном
+AI_DECISION_BUDGET_MS = 2.0
+# Меньше стольких машин в заезде сетка столкновений дороже прямого перебора пар
+SPATIAL_HASH_MIN_CARS = 16
+WIGGLE_OFFSETS = ((0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+def crossing_fraction(start, end, line):
+    # Доля шага (0, 1], на которой координата дошла до линии, или None
+    if start == end:
+        return None
+    fraction = (line - start) / (end - start)
+    return fraction if 0 < fraction <= 1 else None
+
+
+def spawn_points(count, start, end):
+    # count мест равномерной сеткой в прямоугольнике между углами start и end,
+    # рядами от start. Если прямоугольник вырожден в отрезок, места идут
+    # вдоль отрезка
+    (x1, y1), (x2, y2) = start, end
+    width, height = abs(x2 - x1), abs(y2 - y1)
+    if not height:
+        columns = count
+    elif not width:
+        columns = 1
+    else:
+        columns = min(max(round(math.sqrt(count * width / height)), 1), count)
+    rows = math.ceil(count / columns) if count else 0
+    points = []
+    for index in range(count):
+        row, column = divmod(index, columns)
+        along_x = column / (columns - 1) if columns > 1 else 0.0
+        along_y = row / (rows - 1) if rows > 1 else 0.0
+        points.append((x1 + (x2 - x1) * along_x, y1 + (y2 - y1) * along_y))
+    return points
+
+
+class Car:
+    # Состояние машины без привязки к arcade.Sprite. width/height — размер
+    # хитбокса для столкновений со стенами. __slots__ убирает словарь
+    # атрибутов: в горячем цикле меньше памяти и быстрее доступ к полям
+    __slots__ = (
+        'color_name', 'center_x', 'center_y', 'previous_x', 'previous_y', 'width', 'height',
+        'change_x', 'change_y', 'is_player', 'ai_speed', 'has_finished', 'finish_position',
+        'collision_radius', 'car_length', 'car_width', 'front_bumper_y', 'rear_bumper_y',
+        'next_gate', 'lap', 'progress', 'place', 'heading_x', 'heading_y', 'pending_deviation',
+        'sprite',
+    )
+    # Поля, которые меняются по ходу заезда и попадают в снимок состояния
+    STATE_FIELDS = (
+        'center_x', 'center_y', 'previous_x', 'previous_y', 'change_x', 'change_y', 'ai_speed',
+        'has_finished', 'finish_position', 'front_bumper_y', 'rear_bumper_y',
+        'next_gate', 'lap', 'progress', 'place', 'heading_x', 'heading_y', 'pending_deviation',
+    )
+    _read_state = staticmethod(operator.attrgetter(*STATE_FIELDS))
+
+    def __init__(self, color_name, x, y, width, height, is_player=False, ai_speed=0.0,
+                 car_length=0, car_width=0, collision_radius=25, sprite=None):
+        self.color_name = color_name
+        # (файл текстуры, масштаб) для окна; модель заезда его не читает
+        self.sprite = sprite
+        self.center_x = x
+        self.center_y = y
+        self.previous_x = x
+        self.previous_y = y
+        self.width = width
+        self.height = height
+        self.change_x = 0
+        self.change_y = 0
+        self.is_player = is_player
+        self.ai_speed = ai_speed
+        self.has_finished = False
+        self.finish_position = 0
+        self.collision_radius = collision_radius
+        self.car_length = car_length
+        self.car_width = car_width
+        self.front_bumper_y = 0
+        self.rear_bumper_y = 0
+        # Ворота 0 — стартовые, машина стоит на них с самого начала
+        self.next_gate = 1
+        self.lap = 0
+        self.progress = 0.0
+        self.place = 0
+        # Последнее решение ИИ: направление движения и отклонение, которое
+        # ещё не применено
+        self.heading_x = 0.0
+        self.heading_y = 0.0
+        self.pending_deviation = 0.0
+
+    def get_state(self):
+        return self._read_state(self)
+
+    def set_state(self, state):
+        for name, value in zip(self.STATE_FIELDS, state):
+            setattr(self, name, value)
+
+
+class SpatialHash:
+    # Широкая фаза столкновений машин: равномерная сетка с ячейкой не меньше
+    # дистанции взаимодействия. Пары ищутся только в соседних ячейках, и
+    # каждая пара выдаётся один раз, в порядке индексов машин
+    NEIGHBOURS = ((1, -1), (1, 0), (1, 1), (0, 1))
+
+    def __init__(self, cell_size=0):
+        self.cell_size = cell_size
+
+    def pairs(self, cars):
+        cell_size = self.cell_size or 1
+        cells = {}
+        for index, car in enumerate(cars):
+            key = (int(car.center_x // cell_size), int(car.center_y // cell_size))
+            cells.setdefault(key, []).append(index)
+        pairs = []
+        for (cell_x, cell_y), members in cells.items():
+            for position, first in enumerate(members):
+                for second in members[position + 1:]:
+                    pairs.append((first, second))
+            for offset_x, offset_y in self.NEIGHBOURS:
+                others = cells.get((cell_x + offset_x, cell_y + offset_y))
+                if others:
+                    for first in members:
+                        for second in others:
+                            pairs.append((first, second) if first < second else (second, first))
+        pairs.sort()
+        return [(cars[first], cars[second]) for first, second in pairs]
+
+
+class AIScheduler:
+    # Решения ИИ (броски случайных отклонений, выбор направления) идут реже
+    # движения: каждая машина решает раз в interval шагов, машины по кругу со
+    # сдвигом, так что за шаг решает примерно 1/interval машин. budget_ms —
+    # время решений на кадр окна: Race.advance открывает кадр (begin_frame),
+    # и все его шаги физики делят один бюджет. Машины, не успевшие решить,
+    # решают в следующих шагах. Вызов run вне кадра (step без advance)
+    # считается отдельным кадром. Без бюджета порядок решений зависит только
+    # от номера шага, и заезд воспроизводим по seed. Часы читаются только при
+    # бюджете или measure=True (замеры): безголовым заездам время не нужно
+    def __init__(self, interval=1, budget_ms=None, clock=time.perf_counter, measure=False):
+        self.interval = max(int(interval), 1)
+        self.budget_ms = budget_ms
+        self.clock = clock
+        self.timed = budget_ms is not None or measure
+        self.cursor = 0
+        self.deferred = 0
+        self.frames = 0
+        self.decisions = 0
+        self.over_budget = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+        self.peak_ms = 0.0
+        self.in_frame = False
+        self.frame_ms = 0.0
+
+    def begin_frame(self):
+        self.in_frame = True
+        self.frame_ms = 0.0
+
+    def end_frame(self):
+        self.in_frame = False
+        cost = self.frame_ms
+        self.frames += 1
+        self.total_ms += cost
+        self.last_ms = cost
+        self.peak_ms = max(self.peak_ms, cost)
+        if self.budget_ms is not None and cost > self.budget_ms:
+            self.over_budget += 1
+
+    def run(self, cars, decide):
+        count = len(cars)
+        if not count:
+            return
+        if not self.timed:
+            quota = math.ceil(count / self.interval)
+            for offset in range(quota):
+                car = cars[(self.cursor + offset) % count]
+                if not car.has_finished:
+                    decide(car)
+                    self.decisions += 1
+            self.cursor = (self.cursor + quota) % count
+            return
+        own_frame = not self.in_frame
+        if own_frame:
+            self.begin_frame()
+        quota = min(math.ceil(count / self.interval) + self.deferred, count)
+        clock = self.clock
+        start = clock()
+        # Дедлайн — остаток бюджета кадра после предыдущих шагов
+        deadline = None
+        if self.budget_ms is not None:
+            deadline = start + (self.budget_ms - self.frame_ms) / 1000
+        done = 0
+        while done < quota:
+            if deadline is not None and clock() >= deadline:
+                break
+            car = cars[(self.cursor + done) % count]
+            done += 1
+            if not car.has_finished:
+                decide(car)
+                self.decisions += 1
+        self.cursor = (self.cursor + done) % count
+        self.deferred = quota - done
+        self.frame_ms += (clock() - start) * 1000
+        if own_frame:
+            self.end_frame()
+
+    def get_state(self):
+        return self.cursor, self.deferred
+
+    def set_state(self, state):
+        self.cursor, self.deferred = state
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'budget_ms': self.budget_ms,
+            'frames': self.frames,
+            'decisions': self.decisions,
+            'mean_ms': self.total_ms / self.frames if self.frames else 0.0,
+            'last_ms': self.last_ms,
+            'peak_ms': self.peak_ms,
+            'over_budget': self.over_budget,
+            'deferred': self.deferred,
+        }
+
+
+class StressRamp:
+    # Подбор наибольшего числа машин ИИ, при котором держится частота кадров:
+    # число удваивается до первого провала, затем отрезок между последним
+    # успехом и провалом делится пополам, пока не станет уже precision
+    def __init__(self, start=3, limit=1000, precision=0.05):
+        self.count = start
+        self.limit = limit
+        self.precision = precision
+        self.best = None
+        self.failed = None
+        self.done = False
+
+    def record(self, passed):
+        if passed:
+            self.best = self.count
+        else:
+            self.failed = self.count
+        if self.failed is None:
+            if self.count >= self.limit:
+                self.done = True
+            else:
+                self.count = min(self.count * 2, self.limit)
+        elif self.best is None or self.failed - self.best <= max(self.best * self.precision, 1):
+            self.done = True
+        else:
+            self.count = (self.best + self.failed) // 2
+        return not self.done
+
+
+class PlayerBot:
+    # Водитель для безголовых заездов: держит клавишу в сторону финиша и
+    # раз в reaction_time секунд, как живой игрок, поправляет курс: если
+    # машина упёрлась в препятствие или ушла с полосы, жмёт поперечную клавишу
+    # в сторону центра полосы
+    def __init__(self, direction_x=0, direction_y=0, lane_center=0, lane_half_width=0,
+                 reaction_time=0.25):
+        self.direction_x = direction_x
+        self.direction_y = direction_y
+        self.lane_center = lane_center
+        self.lane_half_width = lane_half_width
+        self.reaction_time = reaction_time
+        self.next_press = 0.0
+        self.last_progress = None
+        self.side = 0
+
+    def __call__(self, race, car):
+        if race.game_time < self.next_press:
+            return
+        self.next_press = race.game_time + self.reaction_time
+        speed = race.settings['player_speed']
+        progress = car.center_x * self.direction_x + car.center_y * self.direction_y
+        lateral = car.center_y if self.direction_x else car.center_x
+        blocked = self.last_progress is not None and progress - self.last_progress < speed
+        self.last_progress = progress
+        offset = lateral - self.lane_center
+        if abs(offset) > self.lane_half_width:
+            self.side = -1 if offset > 0 else 1
+        elif blocked:
+            if not self.side:
+                self.side = -1 if offset > 0 else 1
+        else:
+            self.side = 0
+        main_x, main_y = self.direction_x * speed, self.direction_y * speed
+        side = self.side * speed
+        car.change_x = main_x if self.direction_x else side
+        car.change_y = main_y if self.direction_y else side
+
+
+class Race:
+    # Общая часть заезда: отсчёт, шаг с фиксированным dt, стены и финиш.
+    # Вся случайность идёт через self.rng, поэтому одинаковые seed и входные
+    # данные дают одинаковый результат
+    level = 1
+    map_path = None
+    wall_layers = ()
+    default_checkpoints = ()
+    # Область финиша (left, bottom, right, top) для поля направлений ИИ и
+    # половина хитбокса машины ИИ; None — уровень без поля
+    flow_target = None
+    ai_clearance = (0, 0)
+    ai_deviation_chance = 0.0
+    ai_deviation = 0
+    STATE_FIELDS = (
+        'tick', 'game_time', 'step_time', 'accumulator', 'timer', 'game_started', 'countdown_text',
+        'show_go_text', 'go_text_timer', 'race_start_time', 'race_finished',
+    )
+    road_layer = None
+    default_settings = {}
+    # Состав заезда: группы машин с числом, местами старта (сетка между двумя
+    # углами, см. spawn_points), вариантами (имя, текстура, масштаб, ширина,
+    # высота), которые идут по кругу, и разбросом скорости ИИ (None — от
+    # ai_speed_min до ai_speed_max из настроек)
+    roster = ()
+    # Площадка старта для толпы машин ИИ (crowd_roster)
+    crowd_spawn = None
+
+    def __init__(self, seed=None, settings=None, walls=None, road_tiles=(), driver=None,
+                 dt=FIXED_DT, countdown=True, checkpoints=None, flow_field=None, ai_scheduler=None,
+                 roster=None, live_standings=False):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.settings = dict(self.default_settings, **(settings or {}))
+        self.walls = walls if walls is not None else OccupancyGrid(DEFAULT_TILE_SIZE)
+        self.roster = roster or self.roster
+        self.flow_field = flow_field
+        self.ai_scheduler = ai_scheduler or AIScheduler(self.settings['ai_decision_interval'])
+        # Шанс отклонения на одно решение: при решениях раз в interval шагов
+        # отклонения случаются так же часто, как при решении каждый шаг
+        self.ai_decision_chance = 1 - (1 - self.ai_deviation_chance) ** self.ai_scheduler.interval
+        self.driver = driver
+        self.dt = dt
+        self.step_time = dt
+        self.accumulator = 0.0
+        self.tick = 0
+        self.timer = COUNTDOWN_TIME if countdown else 0.0
+        self.game_started = False
+        self.countdown_text = "3" if countdown else ""
+        self.show_go_text = False
+        self.go_text_timer = 0
+        self.game_time = 0
+        self.race_start_time = 0
+        self.race_finished = False
+        self.finish_order = []
+        self.finish_times = {}
+        self.cars = []
+        self.ai_cars = []
+        self.player = None
+        self.collision_grid = SpatialHash()
+        self.track = ProgressIndex(checkpoints or self.default_checkpoints, self.settings['laps'])
+        self.split_times = {}
+        # Прогресс по трассе и таблица мест нужны только для HUD: в
+        # безголовых заездах и на ферме их никто не читает, поэтому виды
+        # включают их явно. Ворота, круги и отсечки считаются всегда
+        self.live_standings = live_standings
+        self.standings = []
+        self.setup_road(road_tiles)
+        self.setup_cars()
+        self.update_standings()
+        if not countdown:
+            self.start_race()
+
+    @classmethod
+    def from_map(cls, path=None, **kwargs):
+        # Карта по умолчанию ищется рядом с модулем, а не в текущем каталоге:
+        # фермы заездов и замеры запускаются откуда угодно
+        path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), cls.map_path)
+        walls, road_tiles = load_map_geometry(path, cls.wall_layers, cls.road_layer)
+        return cls(walls=walls, road_tiles=road_tiles, checkpoints=load_checkpoints(path),
+                   flow_field=cls.load_flow_field(path), **kwargs)
+
+    @classmethod
+    def load_flow_field(cls, path):
+        if cls.flow_target is None:
+            return None
+        return load_flow_field(path, cls.wall_layers, cls.flow_target, *cls.ai_clearance)
+
+    def setup_road(self, road_tiles):
+        pass
+
+    @classmethod
+    def crowd_roster(cls, ai_count):
+        # Тот же состав, но в каждой группе ИИ ai_count машин на площадке crowd_spawn
+        return tuple(entry if entry.get('player') else dict(entry, count=ai_count, spawn=cls.crowd_spawn)
+                     for entry in cls.roster)
+
+    def setup_cars(self):
+        for entry in self.roster:
+            variants = entry['cars']
+            speed = entry.get('speed')
+            start, end = entry['spawn']
+            for index, (x, y) in enumerate(spawn_points(entry['count'], start, end)):
+                name, texture, scale, width, height = variants[index % len(variants)]
+                if index >= len(variants):
+                    name = f"{name} {index + 1}"
+                if entry.get('player'):
+                    ai_speed = 0.0
+                elif speed:
+                    ai_speed = self.rng.uniform(*speed)
+                else:
+                    ai_speed = self.random_ai_speed()
+                self.add_car(Car(name, x, y, width, height, is_player=bool(entry.get('player')),
+                                 ai_speed=ai_speed, car_length=height, car_width=width,
+                                 sprite=(texture, scale)))
+
+    def add_car(self, car):
+        self.cars.append(car)
+        if car.is_player:
+            self.player = car
+        else:
+            self.ai_cars.append(car)
+        self.standings.append(car)
+        self.split_times[car] = []
+        grid = self.collision_grid
+        grid.cell_size = max(grid.cell_size, self.interaction_size(car))
+        return car
+
+    def interaction_size(self, car):
+        raise NotImplementedError
+
+    def collision_pairs(self):
+        active = [car for car in self.cars if not car.has_finished]
+        if len(active) < SPATIAL_HASH_MIN_CARS:
+            # Тот же порядок пар, что и у сетки: по возрастанию индексов
+            return [(first, second) for index, first in enumerate(active) for second in active[index + 1:]]
+        return self.collision_grid.pairs(active)
+
+    def random_ai_speed(self):
+        return self.rng.uniform(self.settings['ai_speed_min'], self.settings['ai_speed_max'])
+
+    def start_race(self):
+        self.countdown_text = ""
+        self.game_started = True
+        self.show_go_text = True
+        self.go_text_timer = 1.0
+        self.race_start_time = self.game_time
+
+    def update_countdown(self, delta_time):
+        if not self.game_started:
+            self.timer -= delta_time
+            if self.timer > 2.0:
+                self.countdown_text = "3"
+            elif self.timer > 1.0:
+                self.countdown_text = "2"
+            elif self.timer > 0:
+                self.countdown_text = "1"
+            else:
+                self.start_race()
+
+        # Скрывать текст "ГОНКА!" через 1 секунду
+        if self.game_started and self.show_go_text:
+            self.go_text_timer -= delta_time
+            if self.go_text_timer <= 0:
+                self.show_go_text = False
+
+    def step(self, delta_time=None):
+        delta_time = self.dt if delta_time is None else delta_time
+        self.step_time = delta_time
+        # Положение в начале шага: для отрисовки между шагами и для
+        # проверки пересечения финиша по отрезку движения
+        for car in self.cars:
+            car.previous_x = car.center_x
+            car.previous_y = car.center_y
+        self.tick += 1
+        self.game_time += delta_time
+        self.update_countdown(delta_time)
+        if self.game_started and not self.race_finished:
+            if self.driver and not self.player.has_finished:
+                self.driver(self, self.player)
+            self.update_race()
+            self.update_progress()
+            if self.live_standings:
+                self.update_standings()
+
+    def on_final_lap(self, car):
+        return car.lap >= self.settings['laps'] - 1
+
+    def update_progress(self):
+        # Пересечение следующих ворот по отрезку движения за шаг: время круга
+        # и промежуточные отсечки, затем прогресс по индексу трассы
+        track = self.track
+        last_gate = len(track) - 1
+        live = self.live_standings
+        if last_gate <= 0 and not live:
+            return
+        # Без живой таблицы ворота ИИ нужны только для счёта кругов; в заезде
+        # в один круг отсечки считаются лишь игроку, они идут в результат
+        cars = self.cars if live or self.settings['laps'] > 1 else (self.player,)
+        for car in cars:
+            if car.has_finished:
+                car.progress = 1.0
+                continue
+            if last_gate > 0:
+                crossing = segment_crossing(car.previous_x, car.previous_y, car.center_x, car.center_y,
+                                            track.gates[car.next_gate])
+                if crossing is not None:
+                    self.split_times[car].append(
+                        self.game_time - self.step_time * (1 - crossing) - self.race_start_time
+                    )
+                    if car.next_gate < last_gate:
+                        car.next_gate += 1
+                    elif not self.on_final_lap(car):
+                        car.lap += 1
+                        car.next_gate = 1
+            if live:
+                car.progress = track.progress(car.center_x, car.center_y, car.next_gate, car.lap)
+
+    def update_standings(self):
+        # Таблица почти не меняется между шагами, поэтому сортировка
+        # вставками проходит её за O(n) вместо полной сортировки каждый кадр
+        standings = self.standings
+        for index in range(1, len(standings)):
+            car = standings[index]
+            key = self.standing_key(car)
+            position = index
+            while position > 0 and self.standing_key(standings[position - 1]) > key:
+                standings[position] = standings[position - 1]
+                position -= 1
+            standings[position] = car
+        for place, car in enumerate(standings, 1):
+            car.place = place
+
+    def standing_key(self, car):
+        if car.has_finished:
+            return (0, car.finish_position)
+        return (1, -car.progress)
+
+    def advance(self, frame_time):
+        # Накопитель для окна: сколько бы кадров в секунду ни было, физика
+        # шагает ровно по self.dt. Долгий кадр обрезается до MAX_FRAME_TIME,
+        # чтобы после подвисания не догонять сотнями шагов
+        self.accumulator += min(frame_time, MAX_FRAME_TIME)
+        self.ai_scheduler.begin_frame()
+        steps = 0
+        while self.accumulator >= self.dt:
+            if self.race_finished:
+                # Заезд окончен: остаток кадра не нужен, рисуем итоговые позиции
+                self.accumulator = 0.0
+                for car in self.cars:
+                    car.previous_x = car.center_x
+                    car.previous_y = car.center_y
+                break
+            self.step()
+            self.accumulator -= self.dt
+            steps += 1
+        self.ai_scheduler.end_frame()
+        return steps
+
+    def interpolated_position(self, car):
+        # Позиция для отрисовки между двумя последними шагами физики
+        alpha = self.accumulator / self.dt
+        return (car.previous_x + (car.center_x - car.previous_x) * alpha,
+                car.previous_y + (car.center_y - car.previous_y) * alpha)
+
+    def update_race(self):
+        raise NotImplementedError
+
+    def hits_wall(self, car):
+        half_width = car.width / 2
+        half_height = car.height / 2
+        return self.walls.overlaps(car.center_x - half_width, car.center_y - half_height,
+                                   car.center_x + half_width, car.center_y + half_height)
+
+    def wiggle_until_free(self, car):
+        # Как в arcade: пробуем сдвиги вверх, вниз, вправо, влево и по
+        # диагоналям, удваивая расстояние, пока машина не окажется свободной
+        original_x = car.center_x
+        original_y = car.center_y
+        distance = 1
+        while distance < 1024:
+            for offset_x, offset_y in WIGGLE_OFFSETS:
+                car.center_x = original_x + offset_x * distance
+                car.center_y = original_y + offset_y * distance
+                if not self.hits_wall(car):
+                    return
+            distance *= 2
+        car.center_x = original_x
+        car.center_y = original_y
+
+    def move_car(self, car):
+        # Повторяет поведение arcade.PhysicsEngineSimple: сначала ось y с
+        # откатом до свободного места и обнулением скорости, затем ось x.
+        # Сдвиг длиннее тайла делится на части не длиннее тайла, чтобы
+        # быстрая машина не проскочила сквозь стену или камень за один шаг
+        if self.hits_wall(car):
+            self.wiggle_until_free(car)
+
+        if car.change_y:
+            parts = self.sweep_parts(car.change_y)
+            part_y = car.change_y / parts
+            for _ in range(parts):
+                car.center_y += part_y
+                if self.hits_wall(car):
+                    if part_y > 0:
+                        while self.hits_wall(car):
+                            car.center_y -= 1
+                    else:
+                        while self.hits_wall(car):
+                            car.center_y += 0.25
+                    car.change_y = 0
+                    break
+            car.center_y = round(car.center_y, 2)
+
+        if car.change_x:
+            direction = 1 if car.change_x > 0 else -1
+            parts = self.sweep_parts(car.change_x)
+            part_x = abs(car.change_x) / parts
+            for _ in range(parts):
+                original_x = car.center_x
+                distance = part_x
+                car.center_x = original_x + distance * direction
+                while distance > 0 and self.hits_wall(car):
+                    distance = max(distance - 1, 0)
+                    car.center_x = original_x + distance * direction
+                if distance < part_x:
+                    break
+
+    def sweep_parts(self, distance):
+        return max(math.ceil(abs(distance) / self.walls.cell_size), 1)
+
+    def record_finish(self, car, crossing=1.0):
+        # crossing — доля шага, на которой машина пересекла финиш: время
+        # считается внутри кадра, и порядок финиша в одном шаге идёт по нему
+        car.has_finished = True
+        if car.is_player:
+            car.change_x = 0
+            car.change_y = 0
+        else:
+            car.ai_speed = 0
+        finish_time = self.game_time - self.step_time * (1 - crossing) - self.race_start_time
+        self.finish_times[car] = finish_time
+        # Финиш — последняя отсечка: ворота финиша после него уже не проверяются
+        self.split_times[car].append(finish_time)
+        bisect.insort(self.finish_order, car, key=self.finish_times.__getitem__)
+        for position, finished_car in enumerate(self.finish_order, 1):
+            finished_car.finish_position = position
+        if all(other.has_finished for other in self.cars):
+            self.race_finished = True
+
+    def snapshot(self):
+        # Снимок всего изменяемого состояния: кортежи полей машин, копии
+        # списков финиша и состояние генератора. Машины остаются теми же
+        # объектами, поэтому restore() не ломает ссылки вида на них
+        return (
+            tuple(getattr(self, name) for name in self.STATE_FIELDS),
+            self.rng.getstate(),
+            [car.get_state() for car in self.cars],
+            list(self.finish_order),
+            dict(self.finish_times),
+            copy.copy(self.driver),
+            list(self.standings),
+            {car: list(splits) for car, splits in self.split_times.items()},
+            self.ai_scheduler.get_state(),
+        )
+
+    def restore(self, snapshot):
+        (fields, rng_state, car_states, finish_order, finish_times, driver, standings, splits,
+         scheduler_state) = snapshot
+        for name, value in zip(self.STATE_FIELDS, fields):
+            setattr(self, name, value)
+        self.rng.setstate(rng_state)
+        for car, state in zip(self.cars, car_states):
+            car.set_state(state)
+        self.finish_order = list(finish_order)
+        self.finish_times = dict(finish_times)
+        self.driver = copy.copy(driver)
+        self.standings = list(standings)
+        self.split_times = {car: list(times) for car, times in splits.items()}
+        self.ai_scheduler.set_state(scheduler_state)
+
+    def run(self, max_time=MAX_RACE_TIME):
+        while not self.race_finished and self.game_time - self.race_start_time < max_time:
+            self.step()
+        return self.results()
+
+    def results(self):
+        player = self.player
+        return {
+            'level': self.level,
+            'seed': self.seed,
+            'finished': self.race_finished,
+            'ticks': self.tick,
+            'finish_order': [car.color_name for car in self.finish_order],
+            'finish_times': [self.finish_times[car] for car in self.finish_order],
+            'player_position': player.finish_position if player.has_finished else None,
+            'player_time': self.finish_times.get(player),
+            'player_won': bool(self.finish_order) and self.finish_order[0] is player,
+            'player_splits': list(self.split_times.get(player, ())),
+        }
+
+
+class LevelOneRace(Race):
+    # Уровень 1 (GameView): заезд сверху вниз по трассе carr2.tmx
+    level = 1
+    map_path = "carr2.tmx"
+    wall_layers = ("collisions",)
+    road_layer = "trassa"
+    default_settings = {
+        'ai_speed_min': AI_CAR_SPEED_MIN,
+        'ai_speed_max': AI_CAR_SPEED_MAX,
+        'player_speed': CAR_SPEED_LEVEL_1,
+        'push_front': 20,
+        'push_rear': 15,
+        'push_side': 10,
+        'laps': 1,
+        'ai_decision_interval': 1,
+    }
+    # Без слоя checkpoints в карте: старт на линии машин и линия финиша
+    default_checkpoints = ((200, 700, 760, 700), (200, 150, 760, 150))
+    finish_line_y = 150
+    finish_line_x_start = 200
+    finish_line_x_end = 760
+    ai_deviation_chance = 0.03
+    ai_deviation = 10
+    roster = (
+        {'player': True, 'count': 1, 'spawn': ((450, 700), (450, 700)),
+         'cars': (("Желтая (Вы)", "car_yellow (12).png", 0.2, 30, 60),)},
+        {'count': 2, 'spawn': ((300, 700), (600, 700)), 'speed': None,
+         'cars': (("Красная", "car_red12.png", 0.08, 12, 24),
+                  ("Синяя", "car_blue123.png", 0.08, 12, 24))},
+    )
+    # Толпа стоит рядами за линией старта и заезжает на экран сверху
+    crowd_spawn = ((220, 700), (740, 1400))
+
+    def setup_road(self, road_tiles):
+        if road_tiles:
+            min_x = min(x for x, y in road_tiles)
+            max_x = max(x for x, y in road_tiles)
+            padding = (max_x - min_x) * 0.05
+            self.road_limits = (min_x + padding, max_x - padding)
+        else:
+            self.road_limits = (200, 760)
+
+    def interaction_size(self, car):
+        # Бамперы и ширина: дальше этого расстояния по любой оси машины не касаются
+        return max(car.car_length, car.car_width)
+
+    def update_car_bumpers(self, car):
+        half_length = car.car_length / 2
+        car.front_bumper_y = car.center_y - half_length
+        car.rear_bumper_y = car.center_y + half_length
+
+    def update_geometry(self):
+        # Бамперы считаются один раз за шаг, после движения машин; дальше их
+        # обновляет только handle_collision у тех машин, которые сдвинул
+        for car in self.cars:
+            self.update_car_bumpers(car)
+
+    def check_car_collision_front_rear(self, car1, car2):
+        if car1.has_finished or car2.has_finished:
+            return False
+        half_width1 = car1.car_width / 2
+        half_width2 = car2.car_width / 2
+
+        x_overlap = abs(car1.center_x - car2.center_x) < (half_width1 + half_width2)
+
+        if not x_overlap:
+            return False
+        front_to_rear = (car1.front_bumper_y <= car2.rear_bumper_y and
+                         car1.front_bumper_y >= car2.front_bumper_y)
+
+        rear_to_front = (car1.rear_bumper_y >= car2.front_bumper_y and
+                         car1.rear_bumper_y <= car2.rear_bumper_y)
+
+        side_by_side = (car1.rear_bumper_y > car2.front_bumper_y and
+                        car1.front_bumper_y < car2.rear_bumper_y)
+
+        return front_to_rear or rear_to_front or side_by_side
+
+    def check_car_collisions(self):
+        # Один проход за шаг: каждая пара из широкой фазы проверяется один раз
+        for car1, car2 in self.collision_pairs():
+            if self.check_car_collision_front_rear(car1, car2):
+                self.handle_collision(car1, car2)
+
+    def handle_collision(self, car1, car2):
+        player_speed = self.settings['player_speed']
+        ai_speed_min = self.settings['ai_speed_min']
+        ai_speed_max = self.settings['ai_speed_max']
+
+        # тип столкновения
+        front_to_rear = car1.front_bumper_y <= car2.rear_bumper_y and car1.front_bumper_y >= car2.front_bumper_y
+        rear_to_front = car1.rear_bumper_y >= car2.front_bumper_y and car1.rear_bumper_y <= car2.rear_bumper_y
+        if front_to_rear:
+            push_strength = self.settings['push_front']
+            if car1.is_player:
+                car1.change_y *= 0.3
+            else:
+                car1.ai_speed *= 0.4
+            if car2.is_player:
+                car2.change_y = min(car2.change_y - 3, -player_speed)
+            else:
+                car2.ai_speed = min(car2.ai_speed * 1.5, ai_speed_max * 2)
+
+        elif rear_to_front:
+            # car1 врезается спереди в car2
+            push_strength = self.settings['push_rear']
+            if car1.is_player:
+                car1.change_y *= 0.5
+            else:
+                car1.ai_speed *= 0.6
+            if car2.is_player:
+                car2.change_y = max(car2.change_y + 2, player_speed)
+            else:
+                car2.ai_speed = max(car2.ai_speed * 0.8, ai_speed_min)
+        else:
+            # Боковое столкновение
+            push_strength = self.settings['push_side']
+            if car1.is_player:
+                car1.change_y *= 0.7
+            else:
+                car1.ai_speed *= 0.8
+            if car2.is_player:
+                car2.change_y *= 0.7
+            else:
+                car2.ai_speed *= 0.8
+
+        # Горизонтальное отталкивание
+        dx = car2.center_x - car1.center_x
+        if dx != 0:
+            push_x = push_strength * 0.3 * (1 if dx > 0 else -1)
+            car1.center_x -= push_x
+            car2.center_x += push_x
+
+        # Вертикальное отталкивание
+        dy = car2.center_y - car1.center_y
+        if dy != 0:
+            push_y = push_strength * (1 if dy > 0 else -1)
+            car1.center_y -= push_y
+            car2.center_y += push_y
+            self.update_car_bumpers(car1)
+            self.update_car_bumpers(car2)
+        self.keep_car_on_road(car1)
+        self.keep_car_on_road(car2)
+
+    def keep_car_on_road(self, car):
+        left_limit, right_limit = self.road_limits
+        if car.center_x < left_limit:
+            car.center_x = left_limit + 5
+            if not car.is_player and not car.has_finished:
+                car.ai_speed *= 0.95
+            elif car.is_player and not car.has_finished:
+                car.change_x = 0
+
+        elif car.center_x > right_limit:
+            car.center_x = right_limit - 5
+            if not car.is_player and not car.has_finished:
+                car.ai_speed *= 0.95
+            elif car.is_player and not car.has_finished:
+                car.change_x = 0
+
+    def check_finish_line(self, car):
+        # Возвращает долю шага, на которой передний бампер пересёк линию
+        # финиша в пределах её ширины, или None. Проверяется весь отрезок
+        # движения за шаг, так что быстрая машина не проскочит линию
+        if car.has_finished or not self.on_final_lap(car):
+            return None
+        previous_front = car.previous_y - car.car_length / 2
+        crossing = crossing_fraction(previous_front, car.front_bumper_y, self.finish_line_y)
+        if crossing is not None:
+            x = car.previous_x + (car.center_x - car.previous_x) * crossing
+            if self.finish_line_x_start <= x <= self.finish_line_x_end:
+                return crossing
+        # Машина уже за линией (пересекла её сбоку от финиша) и въехала в створ.
+        # На кольце за линией стоит каждая машина после круга, там это не финиш
+        if self.settings['laps'] > 1:
+            return None
+        if not (self.finish_line_x_start <= car.center_x <= self.finish_line_x_end):
+            return None
+        return 1.0 if car.front_bumper_y <= self.finish_line_y else None
+
+    def handle_finish(self, car, crossing=1.0):
+        if not car.has_finished:
+            car.center_y = self.finish_line_y - 5
+            self.record_finish(car, crossing)
+
+    def move_ai_cars(self):
+        for ai_car in self.ai_cars:
+            if not ai_car.has_finished:
+                ai_car.center_y -= ai_car.ai_speed
+
+    def decide_ai_car(self, ai_car):
+        # Небольшие случайные отклонения
+        if self.rng.random() < self.ai_decision_chance:
+            ai_car.pending_deviation = self.rng.uniform(-self.ai_deviation, self.ai_deviation)
+
+    def update_ai_cars(self):
+        self.ai_scheduler.run(self.ai_cars, self.decide_ai_car)
+        for ai_car in self.ai_cars:
+            if ai_car.has_finished:
+                continue
+
+            deviation = ai_car.pending_deviation
+            if deviation:
+                ai_car.pending_deviation = 0.0
+                new_x = ai_car.center_x + deviation
+
+                left_limit, right_limit = self.road_limits
+                if left_limit <= new_x <= right_limit:
+                    ai_car.center_x = new_x
+                else:
+                    ai_car.center_x += -deviation * 0.3
+
+            self.keep_car_on_road(ai_car)
+            crossing = self.check_finish_line(ai_car)
+            if crossing is not None:
+                self.handle_finish(ai_car, crossing)
+
+    def update_race(self):
+        for car in self.cars:
+            self.move_car(car)
+        self.move_ai_cars()
+        self.update_geometry()
+        self.check_car_collisions()
+        self.update_ai_cars()
+        player = self.player
+        if not player.has_finished:
+            self.keep_car_on_road(player)
+
+            # Проверяем финиш игрока
+            crossing = self.check_finish_line(player)
+            if crossing is not None:
+                self.handle_finish(player, crossing)
+
+
+class LevelTwoRace(Race):
+    # Уровни 2 и 3 (SecondLevel): заезд слева направо по карте does.tmx с камнями
+    level = 2
+    map_path = "does.tmx"
+    wall_layers = ("collisions", "rocs")
+    default_settings = {
+        'ai_speed_min': AI_CAR_SPEED_MIN,
+        'ai_speed_max': AI_CAR_SPEED_MAX,
+        'player_speed': CAR_SPEED_LEVEL_2,
+        'push': 15,
+        'laps': 1,
+        'ai_decision_interval': 1,
+    }
+    default_checkpoints = ((50, 0, 50, SCREEN_HEIGHT), (900, 200, 900, 600))
+    finish_line_x = 900
+    finish_line_y_start = 200
+    finish_line_y_end = 600
+    flow_target = (finish_line_x, finish_line_y_start, SCREEN_WIDTH, finish_line_y_end)
+    ai_clearance = (51, 25)
+    ai_deviation_chance = 0.04
+    ai_deviation = 15
+    ai_lane = (100, 700)
+    bounds_margin = 20
+    roster = (
+        {'player': True, 'count': 1, 'spawn': ((50, 650), (50, 650)),
+         'cars': (("Желтая (Вы)", "car_yellow (1).png", 0.2, 102, 48),)},
+        {'count': 2, 'spawn': ((50, 430), (50, 250)), 'speed': None,
+         'cars': (("Красная", "car_red1.png", 0.08, 102, 50),
+                  ("Синяя", "car_blue1.png", 0.08, 100, 49))},
+    )
+    # Слева за краем экрана стоять нельзя (keep_car_in_bounds), поэтому
+    # толпа занимает начало полосы между стенами
+    crowd_spawn = ((40, 620), (400, 260))
+
+    def interaction_size(self, car):
+        return 2 * car.collision_radius
+
+    def check_car_collision(self, car1, car2):
+        if car1.has_finished or car2.has_finished:
+            return False
+        dx = car1.center_x - car2.center_x
+        dy = car1.center_y - car2.center_y
+        collision_distance = car1.collision_radius + car2.collision_radius
+        return dx * dx + dy * dy < collision_distance * collision_distance
+
+    def handle_car_collision(self, car1, car2):
+        dx = car2.center_x - car1.center_x
+        dy = car2.center_y - car1.center_y
+        distance = math.sqrt(dx * dx + dy * dy)
+        if distance == 0:
+            dx = self.rng.uniform(-1, 1)
+            dy = self.rng.uniform(-1, 1)
+            distance = math.sqrt(dx * dx + dy * dy)
+        dx /= distance
+        dy /= distance
+        push_strength = self.settings['push']
+        # Как на первом уровне, удар не гасит ИИ ниже минимальной скорости:
+        # поле ведёт обе машины в одни проходы между камнями, и без нижней
+        # границы они дотормаживают друг друга до полной остановки
+        ai_speed_min = self.settings['ai_speed_min']
+
+        if car1.is_player:
+            car1.change_x -= dx * push_strength * 0.5
+            car1.change_y -= dy * push_strength * 0.5
+            car1.change_x *= 0.7
+            car1.change_y *= 0.7
+        else:
+            car1.ai_speed = max(car1.ai_speed * 0.7, ai_speed_min)
+            car1.center_x -= dx * push_strength * 0.3
+            car1.center_y -= dy * push_strength * 0.3
+
+        if car2.is_player:
+            car2.change_x += dx * push_strength * 0.5
+            car2.change_y += dy * push_strength * 0.5
+            car2.change_x *= 0.7
+            car2.change_y *= 0.7
+        else:
+            car2.ai_speed = max(car2.ai_speed * 0.7, ai_speed_min)
+            car2.center_x += dx * push_strength * 0.3
+            car2.center_y += dy * push_strength * 0.3
+
+    def check_all_car_collisions(self):
+        for car1, car2 in self.collision_pairs():
+            if self.check_car_collision(car1, car2):
+                self.handle_car_collision(car1, car2)
+
+    def keep_car_in_bounds(self, car):
+        margin = self.bounds_margin
+        ai_speed_min = self.settings['ai_speed_min']
+        if car.center_x < margin:
+            car.center_x = margin
+            if car.is_player:
+                car.change_x = max(car.change_x, 0)
+            else:
+                car.ai_speed = max(car.ai_speed * 0.8, ai_speed_min)
+        if car.center_x > SCREEN_WIDTH - margin:
+            car.center_x = SCREEN_WIDTH - margin
+            if car.is_player:
+                car.change_x = min(car.change_x, 0)
+            else:
+                car.ai_speed = max(car.ai_speed * 0.8, ai_speed_min)
+        if car.center_y < margin:
+            car.center_y = margin
+            if car.is_player:
+                car.change_y = max(car.change_y, 0)
+        if car.center_y > SCREEN_HEIGHT - margin:
+            car.center_y = SCREEN_HEIGHT - margin
+            if car.is_player:
+                car.change_y = min(car.change_y, 0)
+
+    def check_finish_line(self, car):
+        # Доля шага, на которой машина пересекла вертикальную линию финиша
+        # в пределах её высоты, или None
+        if car.has_finished or not self.on_final_lap(car):
+            return None
+        crossing = crossing_fraction(car.previous_x, car.center_x, self.finish_line_x)
+        if crossing is not None:
+            y = car.previous_y + (car.center_y - car.previous_y) * crossing
+            if self.finish_line_y_start <= y <= self.finish_line_y_end:
+                return crossing
+        if self.settings['laps'] > 1:
+            return None
+        if not (self.finish_line_y_start <= car.center_y <= self.finish_line_y_end):
+            return None
+        return 1.0 if car.center_x >= self.finish_line_x else None
+
+    def handle_finish(self, car, crossing=1.0):
+        if not car.has_finished:
+            car.center_x = self.finish_line_x - 10
+            self.record_finish(car, crossing)
+
+    def add_car(self, car):
+        # До первого решения машина ИИ едет прямо к финишу
+        car.heading_x, car.heading_y = 1.0, 0.0
+        return super().add_car(car)
+
+    def decide_ai_car(self, ai_car):
+        # Направление к финишу в обход камней из поля по клетке машины
+        if self.flow_field:
+            ai_car.heading_x, ai_car.heading_y = self.flow_field.direction(ai_car.center_x, ai_car.center_y)
+        if self.rng.random() < self.ai_decision_chance:
+            ai_car.pending_deviation = self.rng.uniform(-self.ai_deviation, self.ai_deviation)
+
+    def update_ai_cars(self):
+        self.ai_scheduler.run(self.ai_cars, self.decide_ai_car)
+        for ai_car in self.ai_cars:
+            if ai_car.has_finished:
+                continue
+
+            ai_car.center_x += ai_car.ai_speed * ai_car.heading_x
+            ai_car.center_y += ai_car.ai_speed * ai_car.heading_y
+
+            deviation = ai_car.pending_deviation
+            if deviation:
+                ai_car.pending_deviation = 0.0
+                new_y = ai_car.center_y + deviation
+                y_min, y_max = self.ai_lane
+                if y_min <= new_y <= y_max:
+                    ai_car.center_y = new_y
+                else:
+                    ai_car.center_y -= deviation * 0.5
+
+            self.keep_car_in_bounds(ai_car)
+
+            crossing = self.check_finish_line(ai_car)
+            if crossing is not None:
+                self.handle_finish(ai_car, crossing)
+
+    def update_race(self):
+        for car in self.cars:
+            self.move_car(car)
+
+        self.check_all_car_collisions()
+        self.update_ai_cars()
+
+        player = self.player
+        if not player.has_finished:
+            self.keep_car_in_bounds(player)
+
+            crossing = self.check_finish_line(player)
+            if crossing is not None:
+                self.handle_finish(player, crossing)
+
+
+RACE_LEVELS = {1: LevelOneRace, 2: LevelTwoRace, 3: LevelTwoRace}
+
+
+def default_driver(level):
+    if RACE_LEVELS[level] is LevelOneRace:
+        return PlayerBot(direction_y=-1, lane_center=480, lane_half_width=200)
+    return PlayerBot(direction_x=1, lane_center=400, lane_half_width=150)
+
+
+def simulate_race(level, seed, settings=None, countdown=False, path=None):
+    # Один безголовый заезд с ботом вместо игрока
+    race = RACE_LEVELS[level].from_map(
+        path, seed=seed, settings=settings, driver=default_driver(level), countdown=countdown
+    )
+    race.level = level
+    return race.run()
@@ -0,0 +1,106 @@
+import csv
+import json
+import sqlite3
+
+import pytest
+
+from example import SCHEMA_MIGRATIONS, GameDatabase, is_password_hash, verify_password
+
+# Дешёвые параметры scrypt, чтобы тесты не считали настоящие хэши
+HASH = {'n': 2 ** 4, 'r': 8, 'p': 1}
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = GameDatabase(str(tmp_path / "game.db"))
+    yield database
+    database.close()
+
+
+def test_migrations_from_version_zero(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA_MIGRATIONS[0]:
+        conn.execute(statement)
+    conn.executemany("INSERT INTO players (username, password) VALUES (?, ?)",
+                     [("player_one", "-"), ("player_two", "-")])
+    # Дубликаты прогресса из старой версии: остаться должна строка с наибольшим уровнем
+    conn.executemany("INSERT INTO player_progress (player_id, current_level) VALUES (?, ?)",
+                     [(1, 1), (1, 3), (1, 2), (2, 1)])
+    conn.commit()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 0
+    conn.close()
+
+    database = GameDatabase(path)
+    try:
+        database.cursor.execute("PRAGMA user_version")
+        assert database.cursor.fetchone()[0] == len(SCHEMA_MIGRATIONS)
+        database.cursor.execute("SELECT player_id, current_level FROM player_progress ORDER BY player_id")
+        assert database.cursor.fetchall() == [(1, 3), (2, 1)]
+        # Повторное открытие уже мигрированной базы ничего не применяет
+        assert database.migrate() == 0
+    finally:
+        database.close()
+
+
+def test_player_level_upsert(database):
+    success, message = database.register_player("player_one", "secret12", hash_params=HASH)
+    assert success, message
+    success, profile = database.login_player("player_one", "secret12", hash_params=HASH)
+    assert success, profile
+    for level in (2, 3):
+        assert database.update_player_level(profile['id'], level)[0]
+    database.cursor.execute("SELECT current_level FROM player_progress WHERE player_id = ?", (profile['id'],))
+    assert database.cursor.fetchall() == [(3,)]
+    assert database.get_player_profile(profile['id'])[1]['current_level'] == 3
+
+
+def test_race_best_keeps_fastest_time(database):
+    database.register_player("player_one", "secret12", hash_params=HASH)
+    player_id = database.login_player("player_one", "secret12", hash_params=HASH)[1]['id']
+    for race_time in (10.0, 8.0, 9.0):
+        assert database.record_race_result(player_id, 1, 2, race_time)[0]
+    success, (leaders, cursor) = database.get_leaderboard(1)
+    assert success
+    assert [(leader['username'], leader['best_time']) for leader in leaders] == [("player_one", 8.0)]
+
+
+@pytest.mark.parametrize("extension", ["jsonl", "csv"])
+def test_import_export_round_trip(tmp_path, database, extension):
+    source = tmp_path / "players.jsonl"
+    with open(source, "w", encoding="utf-8") as f:
+        for index in range(30):
+            f.write(json.dumps({'username': f"player_{index}", 'password': "pass1234",
+                                'current_level': index % 3 + 1}) + "\n")
+        f.write("не json\n")
+    success, summary = database.import_players(str(source), chunk_size=7, report=None, hash_params=HASH)
+    assert success, summary
+    assert (summary['imported'], summary['invalid']) == (30, 1)
+
+    exported = tmp_path / f"export.{extension}"
+    assert database.export_players(str(exported), report=None)[0]
+    text = exported.read_text(encoding="utf-8")
+    assert "pass1234" not in text
+    if extension == "csv":
+        records = list(csv.DictReader(text.splitlines()))
+    else:
+        records = [json.loads(line) for line in text.splitlines()]
+    assert len(records) == 30
+    assert all(is_password_hash(record['password']) for record in records)
+    assert verify_password("pass1234", records[0]['password'])[0]
+
+    # Выгрузка загружается в новую базу без повторного хэширования
+    restored = GameDatabase(str(tmp_path / "restored.db"))
+    try:
+        success, summary = restored.import_players(str(exported), report=None, hash_params=HASH)
+        assert success, summary
+        assert summary['imported'] == 30
+        success, profile = restored.login_player("player_4", "pass1234", hash_params=HASH)
+        assert success, profile
+        assert profile['current_level'] == 2
+    finally:
+        restored.close()
+
+    # Повторный импорт того же файла пропускает существующих игроков
+    success, summary = database.import_players(str(source), report=None, hash_params=HASH)
+    assert (summary['imported'], summary['skipped']) == (0, 30)
@@ -0,0 +1,51 @@
+import pytest
+
+from race_farm import add_result, merge_stats, new_stats, parse_grid, roster_size, run_chunk, summarize
+from simulation import RACE_LEVELS
+
+
+def result(position, player_time, winner="Желтая (Вы)"):
+    return {
+        'finished': True,
+        'player_won': position == 1,
+        'player_position': position,
+        'player_time': player_time,
+        'finish_order': [winner],
+    }
+
+
+def test_merge_stats_matches_single_pass():
+    results = [result(1, 10.0), result(2, 12.0, "Красная"), result(None, None, "Синяя"), result(3, 9.5, "Синяя")]
+    whole = new_stats(3)
+    for item in results:
+        add_result(whole, item)
+    total = new_stats(3)
+    for part_results in (results[:1], results[1:3], [], results[3:]):
+        part = new_stats(3)
+        for item in part_results:
+            add_result(part, item)
+        merge_stats(total, part)
+    assert total == whole
+    summary = summarize(total)
+    assert summary['races'] == 4
+    assert summary['player_positions'] == [1, 1, 1, 1]
+    assert summary['player_time_min'] == 9.5
+    assert summary['player_time_max'] == 12.0
+    assert summary['winners'] == {"Желтая (Вы)": 1, "Красная": 1, "Синяя": 2}
+
+
+def test_stats_sized_from_roster(monkeypatch):
+    race_class = RACE_LEVELS[2]
+    roster = (race_class.roster[0], dict(race_class.roster[1], count=5))
+    monkeypatch.setattr(race_class, "roster", roster)
+    assert roster_size(2) == 6
+    stats = run_chunk(2, {}, 0, 2, roster_size(2))
+    assert len(stats['player_positions']) == 7
+    assert stats['races'] == 2
+
+
+def test_parse_grid_rejects_settings_of_other_level():
+    assert parse_grid(["push=10,15", "ai_speed_max=3"], 2) == [
+        {'push': 10.0, 'ai_speed_max': 3.0}, {'push': 15.0, 'ai_speed_max': 3.0}]
+    with pytest.raises(ValueError):
+        parse_grid(["push_front=10"], 2)
@@ -0,0 +1,65 @@
+import itertools
+import random
+
+import pytest
+
+from simulation import MAX_RACE_TIME, RACE_LEVELS, AIScheduler, default_driver, simulate_race
+from track import ProgressIndex, segment_crossing
+
+
+def race_at_frame_rate(level, seed, frame_times):
+    race = RACE_LEVELS[level].from_map(seed=seed, driver=default_driver(level))
+    for frame_time in frame_times:
+        if race.race_finished or race.game_time > MAX_RACE_TIME:
+            break
+        race.advance(frame_time)
+    return race.results()
+
+
+@pytest.mark.parametrize("level", [1, 2])
+def test_results_do_not_depend_on_frame_rate(level):
+    jitter = random.Random(7)
+    reference = race_at_frame_rate(level, 3, itertools.repeat(1 / 60))
+    assert reference['finished']
+    for frame_times in (itertools.repeat(1 / 30), itertools.repeat(1 / 144),
+                        iter(lambda: jitter.uniform(0.005, 0.07), None)):
+        assert race_at_frame_rate(level, 3, frame_times) == reference
+
+
+@pytest.mark.parametrize("level", [1, 2])
+def test_same_seed_gives_same_race(level):
+    assert simulate_race(level, 11) == simulate_race(level, 11)
+
+
+def test_scheduler_without_budget_does_not_read_clock():
+    def clock():
+        raise AssertionError("часы без бюджета читаться не должны")
+
+    class Car:
+        has_finished = False
+
+    cars = [Car() for _ in range(5)]
+    decided = []
+    scheduler = AIScheduler(interval=2, clock=clock)
+    scheduler.run(cars, decided.append)
+    scheduler.run(cars, decided.append)
+    assert decided == cars[:3] + cars[3:] + cars[:1]
+
+
+def test_segment_crossing():
+    gate = (10, 0, 10, 20)
+    assert segment_crossing(0, 5, 20, 5, gate) == pytest.approx(0.5)
+    assert segment_crossing(0, 5, 5, 5, gate) is None
+    assert segment_crossing(0, 25, 20, 25, gate) is None
+    # Движение вдоль ворот их не пересекает
+    assert segment_crossing(10, 0, 10, 20, gate) is None
+
+
+def test_progress_index():
+    track = ProgressIndex([(0, 0, 0, 10), (10, 0, 10, 10), (30, 0, 30, 10)], laps=2)
+    assert track.lap_length == pytest.approx(30)
+    assert track.progress(0, 5, 1, 0) == pytest.approx(0.0)
+    assert track.progress(5, 5, 1, 0) == pytest.approx(5 / 30 / 2)
+    assert track.progress(20, 5, 2, 1) == pytest.approx((1 + 20 / 30) / 2)
+    # Проекция обрезается краями участка
+    assert track.progress(-50, 5, 1, 0) == pytest.approx(0.0)
@@ -0,0 +1,288 @@
+import argparse
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import arcade
+import PIL.Image
+
+from track import TILE_SCALING, OccupancyGrid, load_tile_layers
+
+# Скомпилированная карта уровня: один файл в .cache рядом с TMX, который
+# открывается через mmap. Внутри заголовок JSON и выровненные массивы:
+# номера тайлов слоёв (uint32), центры спрайтов (float32) и пиксели каждого
+# использованного тайла. Хитбоксы тайлов и сетки занятости слоёв посчитаны
+# при компиляции, поэтому при загрузке не разбирается ни XML, ни тайлсеты,
+# ни картинки, и arcade не считает хитбоксы заново. Массивы пишутся и
+# читаются модулем array, без numpy: игра не тянет его при запуске
+TILEMAP_CACHE_VERSION = 1
+TILEMAP_CACHE_MAGIC = b"TMAPCACH"
+TILEMAP_CACHE_ALIGN = 16
+# Старшие биты gid в TMX — отражения тайла
+GID_FLIPPED_HORIZONTALLY = 0x80000000
+GID_FLIPPED_VERTICALLY = 0x40000000
+GID_FLIPPED_DIAGONALLY = 0x20000000
+GID_MASK = 0x0FFFFFFF
+
+
+def cache_path(path, scaling):
+    directory = os.path.join(os.path.dirname(os.path.abspath(path)), ".cache")
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(directory, f"{name}_{scaling}.tilemap")
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def map_sources(path):
+    # Карта, её внешние тайлсеты и все картинки, от которых зависит результат
+    sources = [os.path.abspath(path)]
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        directory = os.path.dirname(os.path.abspath(current))
+        root = ET.parse(current).getroot()
+        for tileset in root.iter("tileset"):
+            source = tileset.get("source")
+            if source:
+                source = os.path.normpath(os.path.join(directory, source))
+                if source not in sources:
+                    sources.append(source)
+                    pending.append(source)
+        for image in root.iter("image"):
+            source = os.path.normpath(os.path.join(directory, image.get("source")))
+            if source not in sources:
+                sources.append(source)
+    return sources
+
+
+def source_entry(path):
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns, file_digest(path)]
+
+
+def sources_match(entries):
+    # Время правки совпало — файл тот же. Иначе (например, после checkout)
+    # решает хэш содержимого
+    for path, size, mtime_ns, digest in entries:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns != mtime_ns and file_digest(path) != digest:
+            return False
+    return True
+
+
+def flip_texture(texture, gid):
+    # Тот же порядок, что и в arcade.tilemap при загрузке TMX
+    if gid & GID_FLIPPED_DIAGONALLY:
+        texture = texture.flip_diagonally()
+    if gid & GID_FLIPPED_HORIZONTALLY:
+        texture = texture.flip_horizontally()
+    if gid & GID_FLIPPED_VERTICALLY:
+        texture = texture.flip_vertically()
+    return texture
+
+
+def compile_tilemap(path, scaling=TILE_SCALING, output=None):
+    # Карта грузится обычным arcade.load_tilemap, и его результат
+    # сохраняется как есть: спрайты слоя идут в порядке ненулевых gid, так
+    # что по gid восстанавливаются и текстура, и отражения. Возвращает
+    # загруженную карту, чтобы первый запуск не грузил её второй раз
+    sources = [source_entry(source) for source in map_sources(path)]
+    tile_map = arcade.load_tilemap(path, scaling=scaling)
+    width, height, tile_size, layers = load_tile_layers(path)
+    cell_size = tile_map.tile_width * tile_map.scaling
+
+    blobs = []
+    offset = 0
+
+    def add(data):
+        nonlocal offset
+        offset += -offset % TILEMAP_CACHE_ALIGN
+        blobs.append((offset, data))
+        start = offset
+        offset += len(data)
+        return [start, len(data)]
+
+    tiles = {}
+    header_layers = []
+    for name, sprite_list in tile_map.sprite_lists.items():
+        if name not in layers:
+            raise ValueError(f"Слой {name} в {path} не тайловый, компилировать нельзя")
+        gids = array.array("I", [gid for row in layers[name] for gid in row])
+        used = [gid for gid in gids if gid]
+        if len(used) != len(sprite_list):
+            raise ValueError(f"Слой {name} в {path}: спрайтов {len(sprite_list)}, тайлов {len(used)}")
+        positions = array.array("f", [coordinate for sprite in sprite_list for coordinate in sprite.position])
+        for gid, sprite in zip(used, sprite_list):
+            base = gid & GID_MASK
+            if base in tiles:
+                continue
+            # Пиксели и хитбокс без отражений (картинка у отражённой текстуры
+            # та же): отражения повторяются при загрузке теми же вызовами flip_*
+            texture = sprite.texture
+            if gid != base:
+                texture = arcade.Texture(texture.image)
+            image = texture.image.convert("RGBA")
+            tiles[base] = {
+                'gid': base,
+                'size': list(image.size),
+                'pixels': add(image.tobytes()),
+                'hit_box': [list(point) for point in texture.hit_box_points],
+            }
+        first = sprite_list[0] if len(sprite_list) else None
+        header_layers.append({
+            'name': name,
+            'visible': sprite_list.visible,
+            'color': list(first.color) if first else None,
+            'gids': add(gids.tobytes()),
+            'positions': add(positions.tobytes()),
+            'occupancy': OccupancyGrid.from_tiles(zip(positions[0::2], positions[1::2]), cell_size).rows,
+        })
+
+    header = json.dumps({
+        'version': TILEMAP_CACHE_VERSION,
+        'sources': sources,
+        'width': width,
+        'height': height,
+        'tile_width': tile_map.tile_width,
+        'tile_height': tile_map.tile_height,
+        'scaling': scaling,
+        'layers': header_layers,
+        'tiles': list(tiles.values()),
+    }, ensure_ascii=False).encode()
+    prefix = TILEMAP_CACHE_MAGIC + struct.pack("<I", len(header)) + header
+    base_offset = len(prefix) + (-len(prefix) % TILEMAP_CACHE_ALIGN)
+
+    output = output or cache_path(path, scaling)
+    try:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        temporary = output + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(prefix)
+            for start, data in blobs:
+                f.seek(base_offset + start)
+                f.write(data)
+        os.replace(temporary, output)
+    except OSError:
+        # Каталог только для чтения: карта уже загружена, кэш будет в другой раз
+        pass
+    return tile_map
+
+
+class CompiledTileMap:
+    # Замена arcade.TileMap для видов: sprite_lists в порядке слоёв TMX,
+    # tile_width и scaling. Массивы смотрят прямо в mmap файла, поэтому файл
+    # остаётся открытым, пока жива карта
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mapping[:len(TILEMAP_CACHE_MAGIC)] != TILEMAP_CACHE_MAGIC:
+            raise ValueError(f"{path} не кэш карты")
+        magic_end = len(TILEMAP_CACHE_MAGIC)
+        header_size, = struct.unpack_from("<I", self.mapping, magic_end)
+        header_end = magic_end + 4 + header_size
+        self.header = json.loads(self.mapping[magic_end + 4:header_end])
+        self.base_offset = header_end + (-header_end % TILEMAP_CACHE_ALIGN)
+        self.path = path
+
+    def is_fresh(self):
+        return self.header.get('version') == TILEMAP_CACHE_VERSION and sources_match(self.header['sources'])
+
+    def array(self, section, typecode):
+        start, size = section
+        start += self.base_offset
+        return memoryview(self.mapping)[start:start + size].cast(typecode).tolist()
+
+    def build(self):
+        header = self.header
+        self.width = header['width']
+        self.height = header['height']
+        self.tile_width = header['tile_width']
+        self.tile_height = header['tile_height']
+        self.scaling = header['scaling']
+        view = memoryview(self.mapping)
+        base_textures = {}
+        for tile in header['tiles']:
+            start, size = tile['pixels']
+            image = PIL.Image.frombuffer("RGBA", tuple(tile['size']),
+                                         view[self.base_offset + start:self.base_offset + start + size],
+                                         "raw", "RGBA", 0, 1)
+            base_textures[tile['gid']] = arcade.Texture(
+                image, hit_box_points=[tuple(point) for point in tile['hit_box']],
+                hash=f"tilemap:{self.path}:{tile['gid']}")
+        textures = {}
+        self.sprite_lists = {}
+        self.occupancy = {}
+        for layer in header['layers']:
+            gids = self.array(layer['gids'], "I")
+            positions = self.array(layer['positions'], "f")
+            sprite_list = arcade.SpriteList()
+            for gid, x, y in zip([gid for gid in gids if gid], positions[0::2], positions[1::2]):
+                texture = textures.get(gid)
+                if texture is None:
+                    texture = textures[gid] = flip_texture(base_textures[gid & GID_MASK], gid)
+                sprite = arcade.Sprite(texture, self.scaling, x, y)
+                if layer['color'] and tuple(layer['color']) != (255, 255, 255, 255):
+                    sprite.color = tuple(layer['color'])
+                sprite_list.append(sprite)
+            sprite_list.visible = layer['visible']
+            self.sprite_lists[layer['name']] = sprite_list
+            self.occupancy[layer['name']] = layer['occupancy']
+        return self
+
+    def walls(self, *names):
+        rows = []
+        for name in names:
+            for index, row in enumerate(self.occupancy.get(name, ())):
+                if index >= len(rows):
+                    rows.append(0)
+                rows[index] |= row
+        return OccupancyGrid(self.tile_width * self.scaling, rows)
+
+
+def load_tilemap(path, scaling=TILE_SCALING):
+    # Свежий кэш — одно чтение через mmap; иначе карта компилируется заново
+    # (и заодно загружается обычным способом). Битый кэш просто пересобирается
+    try:
+        compiled = CompiledTileMap(cache_path(path, scaling))
+        if compiled.is_fresh():
+            return compiled.build()
+    except (OSError, ValueError, KeyError, struct.error):
+        pass
+    return compile_tilemap(path, scaling)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Компиляция карт уровней в кэш .cache")
+    parser.add_argument("maps", nargs="*", default=["carr2.tmx", "does.tmx"])
+    parser.add_argument("--scaling", type=float, default=TILE_SCALING)
+    args = parser.parse_args()
+    failed = False
+    for path in args.maps:
+        start = time.perf_counter()
+        try:
+            compile_tilemap(path, args.scaling)
+        except (OSError, ValueError) as e:
+            print(f"{path}: не скомпилирована ({e})")
+            failed = True
+            continue
+        print(f"{path}: {cache_path(path, args.scaling)} за {(time.perf_counter() - start) * 1000:.1f} мс")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
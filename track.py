@@ -0,0 +1,323 @@
+import hashlib
+import heapq
+import json
+import math
+import os
+from functools import lru_cache
+import xml.etree.ElementTree as ET
+
+TILE_SCALING = 0.5
+DEFAULT_TILE_SIZE = 64 * TILE_SCALING
+
+
+def load_tile_layers(path):
+    # Читает слои TMX (формат csv) без arcade: возвращает размер карты,
+    # размер тайла с учётом масштаба и словарь {имя слоя: строки gid сверху вниз}
+    root = ET.parse(path).getroot()
+    width = int(root.get("width"))
+    height = int(root.get("height"))
+    tile_size = int(root.get("tilewidth")) * TILE_SCALING
+    layers = {}
+    for layer in root.iter("layer"):
+        values = [int(value) for value in layer.find("data").text.split(",") if value.strip()]
+        layers[layer.get("name")] = [values[row * width:(row + 1) * width] for row in range(height)]
+    return width, height, tile_size, layers
+
+
+def map_size(path):
+    # Размер карты в тайлах из открывающего тега <map>, без разбора слоёв
+    for event, element in ET.iterparse(path, events=("start",)):
+        return int(element.get("width")), int(element.get("height"))
+
+
+def tile_center(column, row, height, tile_size):
+    # В TMX строки идут сверху вниз, а в arcade ось y направлена вверх
+    return (column + 0.5) * tile_size, (height - row - 0.5) * tile_size
+
+
+def layer_centers(layers, name, height, tile_size):
+    centers = []
+    for row, values in enumerate(layers.get(name, ())):
+        for column, gid in enumerate(values):
+            if gid:
+                centers.append(tile_center(column, row, height, tile_size))
+    return centers
+
+
+class OccupancyGrid:
+    # Неподвижные стены и камни как битовая карта тайлов: строка сетки —
+    # целое число, где бит номер column означает занятый тайл. Проверка
+    # прямоугольника машины — одна операция & на каждую задетую строку,
+    # независимо от числа стен на карте
+    def __init__(self, cell_size, rows=()):
+        self.cell_size = cell_size
+        self.rows = list(rows)
+
+    @classmethod
+    def from_tiles(cls, centers, cell_size):
+        grid = cls(cell_size)
+        for x, y in centers:
+            grid.fill(int(x // cell_size), int(y // cell_size))
+        return grid
+
+    def fill(self, column, row):
+        if column < 0 or row < 0:
+            return
+        if row >= len(self.rows):
+            self.rows.extend([0] * (row + 1 - len(self.rows)))
+        self.rows[row] |= 1 << column
+
+    def is_blocked(self, column, row):
+        return 0 <= row < len(self.rows) and column >= 0 and bool(self.rows[row] >> column & 1)
+
+    def overlaps(self, left, bottom, right, top):
+        # Строгое пересечение, как у проверки столкновений спрайтов: касание
+        # краем тайла столкновением не считается
+        rows = self.rows
+        cell_size = self.cell_size
+        first_row = int(bottom // cell_size) if bottom > 0 else 0
+        last_row = min(-int(-top // cell_size) - 1, len(rows) - 1)
+        if first_row > last_row:
+            return False
+        first_column = int(left // cell_size) if left > 0 else 0
+        last_column = -int(-right // cell_size) - 1
+        if first_column > last_column:
+            return False
+        span = ((2 << (last_column - first_column)) - 1) << first_column
+        for row in rows[first_row:last_row + 1]:
+            if row & span:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(bin(row).count("1") for row in self.rows)
+
+
+@lru_cache(maxsize=None)
+def load_map_geometry(path, wall_layers, road_layer=None):
+    # Сетка стен и центры тайлов дороги для безголовой симуляции. Если карты
+    # нет, стен и дороги нет, как при отсутствии слоёв в игре
+    if not os.path.exists(path):
+        return OccupancyGrid(DEFAULT_TILE_SIZE), ()
+    width, height, tile_size, layers = load_tile_layers(path)
+    walls = OccupancyGrid(tile_size)
+    for name in wall_layers:
+        for x, y in layer_centers(layers, name, height, tile_size):
+            walls.fill(int(x // tile_size), int(y // tile_size))
+    road = layer_centers(layers, road_layer, height, tile_size) if road_layer else []
+    return walls, tuple(road)
+
+
+@lru_cache(maxsize=None)
+def load_checkpoints(path):
+    # Ворота заезда из объектного слоя checkpoints: полилинии из двух точек,
+    # имя объекта — номер ворот (0 — старт, последние — финиш). Возвращает
+    # отрезки (x1, y1, x2, y2) в координатах arcade
+    if not os.path.exists(path):
+        return ()
+    root = ET.parse(path).getroot()
+    map_height = int(root.get("height")) * int(root.get("tileheight"))
+    gates = []
+    for group in root.iter("objectgroup"):
+        if group.get("name") != "checkpoints":
+            continue
+        for item in group.iter("object"):
+            polyline = item.find("polyline")
+            if polyline is None:
+                continue
+            origin_x, origin_y = float(item.get("x")), float(item.get("y"))
+            points = polyline.get("points").split()
+            (x1, y1), (x2, y2) = [map(float, point.split(",")) for point in (points[0], points[-1])]
+            gates.append((int(item.get("name")), (
+                (origin_x + x1) * TILE_SCALING, (map_height - origin_y - y1) * TILE_SCALING,
+                (origin_x + x2) * TILE_SCALING, (map_height - origin_y - y2) * TILE_SCALING,
+            )))
+    return tuple(gate for order, gate in sorted(gates))
+
+
+def segment_crossing(start_x, start_y, end_x, end_y, gate):
+    # Доля отрезка движения (0, 1], на которой он пересёк ворота, или None
+    x1, y1, x2, y2 = gate
+    move_x, move_y = end_x - start_x, end_y - start_y
+    gate_x, gate_y = x2 - x1, y2 - y1
+    denominator = move_x * gate_y - move_y * gate_x
+    if denominator == 0:
+        return None
+    offset_x, offset_y = x1 - start_x, y1 - start_y
+    fraction = (offset_x * gate_y - offset_y * gate_x) / denominator
+    along_gate = (offset_x * move_y - offset_y * move_x) / denominator
+    if 0 < fraction <= 1 and 0 <= along_gate <= 1:
+        return fraction
+    return None
+
+
+class ProgressIndex:
+    # Предрасчёт трассы по воротам: центры ворот, векторы и длины участков
+    # между ними и накопленная длина. Прогресс машины — проекция на текущий
+    # участок, то есть O(1) при известном номере следующих ворот
+    def __init__(self, gates, laps=1):
+        self.gates = tuple(gates)
+        self.laps = laps
+        centers = [((x1 + x2) / 2, (y1 + y2) / 2) for x1, y1, x2, y2 in self.gates]
+        self.sections = [None]
+        distance = 0.0
+        for (start_x, start_y), (end_x, end_y) in zip(centers, centers[1:]):
+            vector_x, vector_y = end_x - start_x, end_y - start_y
+            length_sq = vector_x * vector_x + vector_y * vector_y
+            length = math.sqrt(length_sq)
+            self.sections.append((start_x, start_y, vector_x, vector_y, length_sq, length, distance))
+            distance += length
+        self.lap_length = distance
+
+    def __len__(self):
+        return len(self.gates)
+
+    def progress(self, x, y, next_gate, lap):
+        # Доля всей гонки [0, 1] с учётом пройденных кругов
+        if len(self.gates) < 2 or not self.lap_length:
+            return 0.0
+        start_x, start_y, vector_x, vector_y, length_sq, length, distance = self.sections[next_gate]
+        along = ((x - start_x) * vector_x + (y - start_y) * vector_y) / length_sq if length_sq else 0.0
+        along = min(max(along, 0.0), 1.0)
+        lap_progress = (distance + along * length) / self.lap_length
+        return (lap + lap_progress) / self.laps
+
+
+FLOW_FIELD_VERSION = 1
+FLOW_DIRECTIONS = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+
+
+class FlowField:
+    # Поле направлений к финишу по тайлам: для каждой клетки — номер
+    # направления из FLOW_DIRECTIONS к соседу, который ближе к финишу, или -1.
+    # Машина ИИ берёт направление по своей клетке за O(1)
+    def __init__(self, cell_size, columns, rows, directions, distances):
+        self.cell_size = cell_size
+        self.columns = columns
+        self.rows = rows
+        self.directions = directions
+        self.distances = distances
+        self.vectors = [(dx / math.hypot(dx, dy), dy / math.hypot(dx, dy)) for dx, dy in FLOW_DIRECTIONS]
+
+    def direction(self, x, y, default=(1.0, 0.0)):
+        column = int(x // self.cell_size)
+        row = int(y // self.cell_size)
+        if not (0 <= column < self.columns and 0 <= row < self.rows):
+            return default
+        index = self.directions[row * self.columns + column]
+        return self.vectors[index] if index >= 0 else default
+
+    def to_json(self):
+        return {
+            'version': FLOW_FIELD_VERSION,
+            'cell_size': self.cell_size,
+            'columns': self.columns,
+            'rows': self.rows,
+            'directions': self.directions,
+            'distances': [round(distance, 3) if distance != math.inf else None
+                          for distance in self.distances],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        distances = [math.inf if distance is None else distance for distance in data['distances']]
+        return cls(data['cell_size'], data['columns'], data['rows'], data['directions'], distances)
+
+
+def build_flow_field(walls, columns, rows, target, half_width, half_height):
+    # Поле строится в пространстве конфигураций: клетка проходима, если
+    # хитбокс машины с центром в ней не задевает стены. Дейкстра от клеток
+    # финиша target = (left, bottom, right, top) по 8 соседям без срезания углов
+    cell_size = walls.cell_size
+    passable = []
+    for row in range(rows):
+        y = (row + 0.5) * cell_size
+        for column in range(columns):
+            x = (column + 0.5) * cell_size
+            passable.append(not walls.overlaps(x - half_width, y - half_height,
+                                               x + half_width, y + half_height))
+    distances = [math.inf] * (columns * rows)
+    queue = []
+    left, bottom, right, top = target
+    for row in range(rows):
+        y = (row + 0.5) * cell_size
+        for column in range(columns):
+            x = (column + 0.5) * cell_size
+            index = row * columns + column
+            if passable[index] and left <= x <= right and bottom <= y <= top:
+                distances[index] = 0.0
+                queue.append((0.0, index))
+    heapq.heapify(queue)
+    while queue:
+        distance, index = heapq.heappop(queue)
+        if distance > distances[index]:
+            continue
+        row, column = divmod(index, columns)
+        for dx, dy in FLOW_DIRECTIONS:
+            next_column, next_row = column + dx, row + dy
+            if not (0 <= next_column < columns and 0 <= next_row < rows):
+                continue
+            next_index = next_row * columns + next_column
+            if not passable[next_index]:
+                continue
+            if dx and dy and not (passable[row * columns + next_column] and
+                                  passable[next_row * columns + column]):
+                continue
+            next_distance = distance + (1.4142135623730951 if dx and dy else 1.0)
+            if next_distance < distances[next_index]:
+                distances[next_index] = next_distance
+                heapq.heappush(queue, (next_distance, next_index))
+
+    # Направление клетки — к соседу с наименьшим расстоянием. Непроходимые
+    # клетки (машину туда затолкали) тоже смотрят на лучшего соседа, чтобы
+    # выбираться из камней, а не упираться в них
+    directions = []
+    for index in range(columns * rows):
+        row, column = divmod(index, columns)
+        best, best_distance = -1, distances[index]
+        for number, (dx, dy) in enumerate(FLOW_DIRECTIONS):
+            next_column, next_row = column + dx, row + dy
+            if not (0 <= next_column < columns and 0 <= next_row < rows):
+                continue
+            if dx and dy and not (passable[row * columns + next_column] and
+                                  passable[next_row * columns + column]):
+                continue
+            neighbour = distances[next_row * columns + next_column]
+            if neighbour < best_distance:
+                best, best_distance = number, neighbour
+        directions.append(best)
+    return FlowField(cell_size, columns, rows, directions, distances)
+
+
+@lru_cache(maxsize=None)
+def load_flow_field(path, wall_layers, target, half_width, half_height):
+    # Поле считается один раз на карту и кладётся в .cache рядом с картой.
+    # Ключ — хэш содержимого TMX и параметров поля, так что правка карты
+    # или размеров машин сама даёт новый файл
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read())
+    digest.update(repr((FLOW_FIELD_VERSION, wall_layers, target, half_width, half_height)).encode())
+    cache_path = os.path.join(os.path.dirname(os.path.abspath(path)), ".cache",
+                              f"flow_{digest.hexdigest()[:20]}.json")
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get('version') == FLOW_FIELD_VERSION:
+            return FlowField.from_json(data)
+    except (OSError, ValueError, KeyError):
+        pass
+    walls = load_map_geometry(path, wall_layers)[0]
+    width, height = map_size(path)
+    field = build_flow_field(walls, width, height, target, half_width, half_height)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temporary = cache_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(field.to_json(), f)
+        os.replace(temporary, cache_path)
+    except OSError:
+        # Каталог только для чтения: работаем с полем из памяти
+        pass
+    return field